@@ -16,25 +16,31 @@
 # Copyright (C) 2011 Simon Newton
 # The handlers for the admin page.
 
+import ast
+import collections
 import common
+import compression
+import counters
+import datetime
 from common import BasePageHandler
 from data.controller_data import CONTROLLER_DATA
 from data.manufacturer_data import MANUFACTURER_DATA
 from data.manufacturer_links import MANUFACTURER_LINKS
-from data.model_data import DEVICE_MODEL_DATA
 from data.node_data import NODE_DATA
 from data.pid_data import ESTA_PIDS, MANUFACTURER_PIDS
 from data.product_categories import PRODUCT_CATEGORIES
 from data.software_data import SOFTWARE_DATA
 from data.splitter_data import SPLITTER_DATA
-import datetime
 import html_differ
+import image_fetcher
 import logging
-import memcache_keys
+import manufacturer_directory
+import model_load_job
 import model_loader
 import product_loader
+import ranking
 import timestamp_keys
-from google.appengine.api import memcache
+import versioned_cache
 from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import db
@@ -42,25 +48,11 @@ from google.appengine.ext import webapp
 from google.appengine.ext.blobstore import BlobInfo
 from google.appengine.ext.db import BadValueError
 from google.appengine.ext.webapp import template
-from model import Command, Controller, LastUpdateTime, Manufacturer, Node, Pid, Product, ProductCategory, ProductTag, Responder, ResponderTag, ResponderTagRelationship, Software, SoftwareVersion, Splitter, UploadedResponderInfo
+from model import Command, Controller, Manufacturer, Node, Pid, PidSupport, Product, ProductCategory, ProductTag, ProductTagRelationship, Responder, ResponderTag, ResponderTagRelationship, Software, SoftwareVersion, Splitter, UploadedResponderInfo
+from model import ManufacturerKeyName
 from utils import StringToInt
 from pid_loader import PidLoader
-
-
-def UpdateModificationTime(timestamp_name):
-  """Update a particular timestamp."""
-  query = LastUpdateTime.all()
-  query.filter('name = ', timestamp_name)
-  result = query.fetch(1)
-  if not result:
-    result = LastUpdateTime(name=timestamp_name)
-  else:
-    result = result[0]
-  result.update_time = datetime.datetime.now()
-  result.put()
-
-  # delete the index info cache
-  memcache.delete(memcache_keys.INDEX_INFO)
+from update_times import UpdateModificationTime
 
 
 class BaseAdminPageHandler(BasePageHandler):
@@ -99,10 +91,6 @@ class AdminPageHandler(BaseAdminPageHandler):
 
     existing_manufacturers = set()
     manufacturers_to_delete = []
-    # invalidate the cache now
-    memcache.delete(memcache_keys.MANUFACTURER_CACHE_KEY)
-    memcache.delete(memcache_keys.MANUFACTURER_MODEL_COUNTS)
-    memcache.delete(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
     added = removed = updated = errors = 0
 
     for manufacturer in Manufacturer.all():
@@ -130,8 +118,10 @@ class AdminPageHandler(BaseAdminPageHandler):
         continue
 
       logging.info('adding %d (%s)' % (manufacturer_id, manufacturer_name))
-      manufacturer = Manufacturer(esta_id=manufacturer_id,
-                                  name=manufacturer_name)
+      manufacturer = Manufacturer(
+          key_name=ManufacturerKeyName(manufacturer_id),
+          esta_id=manufacturer_id,
+          name=manufacturer_name)
       manufacturer.put()
       added += 1
 
@@ -152,8 +142,6 @@ class AdminPageHandler(BaseAdminPageHandler):
       new_data[id] = name
 
     present_manufacturers = set()
-    # invalidate the cache now
-    memcache.delete(memcache_keys.MANUFACTURER_CACHE_KEY)
     added = updated = missing = errors = 0
 
     for manufacturer in Manufacturer.all():
@@ -193,13 +181,17 @@ class AdminPageHandler(BaseAdminPageHandler):
             (added, updated, missing, errors))
 
   def ClearPids(self):
-    memcache.delete(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
-    memcache.delete(memcache_keys.MANUFACTURER_PID_COUNTS)
     for item in Command.all():
       item.delete()
 
+    for item in PidSupport.all():
+      item.delete()
+
     for item in Pid.all():
       item.delete()
+    counters.Reset(counters.MANUFACTURER_PIDS)
+    counters.ResetGroup(counters.PIDS_BY_MANUFACTURER)
+    UpdateModificationTime(timestamp_keys.PIDS)
     return ''
 
   def ClearManufacturerPids(self):
@@ -208,8 +200,9 @@ class AdminPageHandler(BaseAdminPageHandler):
 
     count = 0
     if manufacturer is not None:
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNTS)
+      deltas = [(counters.ManufacturerPids(manufacturer.esta_id), -1)]
+      if manufacturer.esta_id != self.ESTA_ID:
+        deltas.append((counters.MANUFACTURER_PIDS, -1))
 
       for pid in manufacturer.pid_set:
         if pid.discovery_command:
@@ -218,20 +211,14 @@ class AdminPageHandler(BaseAdminPageHandler):
           pid.get_command.delete()
         if pid.set_command:
           pid.set_command.delete()
-        pid.delete()
+        db.delete(PidSupport.all(keys_only=True).ancestor(pid).fetch(100))
+        counters.RunInTransaction(pid.delete, deltas)
         count += 1
+      UpdateModificationTime(timestamp_keys.PIDS)
     return 'Deleted %d PIDs' % count
 
   def FlushCache(self):
-    keys = [
-        memcache_keys.PRODUCT_COUNT_KEY,
-        memcache_keys.MANUFACTURER_MODEL_COUNTS,
-        memcache_keys.CATEGORY_MODEL_COUNTS,
-        memcache_keys.TAG_MODEL_COUNTS,
-        memcache_keys.INDEX_INFO
-    ]
-    for key in keys:
-      memcache.delete(key)
+    versioned_cache.Invalidate(*timestamp_keys.ALL)
     return ''
 
   def LoadPids(self):
@@ -243,7 +230,6 @@ class AdminPageHandler(BaseAdminPageHandler):
 
     if modified > 0:
       UpdateModificationTime(timestamp_keys.PIDS)
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNTS)
 
     return 'Added / Updated %d PIDs' % modified
 
@@ -255,6 +241,83 @@ class AdminPageHandler(BaseAdminPageHandler):
     task = taskqueue.Task(method='GET', url='/tasks/rank_devices')
     task.add()
 
+  def DenormalizeResponders(self):
+    task = taskqueue.Task(method='GET', url='/tasks/denormalize_responders')
+    task.add()
+    return ('Started updating the latest software & search tokens for all '
+            'responders')
+
+  def RecountCounters(self):
+    """Rebuild all the counters from the datastore."""
+    product_count = 0
+    responder_count = 0
+    manufacturer_pids = 0
+    by_product_type = collections.defaultdict(int)
+    by_product_tag = collections.defaultdict(int)
+    by_manufacturer = collections.defaultdict(int)
+    by_category = collections.defaultdict(int)
+    pids_by_manufacturer = collections.defaultdict(int)
+
+    category_ids = {}
+    for category in ProductCategory.all():
+      category_ids[category.key()] = category.id
+
+    for responder in Responder.all():
+      product_count += 1
+      responder_count += 1
+      manufacturer = manufacturer_directory.GetEntityManufacturer(responder)
+      by_manufacturer[manufacturer.esta_id] += 1
+      category_key = Responder.product_category.get_value_for_datastore(
+          responder)
+      if category_key in category_ids:
+        by_category[category_ids[category_key]] += 1
+
+    product_types = dict((cls.class_name(), cls) for cls in
+                         [Controller, Node, Software, Splitter])
+    for product in Product.all():
+      product_count += 1
+      by_product_type[product.class_name()] += 1
+
+    for relationship in ProductTagRelationship.all():
+      by_product_tag[
+          ProductTagRelationship.tag.get_value_for_datastore(relationship)] += 1
+
+    for pid in Pid.all():
+      manufacturer = manufacturer_directory.GetEntityManufacturer(pid)
+      pids_by_manufacturer[manufacturer.esta_id] += 1
+      if manufacturer.esta_id != self.ESTA_ID:
+        manufacturer_pids += 1
+
+    values = [(counters.PRODUCTS, product_count),
+              (counters.RESPONDERS, responder_count),
+              (counters.MANUFACTURER_PIDS, manufacturer_pids)]
+    for class_name, count in by_product_type.iteritems():
+      if class_name in product_types:
+        values.append(
+            (counters.ProductTypeCount(product_types[class_name]), count))
+    for tag_key, count in by_product_tag.iteritems():
+      values.append((counters.TagProducts(tag_key), count))
+    for esta_id, count in by_manufacturer.iteritems():
+      values.append((counters.ManufacturerResponders(esta_id), count))
+    for category_id, count in by_category.iteritems():
+      values.append((counters.CategoryResponders(category_id), count))
+    for esta_id, count in pids_by_manufacturer.iteritems():
+      values.append((counters.ManufacturerPids(esta_id), count))
+    counters.ReplaceAll(values)
+    self.FlushCache()
+    return ('Products: %d, Manufacturer PIDs: %d' %
+            (product_count, manufacturer_pids))
+
+  def MigrateCommands(self):
+    task = taskqueue.Task(method='GET', url='/tasks/migrate_commands')
+    task.add()
+    return 'Started converting the PID commands to JSON'
+
+  def MigrateKeys(self):
+    task = taskqueue.Task(method='GET', url='/tasks/migrate_keys')
+    task.add()
+    return 'Started key migration, flush the cache once it completes'
+
   def LoadManufacturerPids(self):
     loader = PidLoader()
     modified = 0
@@ -265,15 +328,14 @@ class AdminPageHandler(BaseAdminPageHandler):
 
     if modified > 0:
       UpdateModificationTime(timestamp_keys.PIDS)
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNTS)
 
     return 'Modified %d PIDs' % modified
 
   def ClearModels(self):
-    memcache.delete(memcache_keys.MODEL_COUNT_KEY)
+    count = 0
     for item in Responder.all():
       item.delete()
+      count += 1
 
     for item in SoftwareVersion.all():
       item.delete()
@@ -283,21 +345,18 @@ class AdminPageHandler(BaseAdminPageHandler):
 
     for item in ResponderTagRelationship.all():
       item.delete()
+
+    counters.Increment(counters.PRODUCTS, -count)
+    counters.Reset(counters.RESPONDERS)
+    counters.ResetGroup(counters.RESPONDERS_BY_MANUFACTURER)
+    counters.ResetGroup(counters.RESPONDERS_BY_CATEGORY)
+    UpdateModificationTime(timestamp_keys.DEVICES)
     return ''
 
   def UpdateModels(self):
-    loader = model_loader.ModelLoader(DEVICE_MODEL_DATA)
-    added, updated = loader.Update()
-    if added or updated:
-      memcache.delete(memcache_keys.INDEX_INFO)
-      memcache.delete(memcache_keys.PRODUCT_COUNT_KEY)
-      memcache.delete(memcache_keys.MANUFACTURER_MODEL_COUNTS)
-      memcache.delete(memcache_keys.CATEGORY_MODEL_COUNTS)
-      memcache.delete(memcache_keys.TAG_MODEL_COUNTS)
-
-    UpdateModificationTime(timestamp_keys.DEVICES)
-    return ('Models:\nAdded: %s\nUpdated: %s' %
-            (', '.join(added), ', '.join(updated)))
+    job_id, task_count = model_load_job.Start()
+    return ('Started loading models with %d tasks, job %s. The results are '
+            'logged when the load completes.' % (task_count, job_id))
 
   def UpdateProductCategories(self):
     """Update the list of Product Categories."""
@@ -339,6 +398,8 @@ class AdminPageHandler(BaseAdminPageHandler):
       category.delete()
       removed += 1
     logging.info('update complete')
+    # the category counts are cached with the devices
+    versioned_cache.Invalidate(timestamp_keys.DEVICES)
     return ('Categories: added %d, removed %d, updated %d' %
             (added, removed, updated))
 
@@ -399,96 +460,92 @@ class AdminPageHandler(BaseAdminPageHandler):
       return 'No blobs to delete'
 
   def InitiateImageFetch(self):
-    """Add /fetch_image tasks for all responders missing image data."""
-    urls = []
-    for responder in Responder.all():
-      if responder.image_url and not responder.image_data:
-        url = '/tasks/fetch_image?key=%s' % responder.key()
-        task = taskqueue.Task(method='GET', url=url)
-        task.add()
-        urls.append(responder.image_url)
+    """Queue fetches for all the responders & products missing image data.
 
-    for product in Product.all():
-      if product.image_url and not product.image_data:
-        url = '/tasks/fetch_product_image?key=%s' % product.key()
-        task = taskqueue.Task(method='GET', url=url)
-        task.add()
-        urls.append(product.image_url)
+    URLs which have failed recently, or too many times, are skipped.
+    """
+    now = datetime.datetime.now()
+    keys = []
+    urls = []
+    for query in [Responder.all(), Product.all()]:
+      for entity in query:
+        if image_fetcher.NeedsFetch(entity, now):
+          keys.append(entity.key())
+          urls.append(entity.image_url)
+    image_fetcher.ScheduleFetches(keys)
 
     if urls:
       return 'Fetching urls: \n%s' % '\n'.join(urls)
     else:
       return 'No images to fetch'
 
-  def ClearProductType(self, product_class):
-    """Delete all instances of a product class."""
+  def ClearProductType(self, product_class, timestamp_key):
+    """Delete all instances of a product class.
+
+    Args:
+      product_class: the subclass to delete
+      timestamp_key: a timestamp key to update.
+    """
     for splitter in product_class.all():
       for tag in splitter.tag_set:
-        tag.delete()
-      splitter.delete()
+        tag_key = ProductTagRelationship.tag.get_value_for_datastore(tag)
+        counters.RunInTransaction(tag.delete,
+                                  [(counters.TagProducts(tag_key), -1)])
+      counters.RunInTransaction(
+          splitter.delete,
+          [(counters.PRODUCTS, -1),
+           (counters.ProductTypeCount(product_class), -1)])
+    UpdateModificationTime(timestamp_key)
     return ''
 
-  def LoadProductType(self, data, product_type, memcache_keys, timestamp_key):
+  def LoadProductType(self, data, product_type, timestamp_key):
     """Load products from data.
 
     Args:
       data: The data to load
       product_type: the subclass to use
-      memcache_keys: a list of keys to invalidate after loading
       timestamp_key: a timestamp key to update.
     """
     loader = product_loader.ProductLoader(data, product_type)
     added, updated = loader.Update()
-    if added or updated:
-       for key in memcache_keys:
-         memcache.delete(key)
-
     UpdateModificationTime(timestamp_key)
     return ('Products:\nAdded: %s\nUpdated: %s' %
             (', '.join(added), ', '.join(updated)))
 
   def ClearControllers(self):
-    return self.ClearProductType(Controller)
+    return self.ClearProductType(Controller, timestamp_keys.CONTROLLERS)
 
   def UpdateControllers(self):
     return self.LoadProductType(
         CONTROLLER_DATA,
         Controller,
-        [memcache_keys.MANUFACTURER_CONTROLLER_COUNTS,
-         memcache_keys.TAG_CONTROLLER_COUNTS],
         timestamp_keys.CONTROLLERS)
 
   def ClearNodes(self):
-    return self.ClearProductType(Node)
+    return self.ClearProductType(Node, timestamp_keys.NODES)
 
   def UpdateNodes(self):
     return self.LoadProductType(
         NODE_DATA,
         Node,
-        [memcache_keys.MANUFACTURER_NODE_COUNTS,
-         memcache_keys.TAG_NODE_COUNTS],
         timestamp_keys.NODES)
 
   def ClearSplitters(self):
-    return self.ClearProductType(Splitter)
+    return self.ClearProductType(Splitter, timestamp_keys.SPLITTERS)
 
   def UpdateSplitters(self):
     return self.LoadProductType(
         SPLITTER_DATA,
         Splitter,
-        [memcache_keys.MANUFACTURER_SPLITTER_COUNTS,
-         memcache_keys.TAG_SPLITTER_COUNTS],
         timestamp_keys.SPLITTERS)
 
   def ClearSoftware(self):
-    return self.ClearProductType(Software)
+    return self.ClearProductType(Software, timestamp_keys.SOFTWARE)
 
   def UpdateSoftware(self):
     return self.LoadProductType(
         SOFTWARE_DATA,
         Software,
-        [memcache_keys.MANUFACTURER_SOFTWARE_COUNTS,
-         memcache_keys.TAG_SOFTWARE_COUNTS],
         timestamp_keys.SOFTWARE)
 
   def HandleRequest(self):
@@ -500,13 +557,17 @@ class AdminPageHandler(BaseAdminPageHandler):
         'clear_mp': self.ClearManufacturerPids,
         'clear_software': self.ClearSoftware,
         'clear_splitters': self.ClearSplitters,
+        'denormalize_responders': self.DenormalizeResponders,
         'flush_cache': self.FlushCache,
         'gc_blobs': self.GarbageCollectBlobs,
         'gc_tags': self.GarbageCollectTags,
         'initiate_image_fetch': self.InitiateImageFetch,
         'load_mp': self.LoadManufacturerPids,
         'load_p': self.LoadPids,
+        'migrate_commands': self.MigrateCommands,
+        'migrate_keys': self.MigrateKeys,
         'rank_devices': self.RankDevices,
+        'recount': self.RecountCounters,
         'responder_pid_index': self.BuildResponderPidIndex,
         'update_categories': self.UpdateProductCategories,
         'update_controllers': self.UpdateControllers,
@@ -540,7 +601,7 @@ class ResponderModerator(BaseAdminPageHandler):
   """Displays the UI for moderating responder data."""
   def EvalData(self, data):
     try:
-      evaled_data = eval(data, {})
+      evaled_data = ast.literal_eval(data)
       return evaled_data
     except Exception as e:
       logging.info(data)
@@ -590,8 +651,11 @@ class ResponderModerator(BaseAdminPageHandler):
 
     updater = model_loader.ModelUpdater()
     was_added, was_changed = updater.UpdateResponder(manufacturer, model_data)
+    updater.Flush()
     logging.info('Was added %s' % was_added)
     logging.info('Was changed %s' % was_changed)
+    if was_added or was_changed:
+      UpdateModificationTime(timestamp_keys.DEVICES)
 
     # finally mark this one as done
     responder_info.processed = True
@@ -881,6 +945,7 @@ class AdjustTestScore(BaseAdminPageHandler):
             'Set rating of %s to %d' %
             (responder.model_description, rating_int))
         responder.rdm_responder_rating = db.Rating(rating_int)
+        ranking.Rescore(responder)
         responder.put()
 
     self.response.headers['Content-Type'] = 'text/html'
@@ -889,10 +954,10 @@ class AdjustTestScore(BaseAdminPageHandler):
       template_data))
 
 
-app = webapp.WSGIApplication(
+app = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/admin', AdminPageHandler),
     ('/admin/moderate_responder_data', ResponderModerator),
     ('/admin/adjust_test_score', AdjustTestScore),
   ],
-  debug=True)
+  debug=True))
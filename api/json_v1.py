@@ -16,14 +16,18 @@
 # Copyright (C) 2012 Simon Newton
 # Version 1 of the JSON API.
 
-from model import Controller, LastUpdateTime, Manufacturer, Node, Pid, ProductTag, Responder, Software, Splitter
+from model import Controller, LastUpdateTime, Node, ProductTag, Responder, Software, Splitter
 import common
+import compression
 import json
 import logging
+import manufacturer_directory
 import memcache_keys
+import pid_cache
+import responder_search
 import timestamp_keys
 import utils
-from google.appengine.api import memcache
+import versioned_cache
 from google.appengine.ext import webapp
 
 
@@ -32,19 +36,21 @@ class ManufacturerList(webapp.RequestHandler):
   CACHE_KEY = memcache_keys.MANUFACTURER_CACHE_KEY
 
   def get(self):
+    if common.CheckNotModified(self, self.CACHE_KEY.domains):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
-    self.response.headers['Cache-Control'] = 'public; max-age=300;'
 
-    response = memcache.get(memcache_keys.MANUFACTURER_CACHE_KEY)
+    response = versioned_cache.Get(self.CACHE_KEY)
     if response is None:
       response = self.BuildResponse()
-      if not memcache.add(self.CACHE_KEY, response):
+      if not versioned_cache.Add(self.CACHE_KEY, response):
         logging.error("Manufacturer Memcache set failed.")
     self.response.out.write(response)
 
   def BuildResponse(self):
     manufacturers = []
-    for manufacturer in Manufacturer.all():
+    for manufacturer in sorted(manufacturer_directory.AllManufacturers(),
+                               key=lambda m: m.esta_id):
       manufacturers.append({
         'name': manufacturer.name,
         'id': manufacturer.esta_id
@@ -55,6 +61,8 @@ class ManufacturerList(webapp.RequestHandler):
 class ManufacturerLookup(webapp.RequestHandler):
   """Query on manufacturer ID."""
   def get(self):
+    if common.CheckNotModified(self, [timestamp_keys.MANUFACTURERS]):
+      return
     manufacturer = common.GetManufacturer(self.request.get('manufacturer'))
     if manufacturer is None:
       self.error(404)
@@ -65,13 +73,14 @@ class ManufacturerLookup(webapp.RequestHandler):
       'esta_id': manufacturer.esta_id,
     }
     self.response.headers['Content-Type'] = 'text/plain'
-    self.response.headers['Cache-Control'] = 'public; max-age=300;'
     self.response.out.write(json.dumps(output))
 
 
 class ResponderFirmware(webapp.RequestHandler):
   """Return the latest firmware for a responder."""
   def get(self):
+    if common.CheckNotModified(self, [timestamp_keys.DEVICES]):
+      return
     responder = common.LookupModel(self.request.get('manufacturer'),
                                    self.request.get('model'))
     if responder is None:
@@ -81,6 +90,7 @@ class ResponderFirmware(webapp.RequestHandler):
     version = common.GetLatestSoftware(responder)
     if version is None:
       self.error(404)
+      return
 
     output = {
       'version': version.version_id,
@@ -88,13 +98,40 @@ class ResponderFirmware(webapp.RequestHandler):
       'URL': '',
     }
     self.response.headers['Content-Type'] = 'text/json'
-    self.response.headers['Cache-Control'] = 'public; max-age=300;'
     self.response.out.write(json.dumps(output))
 
 
+class ResponderSearch(webapp.RequestHandler):
+  """Search the responders by description, manufacturer, category or tag."""
+  MAX_RESULTS = 100
+
+  def get(self):
+    if common.CheckNotModified(
+        self, [timestamp_keys.DEVICES, timestamp_keys.MANUFACTURERS]):
+      return
+    results = []
+    query = self.request.get('q')
+    if query:
+      limit = utils.StringToInt(self.request.get('limit'))
+      if limit is None or not 0 < limit <= self.MAX_RESULTS:
+        limit = self.MAX_RESULTS
+      for responder in responder_search.Search(query, limit):
+        results.append({
+          'manufacturer_name': responder.manufacturer.name,
+          'manufacturer_id': responder.manufacturer.esta_id,
+          'device_model_id': responder.device_model_id,
+          'model_description': responder.model_description,
+        })
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.out.write(json.dumps({'results': results}))
+
+
 class ResponderPersonalities(webapp.RequestHandler):
   """Returns the personalities for a responder."""
   def get(self):
+    if common.CheckNotModified(
+        self, [timestamp_keys.DEVICES, timestamp_keys.MANUFACTURERS]):
+      return
     responder = common.LookupModel(self.request.get('manufacturer'),
                                    self.request.get('model'))
     if responder is None:
@@ -118,21 +155,23 @@ class ResponderPersonalities(webapp.RequestHandler):
       }
       versions.append(version_output)
 
+    manufacturer = manufacturer_directory.GetEntityManufacturer(responder)
     output = {
-      'manufacturer_name': responder.manufacturer.name,
-      'manufacturer_id': responder.manufacturer.esta_id,
+      'manufacturer_name': manufacturer.name,
+      'manufacturer_id': manufacturer.esta_id,
       'device_model_id': responder.device_model_id,
       'model_description': responder.model_description,
       'versions': versions,
     }
     self.response.headers['Content-Type'] = 'text/plain'
-    self.response.headers['Cache-Control'] = 'public; max-age=300;'
     self.response.out.write(json.dumps(output))
 
 
 class UpdateTimeHandler(webapp.RequestHandler):
   """Return the last update time for various parts of the index."""
   def get(self):
+    if common.CheckNotModified(self, timestamp_keys.ALL):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
 
     # timestamp name : json key
@@ -157,8 +196,10 @@ class UpdateTimeHandler(webapp.RequestHandler):
 class ProductTags(webapp.RequestHandler):
   """Return the tags and number of products for each."""
   def get(self):
+    if common.CheckNotModified(self, self.MemcacheKey().domains):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
-    tag_list = memcache.get(self.MemcacheKey())
+    tag_list = versioned_cache.Get(self.MemcacheKey())
     if not tag_list:
       tag_list = []
       query = ProductTag.all()
@@ -171,17 +212,20 @@ class ProductTags(webapp.RequestHandler):
               'label': tag.label,
               'count': products,
           })
-      memcache.set(self.MemcacheKey(), tag_list)
+      versioned_cache.Set(self.MemcacheKey(), tag_list)
     self.response.out.write(json.dumps(tag_list))
 
 
 class ProductManufacturers(webapp.RequestHandler):
   """Return the manufactures and number of products for each."""
   def get(self):
+    if common.CheckNotModified(self, self.MemcacheKey().domains):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
-    manufacturer_list = memcache.get(self.MemcacheKey())
+    manufacturer_list = versioned_cache.Get(self.MemcacheKey())
     if not manufacturer_list:
-      query = self.ProductType().all()
+      query = common.PrefetchReferences(self.ProductType().all(),
+                                        self.ProductType().manufacturer)
       manufacturer_by_id = {}
       for product in query:
         manufacturer = product.manufacturer
@@ -194,7 +238,7 @@ class ProductManufacturers(webapp.RequestHandler):
         manufacturer_by_id[manufacturer.esta_id]['count'] += 1
       manufacturer_list = manufacturer_by_id.values()
       manufacturer_list.sort(key=lambda x: x['name'])
-      memcache.set(self.MemcacheKey(), manufacturer_list)
+      versioned_cache.Set(self.MemcacheKey(), manufacturer_list)
     self.response.out.write(json.dumps(manufacturer_list))
 
 
@@ -270,8 +314,10 @@ class SplitterTags(ProductTags):
 class PidCounts(webapp.RequestHandler):
   """Return the count of PID usage."""
   def get(self):
+    if common.CheckNotModified(self,
+                               [timestamp_keys.DEVICES, timestamp_keys.PIDS]):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
-    self.response.headers['Cache-Control'] = 'public; max-age=300;'
     self.response.out.write(self.BuildResponse())
 
   def BuildResponse(self):
@@ -282,10 +328,7 @@ class PidCounts(webapp.RequestHandler):
     max_pids = 0
     max_pids_responder = ''
     for responder in Responder.all():
-      params = []
-      version = common.GetLatestSoftware(responder)
-      if version:
-        params = version.supported_parameters
+      params = common.GetLatestSupportedParameters(responder)
 
       manufacturer_pids = 0
       for param in params:
@@ -309,11 +352,9 @@ class PidCounts(webapp.RequestHandler):
         'count': count,
       }
       if param < 0x8000:
-        query = Pid.all()
-        query.filter('pid_id = ', param)
-        pid = query.fetch(1)
-        if pid:
-          param_info['name'] = pid[0].name
+        name = pid_cache.GetPidName(pid_cache.ESTA_ID, param)
+        if name is not None:
+          param_info['name'] = name
       pids.append(param_info)
 
     output = {
@@ -326,12 +367,13 @@ class PidCounts(webapp.RequestHandler):
     return json.dumps(output)
 
 
-app = webapp.WSGIApplication(
+app = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/api/json/1/manufacturers', ManufacturerList),
     ('/api/json/1/manufacturer', ManufacturerLookup),
     ('/api/json/1/latest_responder_firmware', ResponderFirmware),
     ('/api/json/1/responder_personalities', ResponderPersonalities),
+    ('/api/json/1/responder_search', ResponderSearch),
     ('/api/json/1/update_times', UpdateTimeHandler),
     ('/api/json/1/controller_tags', ControllerTags),
     ('/api/json/1/controller_manufacturers', ControllerManufacturers),
@@ -343,4 +385,4 @@ app = webapp.WSGIApplication(
     ('/api/json/1/splitter_manufacturers', SplitterManufacturers),
     ('/api/json/1/pid_counts', PidCounts),
   ],
-  debug=True)
+  debug=True))
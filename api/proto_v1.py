@@ -16,18 +16,23 @@
 # Copyright (C) 2012 Simon Newton
 # Version 1 of the Proto API
 
-from model import Manufacturer
+import common
+import compression
+import manufacturer_directory
+import timestamp_keys
 from google.appengine.ext import webapp
 
 
 class ManufacturerList(webapp.RequestHandler):
   """Return the list of all manufacturers."""
   def get(self):
+    if common.CheckNotModified(self, [timestamp_keys.MANUFACTURERS]):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
-    self.response.headers['Cache-Control'] = 'public; max-age=300;'
 
     output = []
-    for manufacturer in Manufacturer.all():
+    for manufacturer in sorted(manufacturer_directory.AllManufacturers(),
+                               key=lambda m: m.esta_id):
       output.append("manufacturer {")
       output.append("  name: \"%s\"" % manufacturer.name)
       output.append("  id: %d" % manufacturer.esta_id)
@@ -36,8 +41,8 @@ class ManufacturerList(webapp.RequestHandler):
     self.response.out.write('\n'.join(output))
 
 
-app = webapp.WSGIApplication(
+app = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/api/proto/1/manufacturers', ManufacturerList),
   ],
-  debug=True)
+  debug=True))
@@ -0,0 +1,112 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# command_messages.py
+# Copyright (C) 2026 Simon Newton
+# Storage of the Command request & response messages.
+#
+# The messages are stored as canonical JSON (sorted keys, no whitespace)
+# along with the SHA-1 of the JSON, so the same message always has the same
+# hash. Older entities hold the str() of a Python dict, which is parsed with
+# ast.literal_eval until /admin?action=migrate_commands has been run.
+
+import ast
+import hashlib
+import json
+
+# Parsed messages, keyed by hash. The number of distinct messages is small,
+# this is a guard against unbounded growth.
+MAX_CACHE_SIZE = 5000
+_parsed_messages = {}
+
+
+def Encode(message):
+  """Return the canonical JSON form of a message dict."""
+  return json.dumps(message, sort_keys=True, separators=(',', ':'))
+
+
+def Hash(encoded_message):
+  """Return the hash of an encoded message."""
+  if isinstance(encoded_message, unicode):
+    encoded_message = encoded_message.encode('utf-8')
+  return hashlib.sha1(encoded_message).hexdigest()
+
+
+def _Parse(text):
+  try:
+    return json.loads(text)
+  except ValueError:
+    # The legacy str() format
+    return ast.literal_eval(text)
+
+
+def Parse(text, content_hash=None):
+  """Parse a stored message.
+
+  The result is cached for the lifetime of the instance, and shared between
+  callers, so it mustn't be modified.
+
+  Args:
+    text: the stored message.
+    content_hash: the stored hash of the message, or None if there isn't one.
+  """
+  if text is None:
+    return None
+  if content_hash is None:
+    content_hash = Hash(text)
+  message = _parsed_messages.get(content_hash)
+  if message is None:
+    if len(_parsed_messages) >= MAX_CACHE_SIZE:
+      _parsed_messages.clear()
+    message = _Parse(text)
+    _parsed_messages[content_hash] = message
+  return message
+
+
+def Request(command):
+  """Return the parsed request message of a Command."""
+  return Parse(command.request, command.request_hash)
+
+
+def Response(command):
+  """Return the parsed response message of a Command."""
+  return Parse(command.response, command.response_hash)
+
+
+def SetMessages(command, request, response):
+  """Set the request & response of a Command.
+
+  Args:
+    command: the Command entity.
+    request: the request message dict.
+    response: the response message dict.
+
+  Returns:
+    True if either message changed, False otherwise.
+  """
+  changed = False
+  encoded = Encode(request)
+  content_hash = Hash(encoded)
+  if content_hash != command.request_hash:
+    command.request = encoded
+    command.request_hash = content_hash
+    changed = True
+
+  encoded = Encode(response)
+  content_hash = Hash(encoded)
+  if content_hash != command.response_hash:
+    command.response = encoded
+    command.response_hash = content_hash
+    changed = True
+  return changed
@@ -16,14 +16,20 @@
 # Copyright (C) 2011 Simon Newton
 # Common functions
 
-from model import LastUpdateTime, Manufacturer, Pid, Product, ProductCategory, Responder, UploadedResponderInfo
+from model import LastUpdateTime, Manufacturer, ProductCategory, Responder, UploadedResponderInfo
+from model import LastUpdateTimeKeyName, ResponderKeyName
 from utils import StringToInt
+import calendar
+import counters
 import datetime
-import logging
+import email.utils
+import hashlib
+import manufacturer_directory
 import memcache_keys
 import textwrap
+import versioned_cache
 from google.appengine.api import mail
-from google.appengine.api import memcache
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
@@ -59,16 +65,17 @@ def GetManufacturer(manufacturer_id):
   """Lookup a manufacturer entity by manufacturer id. The manufacturer id can
      be a string in decimal or hex (prepend with 0x), or an int
 
+  This is served from the in-memory manufacturer directory, the entity must
+  not be modified.
+
   Returns:
     The Manufacturer entity object, or None if not found.
   """
   if type(manufacturer_id) not in (int, long):
     manufacturer_id = StringToInt(manufacturer_id)
-  query = Manufacturer.all()
-  query.filter('esta_id = ', manufacturer_id)
-  for manufacturer in query.fetch(1):
-    return manufacturer
-  return None
+  if manufacturer_id is None:
+    return None
+  return manufacturer_directory.GetManufacturer(manufacturer_id)
 
 
 def LookupModelFromRequest(request):
@@ -80,23 +87,188 @@ def LookupModel(manufacturer, model_id):
   """Lookup a model based on the URL params."""
   if type(model_id) not in (int, long):
     model_id = StringToInt(model_id)
-  manufacturer = GetManufacturer(manufacturer)
+  if type(manufacturer) not in (int, long):
+    manufacturer = StringToInt(manufacturer)
   if manufacturer is None or model_id is None:
     return None
 
-  models = Responder.all()
-  models.filter('device_model_id = ', model_id)
-  models.filter('manufacturer = ', manufacturer.key())
+  return Responder.get_by_key_name(ResponderKeyName(manufacturer, model_id))
 
-  model_data = models.fetch(1)
-  if not model_data:
-    return None
-  return model_data[0]
+
+# The maximum number of keys to fetch in one db.get()
+MAX_BATCH_GET = 500
+# The number of entities to fetch from a query at once
+QUERY_BATCH_SIZE = 100
+
+
+def PrefetchReferences(entities, *properties):
+  """Resolve the ReferenceProperties of a list of entities in one batch.
+
+  Rather than doing a datastore get each time a reference is dereferenced,
+  this collects all the keys, fetches them with a single db.get() and attaches
+  the results to the entities. References to Manufacturers are resolved from
+  the manufacturer directory.
+
+  Args:
+    entities: an iterable of entities.
+    properties: the ReferenceProperty objects to resolve, e.g.
+      Responder.manufacturer.
+
+  Returns:
+    The entities, as a list.
+  """
+  entities = list(entities)
+  resolved = {}
+  keys_to_fetch = set()
+  for prop in properties:
+    for entity in entities:
+      key = prop.get_value_for_datastore(entity)
+      if key is None or key in resolved:
+        continue
+      if prop.reference_class is Manufacturer:
+        manufacturer = manufacturer_directory.GetManufacturerByKey(key)
+        if manufacturer is not None:
+          resolved[key] = manufacturer
+          continue
+      keys_to_fetch.add(key)
+
+  keys_to_fetch = list(keys_to_fetch)
+  for i in xrange(0, len(keys_to_fetch), MAX_BATCH_GET):
+    batch = keys_to_fetch[i:i + MAX_BATCH_GET]
+    for key, referenced_entity in zip(batch, db.get(batch)):
+      if referenced_entity is not None:
+        resolved[key] = referenced_entity
+
+  for prop in properties:
+    for entity in entities:
+      referenced_entity = resolved.get(prop.get_value_for_datastore(entity))
+      if referenced_entity is not None:
+        prop.__set__(entity, referenced_entity)
+  return entities
+
+
+def QueryInBatches(query, batch_size=QUERY_BATCH_SIZE):
+  """Walk a query in batches, using cursors between them.
+
+  Unlike iterating over the query, this lets the caller work on (and prefetch
+  the references for) one batch at a time.
+
+  Yields:
+    Lists of up to batch_size entities.
+  """
+  while True:
+    entities = query.fetch(batch_size)
+    if entities:
+      yield entities
+    if len(entities) < batch_size:
+      return
+    query.with_cursor(query.cursor())
+
+
+def FetchPage(query, listing, domains, page, page_size, cursor=None):
+  """Fetch one page of a listing, using cursors rather than an offset.
+
+  The cursor at the start of each page is cached, so we only fall back to an
+  offset fetch the first time a page is viewed after the data changes. Only
+  the cursors we computed are cached, a cursor from the request is used for
+  that response alone, since it may not be for the page it claims to be.
+
+  Args:
+    query: the query for the listing.
+    listing: a name for the listing, used in the cache keys.
+    domains: the timestamp_keys sections the listing depends on.
+    page: the page number, 0 offset.
+    page_size: the number of entities per page.
+    cursor: the cursor from the request, or None.
+
+  Returns:
+    A tuple of (entities, previous_cursor, next_cursor). previous_cursor is
+    None for the second page, since the first page doesn't need one.
+  """
+  def CursorKey(page):
+    return memcache_keys.BrowseCursorKey(listing, page, *domains)
+
+  # True if the page was fetched from a cursor we computed
+  trusted = not cursor
+  if not cursor and page:
+    cursor = versioned_cache.Get(CursorKey(page))
+
+  entities = None
+  if cursor:
+    try:
+      query.with_cursor(cursor)
+      entities = query.fetch(page_size)
+    except (db.BadRequestError, db.BadValueError):
+      # the cursor was malformed or from a different query
+      query.with_cursor(None)
+      trusted = True
+  if entities is None:
+    entities = query.fetch(page_size, offset=page * page_size)
+
+  next_cursor = query.cursor()
+  if trusted:
+    versioned_cache.Set(CursorKey(page + 1), next_cursor)
+
+  previous_cursor = None
+  if page > 1:
+    previous_cursor = versioned_cache.Get(CursorKey(page - 1))
+  return entities, previous_cursor, next_cursor
+
+
+def GroupByReference(query, prop, value=lambda entity: entity):
+  """Group the results of a query by the value of a ReferenceProperty.
+
+  This lets us load a collection (e.g. the software_version_set) for many
+  entities with a single query, rather than one query per entity.
+
+  Args:
+    query: the query to run.
+    prop: the ReferenceProperty to group by, e.g. SoftwareVersion.responder.
+    value: called with each entity, returns what to store in the group. This
+      lets the caller keep just the fields it needs rather than the entities.
+
+  Returns:
+    A dict of referenced key to a list of values, in query order.
+  """
+  groups = {}
+  for entity in query:
+    groups.setdefault(prop.get_value_for_datastore(entity), []).append(
+        value(entity))
+  return groups
 
 
 def GetLatestSoftware(responder):
   """Find the latest software version for a responder.
 
+  Returns:
+    A SoftwareVersion object or None.
+  """
+  if responder.software_version_count is not None:
+    if not responder.software_version_count:
+      return None
+    return responder.latest_software
+  return FindLatestSoftware(responder)
+
+
+def GetLatestSupportedParameters(responder):
+  """Return the supported parameters of the latest software version.
+
+  Returns:
+    A list of PID values, which may be empty.
+  """
+  if responder.software_version_count is not None:
+    return responder.supported_parameters
+  version = FindLatestSoftware(responder)
+  if version is None:
+    return []
+  return version.supported_parameters
+
+
+def FindLatestSoftware(responder):
+  """Find the latest software version by scanning the software_version_set.
+
+  This ignores the denormalized fields on the Responder.
+
   Returns:
     A SoftwareVersion object or None.
   """
@@ -109,6 +281,93 @@ def GetLatestSoftware(responder):
   return max_version_info
 
 
+def GetLastUpdateTime(timestamp_name):
+  """Get the last update time for a section of the index.
+
+  Args:
+    timestamp_name: one of the names in timestamp_keys.
+
+  Returns:
+    A datetime, or None if that section has never been updated.
+  """
+  cache_key = memcache_keys.LastUpdateTimeKey(timestamp_name)
+  update_time = versioned_cache.Get(cache_key)
+  if update_time is None:
+    result = LastUpdateTime.get_by_key_name(
+        LastUpdateTimeKeyName(timestamp_name))
+    # 0 means there is no timestamp, so we don't keep going to the datastore
+    update_time = 0
+    if result is not None and result.update_time is not None:
+      update_time = result.update_time
+    versioned_cache.Add(cache_key, update_time)
+  return update_time or None
+
+
+# The Cache-Control header for responses that only change when the index is
+# updated.
+CACHE_CONTROL = 'public, max-age=300'
+
+
+def _ETagMatches(if_none_match, etag):
+  """Check an If-None-Match header, using the weak comparison."""
+  if if_none_match.strip() == '*':
+    return True
+  opaque_tag = etag[2:] if etag.startswith('W/') else etag
+  for tag in if_none_match.split(','):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag == opaque_tag:
+      return True
+  return False
+
+
+def CheckNotModified(handler, timestamp_names):
+  """Set the caching headers and handle conditional GETs.
+
+  The ETag and Last-Modified headers are derived from the update times of the
+  sections of the index the response is built from, so this only needs the
+  (memcached) timestamps rather than the data itself.
+
+  Args:
+    handler: the webapp.RequestHandler.
+    timestamp_names: the timestamp_keys sections the response depends on.
+
+  Returns:
+    True if the client's copy is up to date, in which case a 304 has been sent
+    and the handler should return without doing anything else.
+  """
+  handler.response.headers['Cache-Control'] = CACHE_CONTROL
+  update_times = [GetLastUpdateTime(name) for name in timestamp_names]
+  known_times = [t for t in update_times if t is not None]
+  if not known_times:
+    return False
+
+  # HTTP dates only have a resolution of one second
+  last_modified = calendar.timegm(max(known_times).utctimetuple())
+  etag = 'W/"%s"' % hashlib.sha1(repr(
+      (handler.request.path, handler.request.query_string, update_times))
+  ).hexdigest()
+  handler.response.headers['ETag'] = etag
+  handler.response.headers['Last-Modified'] = email.utils.formatdate(
+      last_modified, usegmt=True)
+
+  if_none_match = handler.request.headers.get('If-None-Match')
+  if_modified_since = handler.request.headers.get('If-Modified-Since')
+  not_modified = False
+  if if_none_match is not None:
+    # If-None-Match takes precedence over If-Modified-Since
+    not_modified = _ETagMatches(if_none_match, etag)
+  elif if_modified_since is not None:
+    parsed_time = email.utils.parsedate_tz(if_modified_since)
+    if parsed_time is not None:
+      not_modified = email.utils.mktime_tz(parsed_time) >= last_modified
+
+  if not_modified:
+    handler.response.set_status(304)
+  return not_modified
+
+
 def LookupProductCategory(category_id):
   """Lookup a ProductCategory entity by id.
 
@@ -169,26 +428,11 @@ class BasePageHandler(webapp.RequestHandler):
 
   def ManufacturerPidCount(self):
     """Return the number of manufacturer PIDs."""
-    manufacturer_pids = memcache.get(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
-    if manufacturer_pids is None:
-      manufacturer_pids = 0
-
-      for pid in Pid.all():
-        if pid.manufacturer.esta_id != self.ESTA_ID:
-          manufacturer_pids += 1
-      if not memcache.add(memcache_keys.MANUFACTURER_PID_COUNT_KEY,
-                          manufacturer_pids):
-        logging.error("Memcache set failed.")
-    return manufacturer_pids
+    return counters.GetCount(counters.MANUFACTURER_PIDS)
 
   def ProductCount(self):
     """Return the number of product."""
-    product_count = memcache.get(memcache_keys.PRODUCT_COUNT_KEY)
-    if product_count is None:
-      product_count = Responder.all().count() + Product.all().count()
-      if not memcache.add(memcache_keys.PRODUCT_COUNT_KEY, product_count):
-        logging.error("Memcache set failed.")
-    return product_count
+    return counters.GetCount(counters.PRODUCTS)
 
   def IndexInfo(self):
     """Get the information about the index.
@@ -199,7 +443,7 @@ class BasePageHandler(webapp.RequestHandler):
        'model_count': ,
       }
     """
-    output = memcache.get(memcache_keys.INDEX_INFO)
+    output = versioned_cache.Get(memcache_keys.INDEX_INFO)
     if not output:
       output = {'last_updated': None}
       results = LastUpdateTime.all()
@@ -210,5 +454,5 @@ class BasePageHandler(webapp.RequestHandler):
             *update_timestamp[0].update_time.timetuple()[0:6])
       output['manufacturer_pid_count'] = self.ManufacturerPidCount()
       output['product_count'] = self.ProductCount()
-      memcache.set(memcache_keys.INDEX_INFO, output)
+      versioned_cache.Set(memcache_keys.INDEX_INFO, output)
     return output
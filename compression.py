@@ -0,0 +1,156 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# compression.py
+# Copyright (C) 2026 Simon Newton
+# WSGI middleware to compress responses.
+
+from __future__ import with_statement
+import gzip
+import zlib
+from StringIO import StringIO
+
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+
+# In order of preference
+SUPPORTED_ENCODINGS = [GZIP, DEFLATE]
+
+COMPRESSIBLE_TYPES = [
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'text/',
+]
+
+
+def ChooseEncoding(accept_encoding):
+  """Pick the content coding to use from an Accept-Encoding header.
+
+  Returns:
+    One of SUPPORTED_ENCODINGS, or None if the response shouldn't be
+    compressed.
+  """
+  if not accept_encoding:
+    return None
+
+  qualities = {}
+  for item in accept_encoding.split(','):
+    params = item.strip().split(';')
+    coding = params[0].strip().lower()
+    quality = 1.0
+    for param in params[1:]:
+      name, _, value = param.strip().partition('=')
+      if name.strip() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    qualities[coding] = quality
+
+  best = None
+  best_quality = 0.0
+  for coding in SUPPORTED_ENCODINGS:
+    quality = qualities.get(coding, qualities.get('*', 0.0))
+    if quality > best_quality:
+      best = coding
+      best_quality = quality
+  return best
+
+
+def Compress(data, encoding):
+  """Compress data with either GZIP or DEFLATE."""
+  if encoding == GZIP:
+    output = StringIO()
+    with gzip.GzipFile(fileobj=output, mode='wb', mtime=0) as f:
+      f.write(data)
+    return output.getvalue()
+  return zlib.compress(data)
+
+
+class GzipMiddleware(object):
+  """Compress the responses from a WSGI application.
+
+  Responses are compressed if they're a 200 with a text content type, the
+  client accepts gzip or deflate, and they're at least MIN_SIZE bytes.
+  Responses which already have a Content-Encoding, like the pre-compressed
+  snapshots, are passed through untouched.
+  """
+  # Below this the compression overhead isn't worth it
+  MIN_SIZE = 1024
+
+  def __init__(self, application, min_size=MIN_SIZE):
+    self._application = application
+    self._min_size = min_size
+
+  def _IsCompressible(self, headers):
+    content_type = ''
+    for name, value in headers:
+      if name.lower() == 'content-type':
+        content_type = value.lower()
+    return any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+  def _AddVary(self, headers):
+    vary = ['Accept-Encoding']
+    output = []
+    for name, value in headers:
+      if name.lower() == 'vary':
+        vary.extend(v.strip() for v in value.split(',')
+                    if v.strip().lower() != 'accept-encoding')
+      else:
+        output.append((name, value))
+    output.append(('Vary', ', '.join(vary)))
+    return output
+
+  def __call__(self, environ, start_response):
+    encoding = ChooseEncoding(environ.get('HTTP_ACCEPT_ENCODING'))
+    response = {}
+    body = []
+
+    def CaptureStartResponse(status, headers, exc_info=None):
+      if exc_info is not None and response:
+        raise exc_info[0], exc_info[1], exc_info[2]
+      response['status'] = status
+      response['headers'] = headers
+      return body.append
+
+    result = self._application(environ, CaptureStartResponse)
+    try:
+      body.extend(result)
+    finally:
+      if hasattr(result, 'close'):
+        result.close()
+
+    status = response['status']
+    headers = response['headers']
+    if not self._IsCompressible(headers):
+      start_response(status, headers)
+      return body
+
+    headers = self._AddVary(headers)
+    data = ''.join(body)
+    already_encoded = any(name.lower() == 'content-encoding'
+                          for name, value in headers)
+    if (encoding is None or already_encoded or
+        not status.startswith('200') or len(data) < self._min_size):
+      start_response(status, headers)
+      return [data]
+
+    data = Compress(data, encoding)
+    headers = [(name, value) for name, value in headers
+               if name.lower() != 'content-length']
+    headers.append(('Content-Encoding', encoding))
+    headers.append(('Content-Length', str(len(data))))
+    start_response(status, headers)
+    return [data]
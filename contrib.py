@@ -17,6 +17,7 @@
 # The handlers for the contrib page.
 
 import common
+import compression
 import logging
 import datetime
 from google.appengine.api import users
@@ -92,6 +93,7 @@ class AddInfoResponderHandler(BaseContribPageHandler):
 
   def BuildResponderList(self, responders):
     output = []
+    common.PrefetchReferences(responders, Responder.manufacturer)
     for responder in responders:
       if responder.link and responder.image_url:
         continue
@@ -137,9 +139,9 @@ class AddInfoResponderHandler(BaseContribPageHandler):
     common.MaybeSendEmail(added)
 
 
-app = webapp.WSGIApplication(
+app = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/contrib', ContribPageHandler),
     ('/contrib/add_responder_info', AddInfoResponderHandler),
   ],
-  debug=True)
+  debug=True))
@@ -0,0 +1,217 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# counters.py
+# Copyright (C) 2026 Simon Newton
+# Sharded counters for the entity counts shown on the site.
+
+import collections
+import random
+from google.appengine.ext import db
+from model import CounterShard, CounterShardKeyName
+
+NUM_SHARDS = 10
+# The maximum number of entities in a single put or delete
+MAX_BATCH = 500
+# The maximum number of entity groups in a cross-group transaction
+MAX_XG_GROUPS = 25
+
+# The groups of per-entity counters
+RESPONDERS_BY_MANUFACTURER = 'responders_by_manufacturer'
+RESPONDERS_BY_CATEGORY = 'responders_by_category'
+PIDS_BY_MANUFACTURER = 'pids_by_manufacturer'
+
+
+class Counter(object):
+  """Identifies a counter.
+
+  Args:
+    name: the name of the counter.
+    group: the group this counter belongs to, or None.
+    member: the id of this counter within the group.
+  """
+  def __init__(self, name, group=None, member=None):
+    self.name = name
+    self.group = group
+    self.member = member
+
+  def ShardKeys(self):
+    """Return the datastore keys of all the shards for this counter."""
+    return [db.Key.from_path(CounterShard.kind(),
+                             CounterShardKeyName(self.name, i))
+            for i in xrange(NUM_SHARDS)]
+
+
+def _GroupCounter(group, member):
+  return Counter('%s:%d' % (group, member), group, member)
+
+
+# Number of products, including responders
+PRODUCTS = Counter('products')
+
+# Number of PIDs which don't belong to ESTA
+MANUFACTURER_PIDS = Counter('manufacturer_pids')
+
+# Number of responders
+RESPONDERS = Counter('responders')
+
+
+def ProductTypeCount(product_type):
+  """The number of products of a type, e.g. Controller."""
+  return Counter('products:%s' % product_type.class_name())
+
+
+def TagProducts(tag_key):
+  """The number of products with a ProductTag."""
+  return Counter('tag_products:%s' % tag_key)
+
+
+def ManufacturerResponders(esta_id):
+  """The number of responders for a manufacturer."""
+  return _GroupCounter(RESPONDERS_BY_MANUFACTURER, esta_id)
+
+
+def CategoryResponders(category_id):
+  """The number of responders in a product category."""
+  return _GroupCounter(RESPONDERS_BY_CATEGORY, category_id)
+
+
+def ManufacturerPids(esta_id):
+  """The number of PIDs for a manufacturer."""
+  return _GroupCounter(PIDS_BY_MANUFACTURER, esta_id)
+
+
+def _ApplyDeltas(deltas):
+  """Add each delta to a random shard of the counter.
+
+  This must be run within a transaction.
+  """
+  shards = []
+  for counter, delta in deltas:
+    key_name = CounterShardKeyName(counter.name,
+                                   random.randint(0, NUM_SHARDS - 1))
+    shard = CounterShard.get_by_key_name(key_name)
+    if shard is None:
+      shard = CounterShard(key_name=key_name,
+                           name=counter.name,
+                           group=counter.group,
+                           member=counter.member)
+    shard.count += delta
+    shards.append(shard)
+  db.put(shards)
+
+
+def RunInTransaction(function, deltas):
+  """Run a function and update the counters in a single transaction.
+
+  Each counter shard is its own entity group, so this uses a cross-group
+  transaction, which limits us to a handful of counters per call.
+
+  Args:
+    function: the function to run, this should put or delete the entity the
+      counters are tracking.
+    deltas: a list of (Counter, delta) tuples.
+
+  Returns:
+    The return value of function.
+  """
+  def Txn():
+    result = function()
+    _ApplyDeltas(deltas)
+    return result
+
+  options = db.create_transaction_options(xg=True)
+  return db.run_in_transaction_options(options, Txn)
+
+
+def Increment(counter, delta=1):
+  """Add delta to a counter."""
+  RunInTransaction(lambda: None, [(counter, delta)])
+
+
+def IncrementAll(deltas):
+  """Apply a list of deltas, merging the ones for the same counter.
+
+  This is used when the entities have been written in a batch, rather than
+  with RunInTransaction.
+
+  Args:
+    deltas: a list of (Counter, delta) tuples.
+  """
+  merged = collections.OrderedDict()
+  for counter, delta in deltas:
+    if counter.name in merged:
+      merged[counter.name] = (counter, merged[counter.name][1] + delta)
+    else:
+      merged[counter.name] = (counter, delta)
+  merged = [(counter, delta) for counter, delta in merged.itervalues()
+            if delta]
+  for i in xrange(0, len(merged), MAX_XG_GROUPS):
+    RunInTransaction(lambda: None, merged[i:i + MAX_XG_GROUPS])
+
+
+def GetCount(counter):
+  """Return the value of a counter."""
+  return sum(shard.count for shard in db.get(counter.ShardKeys())
+             if shard is not None)
+
+
+def GetGroupCounts(group):
+  """Return the values of all the counters in a group.
+
+  Returns:
+    A dict of member: count, counters which are 0 are omitted.
+  """
+  counts = collections.defaultdict(int)
+  query = CounterShard.all()
+  query.filter('group = ', group)
+  for shard in query:
+    counts[shard.member] += shard.count
+  return dict((member, count) for member, count in counts.iteritems() if count)
+
+
+def _InBatches(function, items):
+  for i in xrange(0, len(items), MAX_BATCH):
+    function(items[i:i + MAX_BATCH])
+
+
+def Reset(counter):
+  """Set a counter back to 0."""
+  db.delete(counter.ShardKeys())
+
+
+def ResetGroup(group):
+  """Set all the counters in a group back to 0."""
+  query = CounterShard.all(keys_only=True)
+  query.filter('group = ', group)
+  _InBatches(db.delete, list(query))
+
+
+def ReplaceAll(values):
+  """Replace every counter with a new value.
+
+  This is used to rebuild the counters from the datastore.
+
+  Args:
+    values: a list of (Counter, value) tuples.
+  """
+  _InBatches(db.delete, list(CounterShard.all(keys_only=True)))
+  shards = []
+  for counter, value in values:
+    shards.append(CounterShard(key_name=CounterShardKeyName(counter.name, 0),
+                               name=counter.name,
+                               group=counter.group,
+                               member=counter.member,
+                               count=value))
+  _InBatches(db.put, shards)
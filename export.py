@@ -16,16 +16,22 @@
 # Copyright (C) 2011 Simon Newton
 # The handlers for exporting information to third parties.
 
-from model import Controller, LastUpdateTime, Manufacturer, Pid, Responder
+from model import Controller, LastUpdateTime, LastUpdateTimeKeyName, Pid, Responder, ResponderPersonality, SoftwareVersion
 from utils import TimestampToInt
+import command_messages
 import common
+import compression
+import functools
 import json
+import manufacturer_directory
+import snapshots
+import streaming
 import timestamp_keys
 from google.appengine.ext import webapp
 
 
-class PidDefinitionsAsProto(webapp.RequestHandler):
-  """Dump the PID definitions in protobuf format."""
+class PidDefinitionsWriter(object):
+  """Writes the PID definitions in protobuf format."""
   ESTA_ID = 0
 
   SUB_DEVICE_RANGE_TO_ENUM = {
@@ -40,8 +46,11 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
     False: 'false',
   }
 
+  def __init__(self, out):
+    self._out = out
+
   def Write(self, line, indent=0):
-    self.response.out.write('%s%s\n' % (' ' * indent, line))
+    self._out.write('%s%s\n' % (' ' * indent, line))
 
   def WriteItem(self, item, indent=0):
     self.Write('field {', indent)
@@ -72,8 +81,7 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
 
     self.Write('}', indent)
 
-  def WriteMessage(self, type, message_str, indent=0):
-    message = eval(message_str)
+  def WriteMessage(self, type, message, indent=0):
     self.Write('%s {' % type, indent)
     for item in message['items']:
       self.WriteItem(item, indent + 2)
@@ -85,25 +93,31 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
     self.Write('  value: %d' % pid.pid_id, indent)
 
     if pid.get_command:
-      self.WriteMessage('get_request', pid.get_command.request, indent + 2)
-      self.WriteMessage('get_response', pid.get_command.response, indent + 2)
+      self.WriteMessage('get_request',
+                        command_messages.Request(pid.get_command), indent + 2)
+      self.WriteMessage('get_response',
+                        command_messages.Response(pid.get_command), indent + 2)
       self.Write('  get_sub_device_range: %s' %
                  self.SUB_DEVICE_RANGE_TO_ENUM[pid.get_command.sub_device_range],
                  indent)
 
     if pid.discovery_command:
       self.WriteMessage('discovery_request',
-                        pid.discovery_command.request, indent + 2)
+                        command_messages.Request(pid.discovery_command),
+                        indent + 2)
       self.WriteMessage('discovery_response',
-                        pid.discovery_command.response, indent + 2)
+                        command_messages.Response(pid.discovery_command),
+                        indent + 2)
       self.Write(
           '  discovery_sub_device_range: %s' %
           self.SUB_DEVICE_RANGE_TO_ENUM[pid.discovery_command.sub_device_range],
           indent)
 
     if pid.set_command:
-      self.WriteMessage('set_request', pid.set_command.request, indent + 2)
-      self.WriteMessage('set_response', pid.set_command.response, indent + 2)
+      self.WriteMessage('set_request',
+                        command_messages.Request(pid.set_command), indent + 2)
+      self.WriteMessage('set_response',
+                        command_messages.Response(pid.set_command), indent + 2)
       self.Write('  set_sub_device_range: %s' %
                  self.SUB_DEVICE_RANGE_TO_ENUM[pid.set_command.sub_device_range],
                  indent)
@@ -119,17 +133,16 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
 
     self.Write('}')
 
-  def get(self):
-    esta_manufacturer = common.GetManufacturer(self.ESTA_ID)
-    self.response.headers['Content-Type'] = 'text/plain'
+  def WriteDefinitions(self, pid_selection):
+    """Write the PIDs.
 
-    # Can be '', 'esta', 'esta-draft', 'manufacturers' or 'manufacturer-names'
-    pid_selection = self.request.get('pids')
+    Args:
+      pid_selection: one of '', 'esta', 'esta-draft', 'manufacturers' or
+        'manufacturer-names'
+    """
+    esta_manufacturer = common.GetManufacturer(self.ESTA_ID)
     if pid_selection == 'manufacturer-names':
-      manufacturers = []
-      query = Manufacturer.all()
-      query.order('name')
-      for manufacturer in query:
+      for manufacturer in manufacturer_directory.AllManufacturers():
         if manufacturer.esta_id in [self.ESTA_ID, 0xffff]:
           continue
 
@@ -149,11 +162,12 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
       manufacturers = {}
       esta_pids = []
       for pid in pids:
-        if pid.manufacturer.esta_id == self.ESTA_ID:
+        manufacturer = manufacturer_directory.GetEntityManufacturer(pid)
+        if manufacturer.esta_id == self.ESTA_ID:
           esta_pids.append(pid)
         else:
           # Build the hash of manufacturer pids by manufacturer
-          manufacturers.setdefault(pid.manufacturer.esta_id, []).append(pid)
+          manufacturers.setdefault(manufacturer.esta_id, []).append(pid)
 
       esta_pids.sort(key=lambda p: p.pid_id)
       for pid in esta_pids:
@@ -162,32 +176,93 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
       for manufacturer_id in sorted(manufacturers):
         manufacturer_pids = manufacturers[manufacturer_id]
         manufacturer_pids.sort(key=lambda p: p.pid_id)
-        self.WriteManufacturer(manufacturers[manufacturer_id][0].manufacturer,
-                               manufacturer_pids)
+        self.WriteManufacturer(
+            common.GetManufacturer(manufacturer_id), manufacturer_pids)
 
-    query = LastUpdateTime.all()
     if pid_selection == 'manufacturer-names':
-      query.filter('name = ', timestamp_keys.MANUFACTURERS)
+      timestamp_name = timestamp_keys.MANUFACTURERS
     else:
-      query.filter('name = ', timestamp_keys.PIDS)
-    update_time = query.fetch(1)
+      timestamp_name = timestamp_keys.PIDS
+    update_time = LastUpdateTime.get_by_key_name(
+        LastUpdateTimeKeyName(timestamp_name))
     if update_time:
-      timestamp = TimestampToInt(update_time[0].update_time)
+      timestamp = TimestampToInt(update_time.update_time)
       self.Write('version: %d' % timestamp)
 
 
-class ExportModelsHandler(webapp.RequestHandler):
-  """Return all device models for the RDM Protocol Site.
+class SnapshotHandler(webapp.RequestHandler):
+  """The base class for exports which can be served from a snapshot.
 
-  This is used by the rdmprotocol.org site. Don't change the format without
-  checking in with Peter Kirkup.
+  If there is an up to date snapshot we serve that, otherwise we render the
+  export from the datastore and schedule a build of the snapshot.
   """
+  def SnapshotName(self):
+    """Return the snapshot for this request, or None to always render live."""
+    return None
+
+  def Timestamps(self):
+    """Return the timestamp_keys sections this export is built from."""
+    return snapshots.SNAPSHOTS[self.SnapshotName()]
+
+  def Render(self, out):
+    """Write the export to out, subclasses override this."""
+    pass
+
   def get(self):
+    if common.CheckNotModified(self, self.Timestamps()):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
-    results = Responder.all()
+    name = self.SnapshotName()
+    if name is None:
+      self.Render(self.response.out)
+      return
+
+    data = snapshots.GetCurrentData(name)
+    if data is None:
+      data = snapshots.Render(name, self.Render)
+      snapshots.ScheduleBuild(name)
+
+    encoding = compression.ChooseEncoding(
+        self.request.headers.get('Accept-Encoding'))
+    if encoding == compression.GZIP:
+      # the data is already compressed, so GzipMiddleware leaves it
+      self.response.headers['Content-Encoding'] = compression.GZIP
+      self.response.out.write(data)
+    else:
+      self.response.out.write(snapshots.Decompress(data))
 
-    models = []
-    for model in results:
+
+class PidDefinitionsAsProto(SnapshotHandler):
+  """Dump the PID definitions in protobuf format."""
+  def PidSelection(self):
+    # Can be '', 'esta', 'esta-draft', 'manufacturers' or 'manufacturer-names'
+    return self.request.get('pids')
+
+  def SnapshotName(self):
+    return snapshots.PID_SELECTIONS.get(self.PidSelection())
+
+  def Timestamps(self):
+    if self.PidSelection() == 'manufacturer-names':
+      return [timestamp_keys.MANUFACTURERS]
+    return [timestamp_keys.PIDS, timestamp_keys.MANUFACTURERS]
+
+  def Render(self, out):
+    RenderPidDefinitions(out, self.PidSelection())
+
+
+def RenderPidDefinitions(out, pid_selection=''):
+  PidDefinitionsWriter(out).WriteDefinitions(pid_selection)
+
+
+def RenderModels(out):
+  """Write all device models for the RDM Protocol Site.
+
+  This is used by the rdmprotocol.org site. Don't change the format without
+  checking in with Peter Kirkup.
+  """
+  writer = streaming.JsonListWriter(out, 'models')
+  for batch in common.QueryInBatches(Responder.all()):
+    for model in common.PrefetchReferences(batch, Responder.manufacturer):
       model_output = {
         'manufacturer_name': model.manufacturer.name,
         'manufacturer_id': model.manufacturer.esta_id,
@@ -198,28 +273,32 @@ class ExportModelsHandler(webapp.RequestHandler):
         model_output['link'] = model.link
       if model.image_url:
         model_output['image_url'] = model.image_url
-      tags = list(model.tag_set)
-      if tags:
-        tags = []
-        for tag in model.tag_set:
-          tags.append(tag.tag.label)
-        model_output['tags'] = tags
+      if model.tags:
+        model_output['tags'] = model.tags
+
+      writer.Write(model_output)
+  writer.Close()
+
 
-      models.append(model_output)
-    self.response.out.write(json.dumps({'models': models}))
+class ExportModelsHandler(SnapshotHandler):
+  """Return all device models for the RDM Protocol Site."""
+  def SnapshotName(self):
+    return snapshots.EXPORT_MODELS
 
+  def Render(self, out):
+    RenderModels(out)
 
-class ExportControllersHandler(webapp.RequestHandler):
-  """Return all controllers for the RDM Protocol Site.
+
+def RenderControllers(out):
+  """Write all controllers for the RDM Protocol Site.
 
   This is used by the rdmprotocol.org site. Don't change the format without
   checking in with Peter Kirkup.
   """
-  def get(self):
-    self.response.headers['Content-Type'] = 'text/plain'
-
-    controllers = []
-    for controller in Controller.all():
+  writer = streaming.JsonListWriter(out, 'controllers')
+  for batch in common.QueryInBatches(Controller.all()):
+    for controller in common.PrefetchReferences(batch,
+                                                Controller.manufacturer):
       controller_output = {
         'manufacturer_name': controller.manufacturer.name,
         'key': str(controller.key()),
@@ -229,45 +308,53 @@ class ExportControllersHandler(webapp.RequestHandler):
         controller_output['link'] = controller.link
       if controller.image_url:
         controller_output['image_url'] = controller.image_url
-      tags = list(controller.tag_set)
-      if tags:
-        tags = []
-        for tag in controller.tag_set:
-          tags.append(tag.tag.label)
-        controller_output['tags'] = tags
+      if controller.tags:
+        controller_output['tags'] = controller.tags
+
+      writer.Write(controller_output)
+  writer.Close()
+
 
-      controllers.append(controller_output)
-    self.response.out.write(json.dumps({'controllers': controllers}))
+class ExportControllersHandler(SnapshotHandler):
+  """Return all controllers for the RDM Protocol Site."""
+  def SnapshotName(self):
+    return snapshots.EXPORT_CONTROLLERS
+
+  def Render(self, out):
+    RenderControllers(out)
 
 
 class MissingModelsHandler(webapp.RequestHandler):
   """Return all device models that are missing info / image urls in csv."""
   def get(self):
+    if common.CheckNotModified(
+        self, [timestamp_keys.DEVICES, timestamp_keys.MANUFACTURERS]):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
-    results = Responder.all()
-    results.order('device_model_id')
-
-    self.response.out.write(
-        'Manufacturer ID,Manufacturer Name,Device ID,Model Name,Info Url,'
-        'Image Url\n')
-    for model in results:
-      if model.link and model.image_url:
-        continue
-      fields = []
-      fields.append('0x%hx' % model.manufacturer.esta_id)
-      fields.append(model.manufacturer.name)
-      fields.append('0x%hx' % model.device_model_id)
-      fields.append(model.model_description)
-      if model.link:
-        fields.append(model.link)
-      else:
-        fields.append('')
-      if model.image_url:
-        fields.append(model.image_url)
-      else:
-        fields.append('')
-      self.response.out.write(','.join(fields))
-      self.response.out.write('\n')
+    query = Responder.all()
+    query.order('device_model_id')
+
+    writer = streaming.CsvWriter(self.response.out)
+    writer.Write(['Manufacturer ID', 'Manufacturer Name', 'Device ID',
+                  'Model Name', 'Info Url', 'Image Url'])
+    for batch in common.QueryInBatches(query):
+      for model in common.PrefetchReferences(batch, Responder.manufacturer):
+        if model.link and model.image_url:
+          continue
+        fields = []
+        fields.append('0x%hx' % model.manufacturer.esta_id)
+        fields.append(model.manufacturer.name)
+        fields.append('0x%hx' % model.device_model_id)
+        fields.append(model.model_description)
+        if model.link:
+          fields.append(model.link)
+        else:
+          fields.append('')
+        if model.image_url:
+          fields.append(model.image_url)
+        else:
+          fields.append('')
+        writer.Write(fields)
 
 
 class InfoHandler(webapp.RequestHandler):
@@ -281,6 +368,8 @@ class InfoHandler(webapp.RequestHandler):
   ESTA_ID = 0
 
   def get(self):
+    if common.CheckNotModified(self, timestamp_keys.ALL):
+      return
     self.response.headers['Content-Type'] = 'text/plain'
 
     output = {}
@@ -302,14 +391,23 @@ class InfoHandler(webapp.RequestHandler):
     self.response.out.write(json.dumps(output))
 
 
-class ModelInfoHandler(webapp.RequestHandler):
-  """Return responder model info."""
-  def get(self):
-    self.response.headers['Content-Type'] = 'text/plain'
-    results = Responder.all()
-
-    models = []
-    for model in results:
+def RenderModelInfo(out):
+  """Write the responder model info."""
+  # load the versions and personalities with two queries up front, rather than
+  # two queries per responder. Only the output fields are kept, as tuples, so
+  # the memory used is much less than holding the entities.
+  personalities = common.GroupByReference(
+      ResponderPersonality.all(), ResponderPersonality.sw_version,
+      lambda personality: (personality.description, personality.index,
+                           personality.slot_count))
+  versions = common.GroupByReference(
+      SoftwareVersion.all(), SoftwareVersion.responder,
+      lambda software: (software.version_id, software.label,
+                        personalities.pop(software.key(), [])))
+
+  writer = streaming.JsonListWriter(out, 'models')
+  for batch in common.QueryInBatches(Responder.all()):
+    for model in common.PrefetchReferences(batch, Responder.manufacturer):
       model_output = {
         'manufacturer_name': model.manufacturer.name,
         'manufacturer_id': model.manufacturer.esta_id,
@@ -317,26 +415,46 @@ class ModelInfoHandler(webapp.RequestHandler):
         'model_description': model.model_description,
         'software_versions': [],
       }
-      models.append(model_output)
-      for software in model.software_version_set:
+      for version_id, label, version_personalities in versions.pop(
+          model.key(), []):
         software_output = {
-          'id': software.version_id,
-          'label': software.label,
+          'id': version_id,
+          'label': label,
           'personalities': [],
         }
-        for personality in software.personality_set:
+        for description, index, slot_count in version_personalities:
           personality_output = {
-            'description': personality.description,
-            'index': personality.index,
-            'slot_count': personality.slot_count,
+            'description': description,
+            'index': index,
+            'slot_count': slot_count,
           }
           software_output['personalities'].append(personality_output)
         model_output['software_versions'].append(software_output)
+      writer.Write(model_output)
+  writer.Close()
+
+
+class ModelInfoHandler(SnapshotHandler):
+  """Return responder model info."""
+  def SnapshotName(self):
+    return snapshots.MODEL_INFO
+
+  def Render(self, out):
+    RenderModelInfo(out)
+
 
-    self.response.out.write(json.dumps({'models': models}))
+# The render functions for each snapshot
+SNAPSHOT_RENDERERS = {
+  snapshots.EXPORT_CONTROLLERS: RenderControllers,
+  snapshots.EXPORT_MODELS: RenderModels,
+  snapshots.MODEL_INFO: RenderModelInfo,
+}
+for pid_selection, snapshot_name in snapshots.PID_SELECTIONS.iteritems():
+  SNAPSHOT_RENDERERS[snapshot_name] = functools.partial(
+      RenderPidDefinitions, pid_selection=pid_selection)
 
 
-export_application = webapp.WSGIApplication(
+export_application = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/index_info', InfoHandler),
     ('/download', PidDefinitionsAsProto),
@@ -345,4 +463,4 @@ export_application = webapp.WSGIApplication(
     ('/missing_models', MissingModelsHandler),
     ('/model_info', ModelInfoHandler),
   ],
-  debug=True)
+  debug=True))
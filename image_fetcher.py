@@ -15,61 +15,177 @@
 # image_fetcher.py
 # Copyright (C) 2011 Simon Newton
 # Handles fetching images from remote sites.
+#
+# FetchImages() fetches the images for a batch of responders & products with
+# an image_pipeline.ImagePipeline. The fetches run in parallel, with a limit on
+# the number in flight to each host, and transient failures are retried with
+# exponential backoff. Failures are recorded on the entity, so a dead URL
+# isn't fetched every time.
 
 from __future__ import with_statement
+import datetime
+import json
 import logging
+import ranking
 from google.appengine.api import files
 from google.appengine.api import images
-from google.appengine.api import urlfetch
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from image_pipeline import ImagePipeline
+from model import Responder
+
+# The queue, defined in queue.yaml
+QUEUE_NAME = 'image-fetch'
+FETCH_IMAGES_URL = '/tasks/fetch_images'
+# The number of images fetched by each task
+IMAGES_PER_TASK = 20
+
+# Between tasks, the delay after the first failure, which doubles with each
+# failure after that
+RETRY_DELAY = datetime.timedelta(hours=1)
+MAX_RETRY_DELAY = datetime.timedelta(days=30)
+# After this many failures the url is considered dead, until it changes
+MAX_FETCH_FAILURES = 5
+
+# width to resize images to
+RESIZE_WIDTH = 200
 
 
-class ImageFetcher(object):
-  """Return the image for a model.
+def SaveImage(content):
+  """Resize an image and store it in the blobstore.
 
-  TODO(simon): this is fine for now but we should switch to using task queues
-  or map reduce so the fetches aren't in the serving path.
+  Returns:
+    The new blob key, or None if the content couldn't be transformed.
   """
-  # width to resize images to
-  RESIZE_WIDTH = 200
-
-  def __init__(self):
-    pass
-
-  def FetchAndSaveImage(self, url):
-    """
-    Args:
-      url: The url to fetch.
-
-    Returns:
-      The new blob key, or None if the fetch failed.
-    """
-    logging.info('fetching %s' % url)
-    try:
-      image_response = urlfetch.fetch(url)
-    except urlfetch.Error:
-      return None
-
-    if image_response.status_code != 200:
-      logging.info('image fetch failed. %s -> %d' %
-                   (url, image_response.status_code))
-      return None
-
-    img = images.Image(image_response.content)
+  try:
+    img = images.Image(content)
     # shrink things if needed
-    if img.width > self.RESIZE_WIDTH:
-      img.resize(width=self.RESIZE_WIDTH)
+    if img.width > RESIZE_WIDTH:
+      img.resize(width=RESIZE_WIDTH)
     # we need at least one transform, so use I'm feeling lucky :)
     img.im_feeling_lucky()
-    try:
-      thumbnail = img.execute_transforms(output_encoding=images.PNG)
-    except SystemError, e:
-      # this fires on the dev server if it can't load the PIL module
-      logging.info(e)
-      return None
-
-    file_name = files.blobstore.create(mime_type='image/png')
-    with files.open(file_name, 'a') as f:
-      f.write(thumbnail)
-    files.finalize(file_name)
-
-    return files.blobstore.get_blob_key(file_name)
+    thumbnail = img.execute_transforms(output_encoding=images.PNG)
+  except images.Error, e:
+    logging.info(e)
+    return None
+  except SystemError, e:
+    # this fires on the dev server if it can't load the PIL module
+    logging.info(e)
+    return None
+
+  file_name = files.blobstore.create(mime_type='image/png')
+  with files.open(file_name, 'a') as f:
+    f.write(thumbnail)
+  files.finalize(file_name)
+
+  return files.blobstore.get_blob_key(file_name)
+
+
+def NeedsFetch(entity, now=None):
+  """Check if the image for a Responder or Product should be fetched."""
+  if not entity.image_url or entity.image_data:
+    return False
+  if (entity.image_fetch_failures or 0) >= MAX_FETCH_FAILURES:
+    return False
+  now = now or datetime.datetime.now()
+  return entity.image_retry_time is None or entity.image_retry_time <= now
+
+
+def ResetFetchState(entity):
+  """Clear the fetch failures, this is called when the image url changes."""
+  entity.image_fetch_failures = 0
+  entity.image_fetch_error = None
+  entity.image_retry_time = None
+
+
+def _RecordFailure(entity, error, permanent, now):
+  if permanent:
+    entity.image_fetch_failures = MAX_FETCH_FAILURES
+  else:
+    entity.image_fetch_failures = (entity.image_fetch_failures or 0) + 1
+  entity.image_fetch_error = error
+  delay = min(RETRY_DELAY * (2 ** (entity.image_fetch_failures - 1)),
+              MAX_RETRY_DELAY)
+  entity.image_retry_time = now + delay
+
+
+def _ApplyResult(key, url, blob_key, serving_url, error, permanent, now):
+  """Store the outcome of a fetch on an entity, this is run in a transaction.
+
+  The entity is re-read, so the write doesn't undo changes made while the
+  image was being fetched. Only the image & fetch state fields are modified.
+
+  Returns:
+    True if the image was saved, False otherwise.
+  """
+  entity = db.get(key)
+  if entity is None or entity.image_url != url or entity.image_data:
+    # the url changed, or another task already saved the image
+    return False
+
+  if blob_key is None:
+    _RecordFailure(entity, error, permanent, now)
+  else:
+    entity.image_data = blob_key
+    entity.image_serving_url = serving_url
+    ResetFetchState(entity)
+    if isinstance(entity, Responder):
+      ranking.Rescore(entity)
+  entity.put()
+  return blob_key is not None
+
+
+def FetchImages(keys, pipeline=None):
+  """Fetch the images for a list of responders and products.
+
+  Entities which already have an image, or are waiting to be retried, are
+  skipped.
+
+  Args:
+    keys: a list of Responder or Product keys.
+    pipeline: the ImagePipeline to use.
+
+  Returns:
+    The number of images saved.
+  """
+  now = datetime.datetime.now()
+  entities = [entity for entity in db.get(keys)
+              if entity is not None and NeedsFetch(entity, now)]
+  if not entities:
+    return 0
+
+  pipeline = pipeline or ImagePipeline()
+  results = pipeline.FetchAll(sorted(set(e.image_url for e in entities)))
+
+  # url -> (blob key, serving url), in case entities share an image
+  saved_images = {}
+  saved = 0
+  for entity in entities:
+    url = entity.image_url
+    result = results[url]
+    blob_key, serving_url = None, None
+    error, permanent = result.error, result.permanent
+    if result.content is not None:
+      if url not in saved_images:
+        blob_key = SaveImage(result.content)
+        if blob_key is not None:
+          serving_url = images.get_serving_url(blob_key)
+        saved_images[url] = (blob_key, serving_url)
+      blob_key, serving_url = saved_images[url]
+      if blob_key is None:
+        error, permanent = 'Invalid image', True
+
+    if db.run_in_transaction(_ApplyResult, entity.key(), url, blob_key,
+                             serving_url, error, permanent, now):
+      saved += 1
+  logging.info('Saved %d of %d images' % (saved, len(entities)))
+  return saved
+
+
+def ScheduleFetches(keys):
+  """Queue tasks to fetch the images for a list of entity keys."""
+  keys = [str(key) for key in keys]
+  for i in xrange(0, len(keys), IMAGES_PER_TASK):
+    task = taskqueue.Task(url=FETCH_IMAGES_URL,
+                          payload=json.dumps(keys[i:i + IMAGES_PER_TASK]))
+    task.add(QUEUE_NAME)
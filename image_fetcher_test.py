@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# image_fetcher_test.py
+# Copyright (C) 2026 Simon Newton
+# Tests for FetchImages, these are skipped without the App Engine SDK.
+
+import datetime
+import unittest
+from image_pipeline import ImagePipeline
+from image_pipeline_test import FakeClock, FakeTransport
+
+try:
+  from google.appengine.ext import testbed
+  import image_fetcher
+  from model import Manufacturer, ManufacturerKeyName, Responder
+  from model import ResponderKeyName
+except ImportError:
+  testbed = None
+
+
+@unittest.skipIf(testbed is None, 'the App Engine SDK is not available')
+class TestFetchImages(unittest.TestCase):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.clock = FakeClock()
+
+    manufacturer = Manufacturer(key_name=ManufacturerKeyName(0x7a70),
+                                esta_id=0x7a70, name='Open Lighting')
+    manufacturer.put()
+    self.url = 'http://a.example.com/1.png'
+    self.responder = Responder(key_name=ResponderKeyName(0x7a70, 1),
+                               manufacturer=manufacturer,
+                               device_model_id=1,
+                               image_url=self.url)
+    self.responder.put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def Fetch(self, status_codes, max_attempts):
+    transport = FakeTransport({self.url: status_codes})
+    pipeline = ImagePipeline(
+        transport, max_attempts=max_attempts, clock=self.clock.Time,
+        sleep=self.clock.Sleep)
+    start = datetime.datetime.now()
+    image_fetcher.FetchImages([self.responder.key()], pipeline)
+    return start, Responder.get(self.responder.key())
+
+  def testTransientFailure(self):
+    start, responder = self.Fetch([503], 1)
+    self.assertEqual(1, responder.image_fetch_failures)
+    self.assertEqual('HTTP 503', responder.image_fetch_error)
+    self.assertTrue(responder.image_retry_time >=
+                    start + image_fetcher.RETRY_DELAY)
+    self.assertIsNone(responder.image_data)
+
+    # it's not fetched again until the retry time
+    self.assertFalse(image_fetcher.NeedsFetch(responder))
+    self.assertTrue(image_fetcher.NeedsFetch(
+        responder, responder.image_retry_time))
+
+  def testPermanentFailure(self):
+    start, responder = self.Fetch([404], 3)
+    self.assertEqual(image_fetcher.MAX_FETCH_FAILURES,
+                     responder.image_fetch_failures)
+    self.assertEqual('HTTP 404', responder.image_fetch_error)
+    self.assertTrue(responder.image_retry_time > start)
+
+    # the url is dead until it changes
+    self.assertFalse(image_fetcher.NeedsFetch(
+        responder, responder.image_retry_time))
+    image_fetcher.ResetFetchState(responder)
+    self.assertTrue(image_fetcher.NeedsFetch(responder))
+
+  def testUrlChangedDuringFetch(self):
+    new_url = 'http://b.example.com/2.png'
+
+    class ChangingTransport(FakeTransport):
+      def Start(transport, url):
+        # the responder is updated while the fetch is in flight
+        responder = Responder.get(self.responder.key())
+        responder.image_url = new_url
+        responder.put()
+        return FakeTransport.Start(transport, url)
+
+    transport = ChangingTransport({self.url: [404]})
+    pipeline = ImagePipeline(transport, clock=self.clock.Time,
+                             sleep=self.clock.Sleep)
+    self.assertEqual(
+        0, image_fetcher.FetchImages([self.responder.key()], pipeline))
+
+    responder = Responder.get(self.responder.key())
+    self.assertEqual(new_url, responder.image_url)
+    self.assertEqual(0, responder.image_fetch_failures or 0)
+    self.assertIsNone(responder.image_fetch_error)
+    self.assertTrue(image_fetcher.NeedsFetch(responder))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,171 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# image_pipeline.py
+# Copyright (C) 2026 Simon Newton
+# Fetch a set of urls in parallel, see image_fetcher.py.
+#
+# The HTTP requests go through a transport, UrlFetchTransport by default. The
+# ImagePipeline only calls Start(), WaitAny() and Result(), so it can be run
+# against a local HTTP server or a fake by passing in a different transport.
+# This module doesn't import the App Engine SDK, so it can be tested without
+# it.
+
+import collections
+import logging
+import random
+import time
+import urlparse
+
+# The maximum number of fetches in flight, in total and to a single host
+MAX_CONCURRENT = 10
+MAX_PER_HOST = 2
+# Seconds before a fetch times out
+FETCH_DEADLINE = 20
+# The number of times a url is tried, and the delay before the first retry,
+# which doubles each time
+MAX_ATTEMPTS = 3
+BACKOFF_SECONDS = 1
+# Retries which would run past this many seconds are given up on
+MAX_RUN_TIME = 300
+
+
+class FetchError(Exception):
+  """Raised by a transport if a request fails without a response."""
+
+
+class UrlFetchTransport(object):
+  """Makes the requests with asynchronous urlfetch calls."""
+  def Start(self, url):
+    """Start a request, and return a handle for it."""
+    from google.appengine.api import urlfetch
+    rpc = urlfetch.create_rpc(deadline=FETCH_DEADLINE)
+    urlfetch.make_fetch_call(rpc, url)
+    return rpc
+
+  def WaitAny(self, handles):
+    """Wait for one of the requests to complete, and return its handle."""
+    from google.appengine.api import apiproxy_stub_map
+    return apiproxy_stub_map.UserRPC.wait_any(handles)
+
+  def Result(self, handle):
+    """Return the (status_code, content) of a completed request."""
+    from google.appengine.api import urlfetch
+    try:
+      response = handle.get_result()
+    except urlfetch.Error, e:
+      raise FetchError(str(e) or e.__class__.__name__)
+    return response.status_code, response.content
+
+
+# The outcome of fetching a url. content is None if the fetch failed, in which
+# case permanent is True if retrying won't help.
+FetchResult = collections.namedtuple('FetchResult',
+                                     ['content', 'error', 'permanent'])
+
+
+def IsTransient(status_code):
+  """Check if a failed request may succeed if it's retried.
+
+  Args:
+    status_code: the HTTP status code, or None if there wasn't a response.
+  """
+  return status_code is None or status_code >= 500 or status_code in (408, 429)
+
+
+class _Job(object):
+  def __init__(self, url):
+    self.url = url
+    self.host = urlparse.urlsplit(url).netloc.lower()
+    self.attempt = 0
+    self.ready_time = 0
+
+
+class ImagePipeline(object):
+  """Fetches a set of urls in parallel.
+
+  Args:
+    transport: the transport to make the requests with, defaults to a
+      UrlFetchTransport.
+    clock: returns the current time in seconds.
+    sleep: sleeps for a number of seconds.
+  """
+  def __init__(self, transport=None, max_concurrent=MAX_CONCURRENT,
+               max_per_host=MAX_PER_HOST, max_attempts=MAX_ATTEMPTS,
+               clock=time.time, sleep=time.sleep):
+    self._transport = transport or UrlFetchTransport()
+    self._max_concurrent = max_concurrent
+    self._max_per_host = max_per_host
+    self._max_attempts = max_attempts
+    self._clock = clock
+    self._sleep = sleep
+
+  def _Backoff(self, attempt):
+    """The delay before retrying, with jitter so retries are spread out."""
+    return BACKOFF_SECONDS * (2 ** (attempt - 1)) * random.uniform(1, 1.5)
+
+  def FetchAll(self, urls):
+    """Fetch a list of urls.
+
+    Returns:
+      A dict of url : FetchResult.
+    """
+    deadline = self._clock() + MAX_RUN_TIME
+    pending = [_Job(url) for url in urls]
+    # handle -> job
+    active = {}
+    host_counts = collections.defaultdict(int)
+    results = {}
+
+    while pending or active:
+      now = self._clock()
+      for job in list(pending):
+        if len(active) >= self._max_concurrent:
+          break
+        if (job.ready_time > now or
+            host_counts[job.host] >= self._max_per_host):
+          continue
+        pending.remove(job)
+        job.attempt += 1
+        active[self._transport.Start(job.url)] = job
+        host_counts[job.host] += 1
+
+      if not active:
+        # everything that's left is waiting to be retried
+        self._sleep(max(min(job.ready_time for job in pending) - now, 0))
+        continue
+
+      handle = self._transport.WaitAny(active.keys())
+      job = active.pop(handle)
+      host_counts[job.host] -= 1
+      try:
+        status_code, content = self._transport.Result(handle)
+        error = 'HTTP %d' % status_code
+      except FetchError, e:
+        status_code, content = None, None
+        error = str(e)
+
+      if status_code == 200:
+        results[job.url] = FetchResult(content, None, False)
+        continue
+
+      transient = IsTransient(status_code)
+      if transient and job.attempt < self._max_attempts:
+        job.ready_time = self._clock() + self._Backoff(job.attempt)
+        if job.ready_time < deadline:
+          pending.append(job)
+          continue
+      logging.info('image fetch failed. %s -> %s' % (job.url, error))
+      results[job.url] = FetchResult(None, error, not transient)
+    return results
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# image_pipeline_test.py
+# Copyright (C) 2026 Simon Newton
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import image_pipeline
+import threading
+import unittest
+import urllib2
+from image_pipeline import FetchResult
+
+
+class FakeTransport(object):
+  """A transport which returns canned responses.
+
+  Args:
+    responses: a dict of url : list of status codes. None raises a FetchError.
+  """
+  def __init__(self, responses):
+    self._responses = responses
+    self._next_handle = 0
+    self._active = []
+    self.requests = []
+    # host : the most requests in flight at once
+    self.max_in_flight = {}
+
+  def _Host(self, url):
+    return url.split('/')[2]
+
+  def Start(self, url):
+    self._next_handle += 1
+    handle = (self._next_handle, url)
+    self._active.append(handle)
+    self.requests.append(url)
+    host = self._Host(url)
+    in_flight = len([u for _, u in self._active if self._Host(u) == host])
+    self.max_in_flight[host] = max(self.max_in_flight.get(host, 0), in_flight)
+    return handle
+
+  def WaitAny(self, handles):
+    handle = sorted(handles)[0]
+    self._active.remove(handle)
+    return handle
+
+  def Result(self, handle):
+    status_code = self._responses[handle[1]].pop(0)
+    if status_code is None:
+      raise image_pipeline.FetchError('timeout')
+    return status_code, 'image data'
+
+
+class UrllibTransport(object):
+  """A transport which makes real requests with urllib2, a thread each."""
+  def __init__(self):
+    self._next_handle = 0
+    self._done = Queue.Queue()
+    self._results = {}
+
+  def Start(self, url):
+    self._next_handle += 1
+    handle = self._next_handle
+
+    def Fetch():
+      try:
+        response = urllib2.urlopen(url, timeout=5)
+        result = (response.getcode(), response.read())
+      except urllib2.HTTPError, e:
+        result = (e.code, e.read())
+      except urllib2.URLError, e:
+        result = image_pipeline.FetchError(str(e))
+      self._done.put((handle, result))
+
+    thread = threading.Thread(target=Fetch)
+    thread.daemon = True
+    thread.start()
+    return handle
+
+  def WaitAny(self, handles):
+    while True:
+      for handle in handles:
+        if handle in self._results:
+          return handle
+      handle, result = self._done.get(timeout=10)
+      self._results[handle] = result
+
+  def Result(self, handle):
+    result = self._results.pop(handle)
+    if isinstance(result, image_pipeline.FetchError):
+      raise result
+    return result
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves /image.png, /missing.png and /flaky.png, which fails once."""
+  def do_GET(self):
+    self.server.requests.append(self.path)
+    if self.path == '/image.png':
+      self.Reply(200, 'image data')
+    elif (self.path == '/flaky.png' and
+          self.server.requests.count(self.path) > 1):
+      self.Reply(200, 'flaky image data')
+    elif self.path == '/flaky.png':
+      self.Reply(503, 'try again')
+    else:
+      self.Reply(404, 'not found')
+
+  def Reply(self, status_code, body):
+    self.send_response(status_code)
+    self.send_header('Content-Type', 'image/png')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                       StandInHandler)
+    self.requests = []
+
+
+class FakeClock(object):
+  """A clock which only moves when sleep() is called."""
+  def __init__(self):
+    self.now = 1000.0
+    self.sleeps = []
+
+  def Time(self):
+    return self.now
+
+  def Sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+
+class TestImagePipeline(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+
+  def Pipeline(self, transport, **kwargs):
+    return image_pipeline.ImagePipeline(transport, clock=self.clock.Time,
+                                        sleep=self.clock.Sleep, **kwargs)
+
+  def testPerHostLimit(self):
+    responses = {}
+    for i in xrange(6):
+      responses['http://a.example.com/%d.png' % i] = [200]
+      responses['http://b.example.com/%d.png' % i] = [200]
+    transport = FakeTransport(responses)
+    results = self.Pipeline(transport).FetchAll(sorted(responses))
+
+    self.assertEqual(12, len(results))
+    for result in results.itervalues():
+      self.assertEqual(FetchResult('image data', None, False), result)
+    self.assertEqual(image_pipeline.MAX_PER_HOST,
+                     transport.max_in_flight['a.example.com'])
+    self.assertEqual(image_pipeline.MAX_PER_HOST,
+                     transport.max_in_flight['b.example.com'])
+
+  def testTransientFailureIsRetried(self):
+    url = 'http://a.example.com/1.png'
+    transport = FakeTransport({url: [503, 503, 503]})
+    results = self.Pipeline(transport, max_attempts=3).FetchAll([url])
+
+    self.assertEqual([url] * 3, transport.requests)
+    self.assertEqual(FetchResult(None, 'HTTP 503', False), results[url])
+    # the delay doubles, plus up to 50% jitter
+    self.assertEqual(2, len(self.clock.sleeps))
+    first, second = self.clock.sleeps
+    self.assertTrue(1 <= first <= 1.5)
+    self.assertTrue(2 <= second <= 3)
+
+  def testRetryThenSuccess(self):
+    url = 'http://a.example.com/1.png'
+    transport = FakeTransport({url: [None, 200]})
+    results = self.Pipeline(transport).FetchAll([url])
+    self.assertEqual(FetchResult('image data', None, False), results[url])
+
+  def testPermanentFailure(self):
+    url = 'http://a.example.com/missing.png'
+    transport = FakeTransport({url: [404]})
+    results = self.Pipeline(transport).FetchAll([url])
+
+    self.assertEqual([url], transport.requests)
+    self.assertEqual(FetchResult(None, 'HTTP 404', True), results[url])
+    self.assertEqual([], self.clock.sleeps)
+
+
+class TestImagePipelineWithServer(unittest.TestCase):
+  """Run the pipeline against a local HTTP server."""
+  def setUp(self):
+    self.server = StandInServer()
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.clock = FakeClock()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testFetchAll(self):
+    urls = [self.base_url + path
+            for path in ['/image.png', '/missing.png', '/flaky.png']]
+    pipeline = image_pipeline.ImagePipeline(
+        UrllibTransport(), clock=self.clock.Time, sleep=self.clock.Sleep)
+    results = pipeline.FetchAll(urls)
+
+    self.assertEqual(FetchResult('image data', None, False), results[urls[0]])
+    self.assertEqual(FetchResult(None, 'HTTP 404', True), results[urls[1]])
+    self.assertEqual(FetchResult('flaky image data', None, False),
+                     results[urls[2]])
+    self.assertEqual(2, self.server.requests.count('/flaky.png'))
+    self.assertEqual(1, len(self.clock.sleeps))
+
+
+if __name__ == '__main__':
+  unittest.main()
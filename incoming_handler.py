@@ -16,11 +16,13 @@
 # Copyright (C) 2011 Simon Newton
 # PID search / display handlers.
 
+import ast
 import common
+import compression
 import datetime
 import json
 import logging
-from model import Manufacturer, UploadedResponderInfo
+from model import UploadedResponderInfo
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
@@ -70,7 +72,7 @@ class HandleModelData(webapp.RequestHandler):
       return []
 
     try:
-      evaled_data = eval(data, {})
+      evaled_data = ast.literal_eval(data)
     except Exception as e:
       logging.info(data)
       logging.error(e)
@@ -86,11 +88,9 @@ class HandleModelData(webapp.RequestHandler):
 
       # See if we can get the manufacturer name
       manufacturer_name = None
-      manufacturer_query = Manufacturer.all()
-      manufacturer_query.filter('esta_id = ', manufacturer_id)
-      results = manufacturer_query.fetch(1)
-      if results:
-        manufacturer_name = results[0].name
+      manufacturer = common.GetManufacturer(manufacturer_id)
+      if manufacturer:
+        manufacturer_name = manufacturer.name
 
       for responder in responders:
         if 'device_model' not in responder:
@@ -152,7 +152,7 @@ class UpdateModelData(webapp.RequestHandler):
       return []
 
     try:
-      evaled_data = eval(data, {})
+      evaled_data = ast.literal_eval(data)
     except Exception as e:
       logging.info(data)
       logging.error(e)
@@ -190,9 +190,9 @@ class UpdateModelData(webapp.RequestHandler):
     return []
 
 
-incoming_application = webapp.WSGIApplication(
+incoming_application = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/incoming/model_data', HandleModelData),
     ('/incoming/update_model_data', UpdateModelData),
   ],
-  debug=True)
+  debug=True))
@@ -0,0 +1,158 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# key_migrator.py
+# Copyright (C) 2026 Simon Newton
+# Moves entities onto their deterministic key names.
+
+import logging
+from google.appengine.ext import db
+from model import LastUpdateTime, Manufacturer, Pid, Product, ProductTag, ProductTagRelationship, Responder, ResponderTag, ResponderTagRelationship, SoftwareVersion
+from model import LastUpdateTimeKeyName, ManufacturerKeyName, PidKeyName, ProductTagKeyName, ResponderKeyName, ResponderTagKeyName
+
+
+class MigrationStage(object):
+  """Describes how to re-key one kind.
+
+  Args:
+    kind: the Model class to re-key.
+    key_name_fn: a function which returns the key name for an entity.
+    references: a list of (Model class, property name) tuples for the
+      ReferenceProperties which point at this kind.
+    key_lists: a list of (Model class, property name) tuples for the
+      ListProperty(db.Key) properties which contain keys of this kind.
+  """
+  def __init__(self, kind, key_name_fn, references=(), key_lists=()):
+    self.kind = kind
+    self.key_name_fn = key_name_fn
+    self.references = references
+    self.key_lists = key_lists
+
+
+# The order matters here, Responders and Pids use the manufacturer's esta_id
+# so the Manufacturers need to be moved first.
+STAGES = [
+    MigrationStage(
+        Manufacturer,
+        lambda m: ManufacturerKeyName(m.esta_id),
+        references=[(Responder, 'manufacturer'),
+                    (Product, 'manufacturer'),
+                    (Pid, 'manufacturer')]),
+    MigrationStage(
+        Responder,
+        lambda r: ResponderKeyName(r.manufacturer.esta_id, r.device_model_id),
+        references=[(SoftwareVersion, 'responder'),
+                    (ResponderTagRelationship, 'responder')],
+        key_lists=[(Pid, 'responders')]),
+    MigrationStage(
+        Pid,
+        lambda p: PidKeyName(p.manufacturer.esta_id, p.pid_id)),
+    MigrationStage(
+        ResponderTag,
+        lambda t: ResponderTagKeyName(t.label),
+        references=[(ResponderTagRelationship, 'tag')]),
+    MigrationStage(
+        ProductTag,
+        lambda t: ProductTagKeyName(t.product_type, t.label),
+        references=[(ProductTagRelationship, 'tag')]),
+    MigrationStage(
+        LastUpdateTime,
+        lambda u: LastUpdateTimeKeyName(u.name)),
+]
+
+
+class KeyMigrator(object):
+  """Re-keys entities which were stored with datastore allocated ids.
+
+  Every step is idempotent: the new entity is written before any references
+  are rewritten, and the old entity is only deleted once nothing points at it.
+  If a batch is interrupted it'll be picked up again by the next call.
+  """
+  BATCH_SIZE = 50
+
+  def _NextBatch(self, kind):
+    """Fetch the next batch of entities that don't have a key name.
+
+    Keys with numeric ids sort before keys with names, so we can stop as soon
+    as we see a named key.
+
+    Returns:
+      A tuple of (entities, more), where more is True if there may be further
+      entities to process.
+    """
+    query = kind.all(keys_only=True)
+    query.order('__key__')
+    keys = [key for key in query.fetch(self.BATCH_SIZE)
+            if key.name() is None]
+    # queries are eventually consistent, skip anything that was already moved
+    entities = [entity for entity in db.get(keys) if entity is not None]
+    return entities, len(keys) == self.BATCH_SIZE
+
+  def _CopyEntity(self, entity, key_name):
+    """Create a copy of an entity with a new key name."""
+    properties = {}
+    for name, prop in entity.properties().iteritems():
+      properties[name] = prop.get_value_for_datastore(entity)
+    return entity.__class__(key_name=key_name, **properties)
+
+  def _RewriteReferences(self, stage, old_key, new_key):
+    """Point everything that referenced old_key at new_key instead."""
+    modified = []
+    for kind, property_name in stage.references:
+      query = kind.all()
+      query.filter('%s = ' % property_name, old_key)
+      for entity in query:
+        setattr(entity, property_name, new_key)
+        modified.append(entity)
+
+    for kind, property_name in stage.key_lists:
+      query = kind.all()
+      query.filter('%s = ' % property_name, old_key)
+      for entity in query:
+        keys = getattr(entity, property_name)
+        setattr(entity, property_name,
+                [new_key if key == old_key else key for key in keys])
+        modified.append(entity)
+
+    if modified:
+      db.put(modified)
+    return len(modified)
+
+  def MigrateBatch(self, stage_index):
+    """Re-key the next batch of entities for a stage.
+
+    Returns:
+      True if there are more entities to process in this stage, False if the
+      stage is complete.
+    """
+    stage = STAGES[stage_index]
+    entities, more = self._NextBatch(stage.kind)
+
+    for entity in entities:
+      key_name = stage.key_name_fn(entity)
+      new_entity = stage.kind.get_by_key_name(key_name)
+      if new_entity is None:
+        new_entity = self._CopyEntity(entity, key_name)
+        new_entity.put()
+      else:
+        # either a previous run was interrupted, or there were duplicate
+        # entities. In both cases we keep the one with the key name.
+        logging.info('%s already exists' % key_name)
+
+      updated = self._RewriteReferences(stage, entity.key(), new_entity.key())
+      entity.delete()
+      logging.info('Moved %s -> %s, updated %d references' %
+                   (entity.key(), key_name, updated))
+
+    return more
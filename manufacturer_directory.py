@@ -0,0 +1,149 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# manufacturer_directory.py
+# Copyright (C) 2026 Simon Newton
+# An in-memory directory of all the manufacturers.
+
+import logging
+import memcache_keys
+import time
+import timestamp_keys
+import versioned_cache
+from google.appengine.ext import db
+from model import Manufacturer
+
+
+class ManufacturerDirectory(object):
+  """Holds every Manufacturer entity in memory.
+
+  There are only ~900 manufacturers, so we load the lot once per instance and
+  then check the MANUFACTURERS generation counter in memcache to see if it's
+  changed. The entities are shared between requests so they must be treated as
+  read only.
+  """
+  # How often to check memcache for a new generation, in seconds.
+  CHECK_INTERVAL = 10
+  # Reload from the datastore at least this often, in seconds. This limits how
+  # long we'd hold stale data if the load raced with an update.
+  MAX_AGE = 3600
+
+  def __init__(self):
+    self._generation = None
+    self._last_check = 0
+    self._load_time = 0
+    self._by_id = {}
+    self._by_key = {}
+    self._by_name = []
+
+  def _MaybeRefresh(self):
+    now = time.time()
+    if (self._generation is not None and
+        now - self._last_check < self.CHECK_INTERVAL):
+      return
+    self._last_check = now
+
+    generation = versioned_cache.GetGeneration(timestamp_keys.MANUFACTURERS)
+    if (generation is not None and generation == self._generation and
+        now - self._load_time < self.MAX_AGE):
+      return
+    self._Load(generation)
+    self._load_time = now
+
+  def _Load(self, generation):
+    cached = None
+    if generation is not None:
+      cached = versioned_cache.Get(memcache_keys.MANUFACTURER_DIRECTORY_KEY)
+    if cached is not None:
+      manufacturers = [db.model_from_protobuf(pb) for pb in cached]
+    else:
+      manufacturers = list(Manufacturer.all())
+      encoded = [db.model_to_protobuf(m).Encode() for m in manufacturers]
+      if not versioned_cache.Set(memcache_keys.MANUFACTURER_DIRECTORY_KEY,
+                                 encoded,
+                                 time=self.MAX_AGE):
+        logging.error('Manufacturer directory memcache set failed.')
+
+    self._by_id = {}
+    self._by_key = {}
+    for manufacturer in manufacturers:
+      self._by_id[manufacturer.esta_id] = manufacturer
+      self._by_key[manufacturer.key()] = manufacturer
+    self._by_name = sorted(manufacturers, key=lambda m: m.name)
+    self._generation = generation
+
+  def Get(self, esta_id):
+    """Lookup a manufacturer by ESTA id.
+
+    Returns:
+      The Manufacturer entity, or None if not found.
+    """
+    self._MaybeRefresh()
+    return self._by_id.get(esta_id)
+
+  def GetByKey(self, key):
+    """Lookup a manufacturer by datastore key.
+
+    Returns:
+      The Manufacturer entity, or None if not found.
+    """
+    self._MaybeRefresh()
+    return self._by_key.get(key)
+
+  def All(self):
+    """Return a list of all manufacturers, sorted by name."""
+    self._MaybeRefresh()
+    return self._by_name
+
+  def Invalidate(self):
+    """Bump the generation so every instance reloads the directory."""
+    versioned_cache.Invalidate(timestamp_keys.MANUFACTURERS)
+    self._generation = None
+
+
+_directory = ManufacturerDirectory()
+
+
+def GetManufacturer(esta_id):
+  """Lookup a Manufacturer by ESTA id."""
+  return _directory.Get(esta_id)
+
+
+def GetManufacturerByKey(key):
+  """Lookup a Manufacturer by datastore key."""
+  return _directory.GetByKey(key)
+
+
+def GetEntityManufacturer(entity):
+  """Return the Manufacturer that an entity's manufacturer property refers to.
+
+  This avoids the datastore get that dereferencing the ReferenceProperty
+  would cause.
+  """
+  key = entity.__class__.manufacturer.get_value_for_datastore(entity)
+  manufacturer = _directory.GetByKey(key)
+  if manufacturer is None:
+    # not in the directory yet, fall back to the datastore
+    manufacturer = entity.manufacturer
+  return manufacturer
+
+
+def AllManufacturers():
+  """Return all Manufacturers, sorted by name."""
+  return _directory.All()
+
+
+def InvalidateManufacturers():
+  """Call this after modifying any Manufacturer entities."""
+  _directory.Invalidate()
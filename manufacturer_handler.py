@@ -17,7 +17,8 @@
 # Product search / display handlers
 
 import common
-from model import Manufacturer
+import compression
+import manufacturer_directory
 from google.appengine.ext import webapp
 
 
@@ -27,9 +28,7 @@ class ListManufacturersHandler(common.BasePageHandler):
 
   def GetTemplateData(self):
     manufacturers = []
-    query = Manufacturer.all()
-    query.order('name')
-    for manufacturer in query:
+    for manufacturer in manufacturer_directory.AllManufacturers():
       if manufacturer.esta_id in [0, 0xffff]:
         continue
 
@@ -72,9 +71,9 @@ class DisplayManufacturersHandler(common.BasePageHandler):
     return data
 
 
-app = webapp.WSGIApplication(
+app = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/manufacturer/list', ListManufacturersHandler),
     ('/manufacturer/display', DisplayManufacturersHandler),
   ],
-  debug=True)
+  debug=True))
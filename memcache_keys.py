@@ -15,51 +15,99 @@
 # memcache_keys.py
 # Copyright (C) 2011 Simon Newton
 # The keys used for memcache.
+#
+# Each key lists the timestamp_keys sections the cached data is derived from.
+# The keys are namespaced by the generation number of each of those sections,
+# so bumping a generation with versioned_cache.Invalidate() drops everything
+# that depends on it.
+
+from timestamp_keys import ALL, CONTROLLERS, DEVICES, MANUFACTURERS, NODES, PIDS, PID_INDEX, SOFTWARE, SPLITTERS
+
+
+class CacheKey(object):
+  """A memcache key, and the sections of the index it depends on."""
+  def __init__(self, name, *domains):
+    self.name = name
+    self.domains = sorted(domains)
 
-# Number of products inc. devices
-PRODUCT_COUNT_KEY = 'product_count'
+  def __repr__(self):
+    return 'CacheKey(%s)' % self.name
 
-# Number of manufacturer pids
-MANUFACTURER_CACHE_KEY = 'manufacturers'
 
-# Number of manufacturer pids
-MANUFACTURER_PID_COUNT_KEY = 'manufacturer_pid_count'
+# The manufacturer list
+MANUFACTURER_CACHE_KEY = CacheKey('manufacturers', MANUFACTURERS)
+
+# The serialized manufacturer directory
+MANUFACTURER_DIRECTORY_KEY = CacheKey('manufacturer_directory', MANUFACTURERS)
 
 # PID manufacturer counts
-MANUFACTURER_PID_COUNTS = 'manufacturer_pids'
+MANUFACTURER_PID_COUNTS = CacheKey('manufacturer_pids', MANUFACTURERS, PIDS)
 
 # Manufacturer model counts
-MANUFACTURER_MODEL_COUNTS = 'manufacturer_models'
+MANUFACTURER_MODEL_COUNTS = CacheKey(
+    'manufacturer_models', MANUFACTURERS, DEVICES)
 
 # Manufacturer controller counts
-MANUFACTURER_CONTROLLER_COUNTS = 'manufacturer_controllers'
+MANUFACTURER_CONTROLLER_COUNTS = CacheKey(
+    'manufacturer_controllers', MANUFACTURERS, CONTROLLERS)
 
 # Manufacturer node counts
-MANUFACTURER_NODE_COUNTS = 'manufacturer_nodes'
+MANUFACTURER_NODE_COUNTS = CacheKey('manufacturer_nodes', MANUFACTURERS, NODES)
 
 # Manufacturer software counts
-MANUFACTURER_SOFTWARE_COUNTS = 'manufacturer_software'
+MANUFACTURER_SOFTWARE_COUNTS = CacheKey(
+    'manufacturer_software', MANUFACTURERS, SOFTWARE)
 
 # Manufacturer splitter counts
-MANUFACTURER_SPLITTER_COUNTS = 'manufacturer_splitters'
+MANUFACTURER_SPLITTER_COUNTS = CacheKey(
+    'manufacturer_splitters', MANUFACTURERS, SPLITTERS)
 
 # Category model counts
-CATEGORY_MODEL_COUNTS = 'category_models'
+CATEGORY_MODEL_COUNTS = CacheKey('category_models', DEVICES)
 
 # Tag model counts
-TAG_MODEL_COUNTS = 'tag_models'
+TAG_MODEL_COUNTS = CacheKey('tag_models', DEVICES)
 
 # Tag controller counts
-TAG_CONTROLLER_COUNTS = 'tag_controllers'
+TAG_CONTROLLER_COUNTS = CacheKey('tag_controllers', CONTROLLERS)
 
 # Tag node counts
-TAG_NODE_COUNTS = 'tag_nodes'
+TAG_NODE_COUNTS = CacheKey('tag_nodes', NODES)
 
 # Tag software counts
-TAG_SOFTWARE_COUNTS = 'tag_software'
+TAG_SOFTWARE_COUNTS = CacheKey('tag_software', SOFTWARE)
 
 # Tag splitter counts
-TAG_SPLITTER_COUNTS = 'tag_splitters'
+TAG_SPLITTER_COUNTS = CacheKey('tag_splitters', SPLITTERS)
 
 # Index info data
-INDEX_INFO = 'index_info'
+INDEX_INFO = CacheKey('index_info', *ALL)
+
+# The (manufacturer_id, pid_id) to pid_cache.PidSummary map
+PID_SUMMARIES = CacheKey('pid_summaries', MANUFACTURERS, PIDS)
+
+
+def LastUpdateTimeKey(timestamp_name):
+  """The key for the cached update time of a timestamp_keys entry."""
+  return CacheKey('last_update_time:%s' % timestamp_name, timestamp_name)
+
+
+def BrowseCursorKey(listing, page, *domains):
+  """The key for the cursor at the start of a page of a browse listing."""
+  return CacheKey('browse_cursor:%s:%d' % (listing, page), *domains)
+
+
+def ResponderSummaryKey(responder_id):
+  """The key for the responder_summaries.ResponderSummary of a responder."""
+  return CacheKey('responder_summary:%d' % responder_id, DEVICES)
+
+
+def PidSupportedByKey(pid_key_name, cursor):
+  """The key for a page of the responders which support a PID."""
+  return CacheKey('pid_supported_by:%s:%s' % (pid_key_name, cursor or ''),
+                  DEVICES, PIDS, PID_INDEX)
+
+
+def SnapshotKey(name, *domains):
+  """The key for the gzipped content of a snapshot."""
+  return CacheKey('snapshot:%s' % name, *domains)
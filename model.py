@@ -28,6 +28,64 @@ SUBDEVICE_RANGE_DICT = {
 }
 
 
+# Entities that are looked up by their natural id are stored under a
+# deterministic key name. This lets us use key gets (which can be batched and
+# are strongly consistent) rather than queries.
+def ManufacturerKeyName(esta_id):
+  """The key name for a Manufacturer, e.g. m:0x7a70."""
+  return 'm:0x%04x' % esta_id
+
+
+def ResponderKeyName(esta_id, device_model_id):
+  """The key name for a Responder, e.g. r:0x7a70:0x0001."""
+  return 'r:0x%04x:0x%04x' % (esta_id, device_model_id)
+
+
+def SoftwareVersionKeyName(esta_id, device_model_id, version_id):
+  """The key name for a SoftwareVersion, e.g. sv:0x7a70:0x0001:0x00000100."""
+  return 'sv:0x%04x:0x%04x:0x%08x' % (esta_id, device_model_id, version_id)
+
+
+def ProductKeyName(product_type, esta_id, name):
+  """The key name for a Product, product_type is the class name."""
+  return 'pr:%s:0x%04x:%s' % (product_type, esta_id, name)
+
+
+def PidKeyName(esta_id, pid_id):
+  """The key name for a Pid, e.g. p:0x0000:0x0060."""
+  return 'p:0x%04x:0x%04x' % (esta_id, pid_id)
+
+
+def PidSupportKeyName(bucket):
+  """The key name for a PidSupport, which is a child of the Pid."""
+  return 'ps:%03d' % bucket
+
+
+def ResponderTagKeyName(label):
+  """The key name for a ResponderTag."""
+  return 't:%s' % label
+
+
+def ProductTagKeyName(product_type, label):
+  """The key name for a ProductTag, product_type is the class name."""
+  return 'pt:%s:%s' % (product_type, label)
+
+
+def LastUpdateTimeKeyName(timestamp_name):
+  """The key name for a LastUpdateTime."""
+  return 'u:%s' % timestamp_name
+
+
+def CounterShardKeyName(counter_name, index):
+  """The key name for a CounterShard, e.g. c:products:3."""
+  return 'c:%s:%d' % (counter_name, index)
+
+
+def ModelLoadChunkKeyName(job_id, chunk_id):
+  """The key name for a ModelLoadChunk."""
+  return 'lc:%s:%s' % (job_id, chunk_id)
+
+
 class LastUpdateTime(db.Model):
   """Tracks the last update time for each section of the index."""
   name = db.StringProperty(required=True)
@@ -72,12 +130,34 @@ class Responder(db.Model):
   image_data = blobstore.BlobReferenceProperty()
   # the url we're serving the image on
   image_serving_url = db.LinkProperty()
+  # The failed fetches of the image_url, see image_fetcher.py
+  image_fetch_failures = db.IntegerProperty(default=0, indexed=False)
+  image_fetch_error = db.StringProperty(indexed=False)
+  image_retry_time = db.DateTimeProperty(indexed=False)
   # the scoring rank
   score = db.IntegerProperty()
   # the score penalty, used to demote responders
   score_penalty = db.IntegerProperty()
   # test score, this is updated with the latest score
   rdm_responder_rating = db.RatingProperty()
+  # The following are denormalized from the software_version_set by the
+  # ModelUpdater, so we don't have to load every SoftwareVersion to find the
+  # latest one. They are None for responders that haven't been updated yet.
+  # SoftwareVersion isn't defined yet, so this reference can't be typed.
+  latest_software = db.ReferenceProperty(
+      collection_name='latest_software_responder_set')
+  software_version_count = db.IntegerProperty()
+  # the supported params of the latest software version
+  supported_parameters = db.ListProperty(int, indexed=False)
+  # The normalized tokens (and their prefixes) from the description,
+  # manufacturer, category & tags, maintained by the ModelUpdater. See
+  # responder_search.py.
+  search_tokens = db.StringListProperty()
+  # The labels of the tags, denormalized from the tag_set by the ModelUpdater.
+  tags = db.StringListProperty()
+  # The fingerprint of the model data this responder was last loaded from,
+  # see model_loader.ModelContentHash.
+  content_hash = db.StringProperty(indexed=False)
 
 
 class ResponderTag(db.Model):
@@ -157,6 +237,13 @@ class Product(polymodel.PolyModel):
   image_data = blobstore.BlobReferenceProperty()
   # the url we're serving the image on
   image_serving_url = db.LinkProperty()
+  # The failed fetches of the image_url, see image_fetcher.py
+  image_fetch_failures = db.IntegerProperty(default=0, indexed=False)
+  image_fetch_error = db.StringProperty(indexed=False)
+  image_retry_time = db.DateTimeProperty(indexed=False)
+  # The labels of the tags, denormalized from the tag_set by the
+  # ProductLoader.
+  tags = db.StringListProperty()
 
 
 class ProductTag(db.Model):
@@ -212,8 +299,12 @@ class Command(db.Model):
   sub_device_range = db.IntegerProperty(
       required=True,
       choices=set(xrange(4)))
+  # The messages, as canonical JSON, and the hashes of the JSON. See
+  # command_messages.py.
   request = db.TextProperty()
   response = db.TextProperty()
+  request_hash = db.StringProperty(indexed=False)
+  response_hash = db.StringProperty(indexed=False)
 
 
 class Pid(db.Model):
@@ -231,8 +322,23 @@ class Pid(db.Model):
                                      collection_name='pid_get_command_set')
   set_command = db.ReferenceProperty(Command,
                                      collection_name='pid_set_command_set')
-  # A list of responder keys that support this PID.
+  # The responders that support this PID are stored in the PidSupport
+  # children, see pid_support.py. This list is from before then, it's cleared
+  # by the PID index check.
   responders = db.ListProperty(db.Key)
+  # The number of responders that support this PID.
+  responder_count = db.IntegerProperty(default=0, indexed=False)
+
+
+class PidSupport(db.Model):
+  """A bucket of the responders which support a PID, see pid_support.py.
+
+  The parent is the Pid, and the key name is from PidSupportKeyName().
+  """
+  bucket = db.IntegerProperty(required=True, indexed=False)
+  # the packed, sorted responder ids
+  responders = db.BlobProperty()
+  count = db.IntegerProperty(default=0, indexed=False)
 
 
 class UploadedResponderInfo(db.Model):
@@ -246,3 +352,46 @@ class UploadedResponderInfo(db.Model):
   email_or_name = db.TextProperty()
   upload_time = db.DateTimeProperty()
   processed = db.BooleanProperty(default=False)
+
+
+class CounterShard(db.Model):
+  """One shard of a counter, see counters.py."""
+  name = db.StringProperty(required=True)
+  # Counters in the same group can be fetched with a single query, member
+  # identifies the counter within the group, e.g. the manufacturer's esta_id.
+  group = db.StringProperty()
+  member = db.IntegerProperty()
+  count = db.IntegerProperty(default=0, indexed=False)
+
+
+class ExportSnapshot(db.Model):
+  """A pre-rendered, gzipped copy of an export, see snapshots.py.
+
+  The key name is the name of the snapshot.
+  """
+  blob = blobstore.BlobReferenceProperty()
+  # the sha1 of the uncompressed content
+  content_hash = db.StringProperty(indexed=False)
+  # the most recent update time of the data this was built from
+  source_time = db.DateTimeProperty(indexed=False)
+  build_time = db.DateTimeProperty(indexed=False)
+
+
+class ModelLoadJob(db.Model):
+  """A load of the model data, split into tasks, see model_load_job.py.
+
+  The key name is the job id.
+  """
+  # the chunks the load was split into
+  chunk_ids = db.StringListProperty(indexed=False)
+  start_time = db.DateTimeProperty(indexed=False)
+  finish_time = db.DateTimeProperty(indexed=False)
+  # the descriptions of the models, collected from the chunks
+  added = db.StringListProperty(indexed=False)
+  updated = db.StringListProperty(indexed=False)
+
+
+class ModelLoadChunk(db.Model):
+  """The result of loading one chunk of a ModelLoadJob."""
+  added = db.StringListProperty(indexed=False)
+  updated = db.StringListProperty(indexed=False)
@@ -17,14 +17,20 @@
 # Model search / display handlers
 
 import common
+import compression
+import counters
 import json
 import logging
+import manufacturer_directory
 import memcache_keys
+import pid_cache
+import responder_search
+import timestamp_keys
+import versioned_cache
 from data.sensor_types import SENSOR_TYPES
-from model import Manufacturer, Pid, ProductCategory, Responder, ResponderTag
+from model import ProductCategory, Responder, ResponderTag
 from utils import StringToInt
 from google.appengine.api import images
-from google.appengine.api import memcache
 from google.appengine.ext import webapp
 
 
@@ -44,9 +50,11 @@ class BrowseModels(common.BasePageHandler):
 
     query = Responder.all()
     query.order('-score')
-    total = query.count()
-    models = query.fetch(limit=self.RESULTS_PER_PAGE,
-                         offset=page * self.RESULTS_PER_PAGE)
+    total = counters.GetCount(counters.RESPONDERS)
+    models, previous_cursor, next_cursor = common.FetchPage(
+        query, 'models', [timestamp_keys.DEVICES], page,
+        self.RESULTS_PER_PAGE, self.request.get('cursor'))
+    models = common.PrefetchReferences(models, Responder.manufacturer)
     rows = []
     for model, index in zip(models, range(len(models))):
       if index % self.COLUMNS == 0:
@@ -86,8 +94,10 @@ class BrowseModels(common.BasePageHandler):
     }
     if page:
       data['previous'] = page
+      data['previous_cursor'] = previous_cursor
     if start + len(models) < total:
       data['next'] = page + 2
+      data['next_cursor'] = next_cursor
     return data
 
 
@@ -112,20 +122,19 @@ class SearchByManufacturer(BaseSearchHandler):
     self._manufacturer = common.GetManufacturer(self._manufacturer_id)
 
   def GetSearchData(self):
-    manufacturer_list = memcache.get(memcache_keys.MANUFACTURER_MODEL_COUNTS)
+    manufacturer_list = versioned_cache.Get(memcache_keys.MANUFACTURER_MODEL_COUNTS)
     if not manufacturer_list:
       manufacturer_list = []
-      query = Manufacturer.all()
-      query.order('name')
-      for manufacturer in query:
-        responders = manufacturer.responder_set.count()
+      counts = counters.GetGroupCounts(counters.RESPONDERS_BY_MANUFACTURER)
+      for manufacturer in manufacturer_directory.AllManufacturers():
+        responders = counts.get(manufacturer.esta_id)
         if responders:
           manufacturer_list.append({
               'id': manufacturer.esta_id,
               'name': manufacturer.name,
               'responder_count': responders,
           })
-      memcache.set(memcache_keys.MANUFACTURER_MODEL_COUNTS, manufacturer_list)
+      versioned_cache.Set(memcache_keys.MANUFACTURER_MODEL_COUNTS, manufacturer_list)
 
     return {
         'manufacturers': manufacturer_list,
@@ -149,20 +158,21 @@ class SearchByCategory(BaseSearchHandler):
     self._category = common.LookupProductCategory(self._category_id)
 
   def GetSearchData(self):
-    category_list = memcache.get(memcache_keys.CATEGORY_MODEL_COUNTS)
+    category_list = versioned_cache.Get(memcache_keys.CATEGORY_MODEL_COUNTS)
     if not category_list:
       category_list = []
+      counts = counters.GetGroupCounts(counters.RESPONDERS_BY_CATEGORY)
       query = ProductCategory.all()
       query.order('name')
       for category in query:
-        responders = category.responder_set.count()
+        responders = counts.get(category.id)
         if responders:
           category_list.append({
               'id': category.id,
               'name': category.name,
               'responder_count': responders,
           })
-      memcache.set(memcache_keys.CATEGORY_MODEL_COUNTS, category_list)
+      versioned_cache.Set(memcache_keys.CATEGORY_MODEL_COUNTS, category_list)
 
     return {
         'categories': category_list,
@@ -183,7 +193,7 @@ class SearchByTag(BaseSearchHandler):
     self._tag = self.request.get('tag')
 
   def GetSearchData(self):
-    tag_list = memcache.get(memcache_keys.TAG_MODEL_COUNTS)
+    tag_list = versioned_cache.Get(memcache_keys.TAG_MODEL_COUNTS)
     if not tag_list:
       tag_list = []
       query = ResponderTag.all()
@@ -195,7 +205,7 @@ class SearchByTag(BaseSearchHandler):
               'label': tag.label,
               'responder_count': responders,
           })
-      memcache.set(memcache_keys.TAG_MODEL_COUNTS, tag_list)
+      versioned_cache.Set(memcache_keys.TAG_MODEL_COUNTS, tag_list)
 
     return {
         'tags': tag_list,
@@ -203,14 +213,28 @@ class SearchByTag(BaseSearchHandler):
     }
 
   def GetResults(self):
-    if self._tag is not None:
-      query = ResponderTag.all()
-      query.filter('label = ', self._tag)
-      tags = query.fetch(1)
+    if self._tag:
+      query = Responder.all()
+      query.filter('tags = ', self._tag)
+      query.order('-score')
+      return common.PrefetchReferences(query, Responder.manufacturer)
+    return []
 
-      if tags:
-        tag_relationships = tags[0].responder_set
-        return [r.responder for r in tag_relationships]
+
+class SearchByText(BaseSearchHandler):
+  """Search by model description, manufacturer, category or tag."""
+  TEMPLATE = 'templates/text_model_search.tmpl'
+  MAX_RESULTS = 100
+
+  def Init(self):
+    self._query = self.request.get('q')
+
+  def GetSearchData(self):
+    return {'query': self._query}
+
+  def GetResults(self):
+    if self._query:
+      return responder_search.Search(self._query, self.MAX_RESULTS)
     return []
 
 
@@ -224,6 +248,7 @@ class DisplayModel(common.BasePageHandler):
       self.error(404)
       return
 
+    manufacturer = manufacturer_directory.GetEntityManufacturer(model)
     esta_manufacturer = common.GetManufacturer(0)
     if not esta_manufacturer:
       logging.error("Can't find ESTA manufacturer!")
@@ -243,24 +268,8 @@ class DisplayModel(common.BasePageHandler):
 
       supported_parameters = version_info.supported_parameters
       if supported_parameters is not None:
-        param_output = []
-        for param in supported_parameters:
-          param_dict = {'id': param}
-
-          query = Pid.all()
-          query.filter('pid_id =', param)
-          if param >= 0x8000:
-            query.filter('manufacturer = ', model.manufacturer)
-            param_dict['manufacturer_id'] = model.manufacturer.esta_id
-          else:
-            query.filter('manufacturer = ', esta_manufacturer)
-            param_dict['manufacturer_id'] = esta_manufacturer.esta_id
-
-          results = query.fetch(1)
-          if results:
-            param_dict['name'] = results[0].name
-          param_output.append(param_dict)
-
+        param_output = pid_cache.ResolveParameters(manufacturer.esta_id,
+                                                   supported_parameters)
         version_output['supported_parameters'] = sorted(
             param_output,
             key=lambda x: x['id'])
@@ -301,13 +310,13 @@ class DisplayModel(common.BasePageHandler):
 
     # construct link to Open Fixture Library's RDM lookup page
     ofl_model_url = 'https://open-fixture-library.org/rdm?source=olp'
-    ofl_model_url += '&manufacturerId=' + str(model.manufacturer.esta_id)
+    ofl_model_url += '&manufacturerId=' + str(manufacturer.esta_id)
     ofl_model_url += '&modelId=' + str(model.device_model_id)
 
     output = {
       'description': common.MaybeEncode(model.model_description),
-      'manufacturer': model.manufacturer.name,
-      'manufacturer_id': model.manufacturer.esta_id,
+      'manufacturer': manufacturer.name,
+      'manufacturer_id': manufacturer.esta_id,
       'model_id': model.device_model_id,
       'software_versions': software_versions,
       'software_versions_json': json.dumps(software_versions),
@@ -321,10 +330,8 @@ class DisplayModel(common.BasePageHandler):
       output['product_category'] = category.name
       output['product_category_id'] = category.id
 
-    # tags
-    for tag in model.tag_set:
-      tags = output.setdefault('tags', [])
-      tags.append(tag.tag.label)
+    if model.tags:
+      output['tags'] = model.tags
 
     if model.image_data:
       serving_url = model.image_serving_url
@@ -336,13 +343,14 @@ class DisplayModel(common.BasePageHandler):
     return output
 
 
-model_application = webapp.WSGIApplication(
+model_application = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/', BrowseModels),
     ('/model/browse', BrowseModels),
     ('/model/manufacturer', SearchByManufacturer),
     ('/model/category', SearchByCategory),
     ('/model/tag', SearchByTag),
+    ('/model/search', SearchByText),
     ('/model/display', DisplayModel),
   ],
-  debug=True)
+  debug=True))
@@ -0,0 +1,157 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# model_load_job.py
+# Copyright (C) 2026 Simon Newton
+# Load the model data with a task per chunk of models.
+#
+# Start() splits DEVICE_MODEL_DATA into chunks and adds a task for each one.
+# Each task loads its chunk and records the result in a ModelLoadChunk
+# entity. A finish task polls for the chunk results, and once they're all
+# present it collects them and updates the DEVICES timestamp.
+
+import datetime
+import logging
+import model_loader
+import timestamp_keys
+from data.model_data import DEVICE_MODEL_DATA
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from model import ModelLoadChunk, ModelLoadChunkKeyName, ModelLoadJob
+from update_times import UpdateModificationTime
+
+# The queue, defined in queue.yaml
+QUEUE_NAME = 'model-load'
+LOAD_URL = '/tasks/load_models'
+FINISH_URL = '/tasks/finish_model_load'
+
+# The number of models loaded by each task
+CHUNK_SIZE = 50
+# Seconds between checks for the chunks being complete
+FINISH_POLL_INTERVAL = 10
+# Give up waiting for the chunks after this long
+MAX_JOB_DURATION = datetime.timedelta(hours=1)
+# The maximum number of tasks in a single Queue.add()
+MAX_TASKS_PER_ADD = 100
+
+
+def _ChunkId(manufacturer_id, start):
+  return '0x%04x-%d' % (manufacturer_id, start)
+
+
+def _Chunks():
+  """Split the model data into chunks.
+
+  Returns:
+    A list of (chunk_id, manufacturer_id, start) tuples.
+  """
+  chunks = []
+  for manufacturer_id in sorted(DEVICE_MODEL_DATA):
+    models = DEVICE_MODEL_DATA[manufacturer_id]
+    for start in xrange(0, len(models), CHUNK_SIZE):
+      chunks.append((_ChunkId(manufacturer_id, start), manufacturer_id, start))
+  return chunks
+
+
+def _AddFinishTask(job_id, attempt):
+  # the task is named so that a retry of the task which added it doesn't
+  # start a second chain of finish tasks
+  task = taskqueue.Task(method='GET',
+                        name='model-load-finish-%s-%d' % (job_id, attempt),
+                        url='%s?job=%s&attempt=%d' %
+                            (FINISH_URL, job_id, attempt),
+                        countdown=FINISH_POLL_INTERVAL)
+  try:
+    task.add(QUEUE_NAME)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def Start():
+  """Start loading the model data.
+
+  Returns:
+    A tuple of (job_id, number of tasks).
+  """
+  now = datetime.datetime.now()
+  job_id = now.strftime('%Y%m%d%H%M%S%f')
+  chunks = _Chunks()
+  ModelLoadJob(key_name=job_id,
+               chunk_ids=[chunk_id for chunk_id, _, _ in chunks],
+               start_time=now).put()
+
+  tasks = []
+  for chunk_id, manufacturer_id, start in chunks:
+    tasks.append(taskqueue.Task(
+        method='GET',
+        name='model-load-%s-%s' % (job_id, chunk_id),
+        url='%s?job=%s&manufacturer=%d&start=%d' %
+            (LOAD_URL, job_id, manufacturer_id, start)))
+  queue = taskqueue.Queue(QUEUE_NAME)
+  for i in xrange(0, len(tasks), MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + MAX_TASKS_PER_ADD])
+
+  _AddFinishTask(job_id, 0)
+  logging.info('Started model load %s with %d tasks' % (job_id, len(tasks)))
+  return job_id, len(tasks)
+
+
+def LoadChunk(job_id, manufacturer_id, start):
+  """Load one chunk of the model data.
+
+  This can be run more than once for the same chunk.
+  """
+  key_name = ModelLoadChunkKeyName(job_id, _ChunkId(manufacturer_id, start))
+  if ModelLoadChunk.get_by_key_name(key_name) is not None:
+    logging.info('Chunk %s already loaded' % key_name)
+    return
+
+  models = DEVICE_MODEL_DATA.get(manufacturer_id, [])[start:start + CHUNK_SIZE]
+  loader = model_loader.ModelLoader({manufacturer_id: models})
+  added, updated = loader.Update()
+  ModelLoadChunk(key_name=key_name, added=added, updated=updated).put()
+
+
+def Finish(job_id, attempt):
+  """Complete a job if all the chunks have been loaded.
+
+  If they haven't, this schedules another check.
+  """
+  job = ModelLoadJob.get_by_key_name(job_id)
+  if job is None or job.finish_time is not None:
+    return
+
+  chunk_keys = [db.Key.from_path(ModelLoadChunk.kind(),
+                                 ModelLoadChunkKeyName(job_id, chunk_id))
+                for chunk_id in job.chunk_ids]
+  chunks = db.get(chunk_keys)
+  remaining = len([chunk for chunk in chunks if chunk is None])
+  if remaining:
+    if datetime.datetime.now() - job.start_time < MAX_JOB_DURATION:
+      _AddFinishTask(job_id, attempt + 1)
+      return
+    logging.error('Model load %s timed out with %d chunks remaining' %
+                  (job_id, remaining))
+
+  for chunk in chunks:
+    if chunk is not None:
+      job.added.extend(chunk.added)
+      job.updated.extend(chunk.updated)
+  job.finish_time = datetime.datetime.now()
+  job.put()
+  db.delete([chunk for chunk in chunks if chunk is not None])
+
+  UpdateModificationTime(timestamp_keys.DEVICES)
+  logging.info('Model load %s complete.\nAdded: %s\nUpdated: %s' %
+               (job_id, ', '.join(job.added), ', '.join(job.updated)))
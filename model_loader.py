@@ -18,7 +18,40 @@
 
 import logging
 import common
+import counters
+import hashlib
+import image_fetcher
+import manufacturer_directory
+import pid_index_builder
+import ranking
+import responder_search
+from google.appengine.ext import db
 from model import ProductCategory, Responder, ResponderPersonality, ResponderSensor, ResponderTag, ResponderTagRelationship, SoftwareVersion
+from model import ResponderKeyName, ResponderTagKeyName, SoftwareVersionKeyName
+from unit_of_work import UnitOfWork
+
+# Bump this if the way the model data is loaded changes, so every responder
+# is updated on the next load.
+CONTENT_HASH_VERSION = 1
+
+
+def _Canonical(value):
+  """Convert a value to a form with a stable repr(), by sorting the dicts."""
+  if isinstance(value, dict):
+    return sorted((k, _Canonical(v)) for k, v in value.iteritems())
+  if isinstance(value, (list, tuple)):
+    return [_Canonical(v) for v in value]
+  return value
+
+
+def ModelContentHash(model_info):
+  """Return a fingerprint of the data for a model.
+
+  Args:
+    model_info: a model dict, in the format used in data/model_data.py.
+  """
+  content = repr((CONTENT_HASH_VERSION, _Canonical(model_info)))
+  return hashlib.sha1(content).hexdigest()
 
 
 class ModelLoader(object):
@@ -51,6 +84,17 @@ class ModelLoader(object):
     """
     added = []
     updated = []
+    skipped = 0
+
+    responder_keys = []
+    for manufacturer_id, models in self._model_data.iteritems():
+      for model_info in models:
+        responder_keys.append(db.Key.from_path(
+            Responder.kind(),
+            ResponderKeyName(manufacturer_id, model_info['device_model'])))
+    for i in xrange(0, len(responder_keys), common.MAX_BATCH_GET):
+      self._updater.AddResponders(
+          db.get(responder_keys[i:i + common.MAX_BATCH_GET]))
 
     for manufacturer_id, models in self._model_data.iteritems():
       manufacturer = self._LookupManufacturer(manufacturer_id)
@@ -59,8 +103,15 @@ class ModelLoader(object):
         continue
 
       for model_info in models:
+        content_hash = ModelContentHash(model_info)
+        responder = self._updater.GetResponder(manufacturer_id,
+                                               model_info['device_model'])
+        if responder is not None and responder.content_hash == content_hash:
+          skipped += 1
+          continue
+
         was_added, was_modified = self._updater.UpdateResponder(
-            manufacturer, model_info)
+            manufacturer, model_info, content_hash)
 
         model_description = common.Encode(model_info.get('model_description'))
         if model_description is None:
@@ -70,17 +121,36 @@ class ModelLoader(object):
           added.append(model_description)
         elif was_modified:
           updated.append(model_description)
+      self._updater.Flush()
 
+    logging.info('Skipped %d unchanged models' % skipped)
     return added, updated
 
 
 class ModelUpdater(object):
-  """Load Model definition into the datastore."""
+  """Load Model definition into the datastore.
+
+  The changes are collected in a UnitOfWork, nothing is written until Flush()
+  is called.
+  """
   def __init__(self):
+    self._work = UnitOfWork()
+    # responder key name to Responder object, or None if it doesn't exist
+    self._responders = {}
     # category_id to ProductCategory object
     self._product_categories = {}
     # string to ResponderTag object
     self._tags = {}
+    # (manufacturer_id, model_id, added, removed) for each responder
+    # whose supported parameters changed, see pid_index_builder.py
+    self._pid_deltas = []
+
+  def Flush(self):
+    """Write the changes to the datastore, and update the PID index."""
+    self._work.Flush()
+    if self._pid_deltas:
+      pid_index_builder.ScheduleDeltas(self._pid_deltas)
+      self._pid_deltas = []
 
   def _Encode(self, s):
     """Encode a string that may contain binary data."""
@@ -108,38 +178,62 @@ class ModelUpdater(object):
     Returns:
       The entity object, or None if not found.
     """
-    if tag_label not in self._tags:
-      query = ResponderTag.all()
-      query.filter('label = ', tag_label)
-      tags = query.fetch(1)
-      if tags:
-        self._tags[tag_label] = tags[0]
-      else:
-        tag_entity = ResponderTag(label=tag_label)
-        tag_entity.put()
-        self._tags[tag_label] = tag_entity
+    if self._tags.get(tag_label) is None:
+      key_name = ResponderTagKeyName(tag_label)
+      tag_entity = ResponderTag.get_by_key_name(key_name)
+      if tag_entity is None:
+        tag_entity = ResponderTag(key_name=key_name, label=tag_label)
+        self._work.Put(tag_entity)
         logging.info('added %s -> %s' % (tag_label, tag_entity))
+      self._tags[tag_label] = tag_entity
 
     return self._tags[tag_label]
 
-  def _LookupResponder(self, manufacturer_key, model_id):
-    """Given a manufacturer key and model_id, lookup the Responder entity."""
-    models = Responder.all()
-    models.filter('device_model_id = ', model_id)
-    models.filter('manufacturer = ', manufacturer_key)
+  def _LookupTags(self, tag_labels):
+    """Lookup the ResponderTag entities for a list of labels.
+
+    Returns:
+      A list of the entities, labels without a ResponderTag are skipped.
+    """
+    missing = [label for label in tag_labels if label not in self._tags]
+    if missing:
+      tags = db.get([db.Key.from_path(ResponderTag.kind(),
+                                      ResponderTagKeyName(label))
+                     for label in missing])
+      for label, tag in zip(missing, tags):
+        self._tags[label] = tag
+    return [self._tags[label] for label in tag_labels
+            if self._tags[label] is not None]
+
+  def AddResponders(self, responders):
+    """Add Responder entities that have already been fetched.
+
+    Args:
+      responders: the result of a db.get() for a list of responder keys.
+        Entries which are None are ignored.
+    """
+    for responder in responders:
+      if responder is not None:
+        self._responders[responder.key().name()] = responder
 
-    model_data = models.fetch(1)
-    if not model_data:
-      return None
-    return model_data[0]
+  def GetResponder(self, manufacturer_id, model_id):
+    """Given a manufacturer id and model_id, lookup the Responder entity."""
+    key_name = ResponderKeyName(manufacturer_id, model_id)
+    if key_name not in self._responders:
+      self._responders[key_name] = Responder.get_by_key_name(key_name)
+    return self._responders[key_name]
 
   def _UpdateResponder(self, responder, model_info):
     """Update this responder entity if there is new data.
 
     Returns:
-      True if this entity was updated, false otherwise.
+      A tuple of (modified, complete). modified is True if this entity was
+      updated, complete is False if some of the data couldn't be applied
+      because a lookup failed.
     """
     modified = False
+    complete = True
+    deltas = []
     model_description = self._Encode(model_info.get('model_description'))
     if model_description and model_description != responder.model_description:
       responder.model_description = model_description
@@ -152,11 +246,16 @@ class ModelUpdater(object):
         # requires update
         new_category = self._LookupProductCategory(product_category_id)
         if new_category:
+          if current_category:
+            deltas.append(
+                (counters.CategoryResponders(current_category.id), -1))
+          deltas.append((counters.CategoryResponders(new_category.id), 1))
           responder.product_category = new_category
           modified = True
         else:
           logging.info('No product category found for 0x%hx' %
                        product_category_id)
+          complete = False
 
     # update link url
     link_url = model_info.get('link')
@@ -169,11 +268,13 @@ class ModelUpdater(object):
     if image_url is not None and image_url != responder.image_url:
       responder.image_url = image_url
       responder.image_data = None
+      image_fetcher.ResetFetchState(responder)
       modified = True
 
     if modified:
-      responder.put()
-    return modified
+      self._work.Put(responder)
+      self._work.AddCounterDeltas(deltas)
+    return modified, complete
 
   def _AddResponder(self, manufacturer, model_id, model_info):
     """Add a responder to the data store.
@@ -184,12 +285,19 @@ class ModelUpdater(object):
       model_info: The dict with the responder information
 
     Returns:
-      The new Responder entity.
+      A tuple of (the new Responder entity, complete). complete is False if
+      some of the data couldn't be applied because a lookup failed.
     """
+    complete = True
     responder = Responder(
+        key_name=ResponderKeyName(manufacturer.esta_id, model_id),
         manufacturer=manufacturer,
         device_model_id=model_id,
-        model_description=self._Encode(model_info.get('model_description')))
+        model_description=self._Encode(model_info.get('model_description')),
+        software_version_count=0)
+    deltas = [(counters.PRODUCTS, 1),
+              (counters.RESPONDERS, 1),
+              (counters.ManufacturerResponders(manufacturer.esta_id), 1)]
 
     # add product_category if there is one
     product_category_id = model_info.get('product_category')
@@ -197,9 +305,11 @@ class ModelUpdater(object):
       category = self._LookupProductCategory(product_category_id)
       if category:
         responder.product_category = category
+        deltas.append((counters.CategoryResponders(category.id), 1))
       else:
         logging.info('No product category found for 0x%hx' %
                      product_category_id)
+        complete = False
 
     # add link and image_url if they exist
     link_url = model_info.get('link')
@@ -209,8 +319,9 @@ class ModelUpdater(object):
     if image_url:
       responder.image_url = image_url
 
-    responder.put()
-    return responder
+    self._work.Put(responder)
+    self._work.AddCounterDeltas(deltas)
+    return responder, complete
 
   def _AddSoftwareVersion(self, responder, version_id, version_info):
     """Add a software version to a responder.
@@ -219,22 +330,32 @@ class ModelUpdater(object):
       responder: The Responder entity to update
       version_id: the id of the version
       version_info: the dict with the version information
+
+    Returns:
+      The new SoftwareVersion entity.
     """
-    # create the new version object and store it
-    version_obj = SoftwareVersion(version_id=version_id,
-                                  label=self._Encode(version_info.get('label')),
-                                  responder=responder)
+    # create the new version object and store it. It has a key name so the
+    # personalities & sensors can refer to it before it's written.
+    manufacturer = manufacturer_directory.GetEntityManufacturer(responder)
+    version_obj = SoftwareVersion(
+        key_name=SoftwareVersionKeyName(manufacturer.esta_id,
+                                        responder.device_model_id,
+                                        version_id),
+        version_id=version_id,
+        label=self._Encode(version_info.get('label')),
+        responder=responder)
     supported_params = version_info.get('supported_parameters')
     if supported_params:
       # keep things sorted
       version_obj.supported_parameters = sorted(supported_params)
-    version_obj.put()
+    self._work.Put(version_obj)
 
     personalities = version_info.get('personalities', [])
     self._UpdatePersonalities(version_obj, personalities)
 
     sensors = version_info.get('sensors', [])
     self._UpdateSensors(version_obj, sensors)
+    return version_obj
 
   def _UpdatePersonalities(self, software_version, personalities):
     """Update the personalities for a SoftwareVersion entity.
@@ -261,7 +382,7 @@ class ModelUpdater(object):
           save = True
 
         if save:
-          personality.put()
+          self._work.Put(personality)
           modified = True
         del new_personalities[personality.index]
 
@@ -274,7 +395,7 @@ class ModelUpdater(object):
       if 'slot_count' in personality_info:
         personality.slot_count = personality_info['slot_count']
 
-      personality.put()
+      self._work.Put(personality)
       modified = True
 
     return modified
@@ -314,7 +435,7 @@ class ModelUpdater(object):
             save = True
 
         if save:
-          sensor.put()
+          self._work.Put(sensor)
           modified = True
         del new_sensors[sensor.index]
 
@@ -328,7 +449,7 @@ class ModelUpdater(object):
           supports_min_max_recording=bool(
             sensor_info['supports_recording'] & 2),
           sw_version=software_version)
-      sensor.put()
+      self._work.Put(sensor)
       modified = True
 
     return modified
@@ -347,8 +468,10 @@ class ModelUpdater(object):
     """
     new_versions = set(versions.keys())
     modified = False
+    all_versions = []
 
     for version in responder.software_version_set:
+      all_versions.append(version)
       version_id = version.version_id
       if version_id in new_versions:
         new_version_info = versions[version_id]
@@ -356,7 +479,7 @@ class ModelUpdater(object):
         label = self._Encode(new_version_info.get('label'))
         if label and label != version.label:
           version.label = label
-          version.put()
+          self._work.Put(version)
           modified = True
 
         # update supported_parameters if required
@@ -365,7 +488,7 @@ class ModelUpdater(object):
         if (new_supported_parameters and
             sorted(new_supported_parameters) != sorted(supported_parameters)):
           version.supported_parameters = sorted(new_supported_parameters)
-          version.put()
+          self._work.Put(version)
           modified = True
 
         # update personalities if required
@@ -386,11 +509,108 @@ class ModelUpdater(object):
     for new_version in new_versions:
       logging.info('Adding %d for %s' %
                    (new_version, responder.model_description))
-      self._AddSoftwareVersion(responder, new_version, versions[new_version])
+      all_versions.append(
+          self._AddSoftwareVersion(responder, new_version,
+                                   versions[new_version]))
       modified = True
 
+    self._UpdateLatestSoftware(responder, all_versions)
     return modified
 
+  def _UpdateLatestSoftware(self, responder, versions):
+    """Update the denormalized latest software fields of a responder.
+
+    Args:
+      responder: The Responder entity to update
+      versions: a list of all the SoftwareVersion entities for the responder.
+
+    Returns:
+      True if the responder was modified, false otherwise.
+    """
+    latest = None
+    for version in versions:
+      if latest is None or version.version_id > latest.version_id:
+        latest = version
+
+    latest_key = None
+    supported_parameters = []
+    if latest:
+      latest_key = latest.key()
+      supported_parameters = sorted(int(i) for i in
+                                    latest.supported_parameters)
+
+    current_key = Responder.latest_software.get_value_for_datastore(responder)
+    if (current_key == latest_key and
+        responder.software_version_count == len(versions) and
+        responder.supported_parameters == supported_parameters):
+      return False
+
+    added, removed = pid_index_builder.SupportedParametersDelta(
+        responder.supported_parameters, supported_parameters)
+    if added or removed:
+      manufacturer = manufacturer_directory.GetEntityManufacturer(responder)
+      self._pid_deltas.append(
+          (manufacturer.esta_id, responder.device_model_id, added, removed))
+    responder.latest_software = latest_key
+    responder.software_version_count = len(versions)
+    responder.supported_parameters = supported_parameters
+    self._work.Put(responder)
+    return True
+
+  def UpdateLatestSoftware(self, responder):
+    """Recompute the latest software fields from the software_version_set.
+
+    Returns:
+      True if the responder was modified, false otherwise.
+    """
+    if not self._UpdateLatestSoftware(responder,
+                                      list(responder.software_version_set)):
+      return False
+    self._Rescore(responder)
+    return True
+
+  def _Rescore(self, responder):
+    """Update the score of a responder, if any of its inputs changed."""
+    if ranking.Rescore(responder):
+      self._work.Put(responder)
+
+  def UpdateSearchTokens(self, responder):
+    """Rebuild the search_tokens for a responder.
+
+    Returns:
+      True if the responder was modified, false otherwise.
+    """
+    manufacturer = manufacturer_directory.GetEntityManufacturer(responder)
+    category = responder.product_category
+    tag_labels = [tag.label for tag in self._LookupTags(responder.tags)
+                  if not tag.exclude_from_search]
+    search_tokens = responder_search.IndexTokens(
+        responder.model_description,
+        manufacturer and manufacturer.name,
+        category and category.name,
+        tag_labels)
+    if search_tokens == responder.search_tokens:
+      return False
+
+    responder.search_tokens = search_tokens
+    self._work.Put(responder)
+    return True
+
+  def UpdateTagLabels(self, responder):
+    """Copy the tag labels from the tag_set to the tags property.
+
+    Returns:
+      True if the responder was modified, false otherwise.
+    """
+    labels = sorted(relationship.tag.label
+                    for relationship in responder.tag_set)
+    if labels == responder.tags:
+      return False
+
+    responder.tags = labels
+    self._work.Put(responder)
+    return True
+
   def _UpdateTags(self, responder, new_tags):
     """Update the tags for a responder
 
@@ -401,6 +621,7 @@ class ModelUpdater(object):
     Returns:
       True if the responder was modified, false otherwise.
     """
+    labels = sorted(set(new_tags))
     new_tags = set(new_tags)
     modified = False
 
@@ -411,7 +632,7 @@ class ModelUpdater(object):
       else:
         logging.info('Deleting %s from %s' %
                      (label, responder.model_description))
-        relationship.delete()
+        self._work.Delete(relationship)
         modified = True
 
     for tag_label in new_tags:
@@ -419,14 +640,26 @@ class ModelUpdater(object):
       relationship = ResponderTagRelationship(
           tag=tag_entity,
           responder=responder)
-      relationship.put()
+      self._work.Put(relationship)
       modified = True
 
+    # this also fills in the labels for responders tagged before the tags
+    # property existed.
+    if responder.tags != labels:
+      responder.tags = labels
+      self._work.Put(responder)
+      modified = True
     return modified
 
-  def UpdateResponder(self, manufacturer, model_info):
+  def UpdateResponder(self, manufacturer, model_info, content_hash=None):
     """Add or Update a Responder.
 
+    Args:
+      manufacturer: the Manufacturer entity.
+      model_info: the model dict.
+      content_hash: the ModelContentHash of model_info, or None if model_info
+        isn't the complete data for the responder.
+
     Returns:
       was_added, was_modified
     """
@@ -434,15 +667,17 @@ class ModelUpdater(object):
     was_modified = False
 
     model_id = model_info['device_model']
-    responder = self._LookupResponder(manufacturer.key(), model_id)
+    responder = self.GetResponder(manufacturer.esta_id, model_id)
     if responder:
       # update
-      if self._UpdateResponder(responder, model_info):
+      was_modified, complete = self._UpdateResponder(responder, model_info)
+      if was_modified:
         logging.info(' responder changed')
-        was_modified = True
     else:
       # add a new one
-      responder = self._AddResponder(manufacturer, model_id, model_info)
+      responder, complete = self._AddResponder(manufacturer, model_id,
+                                               model_info)
+      self._responders[responder.key().name()] = responder
       was_added = True
 
     # add software version information
@@ -460,4 +695,18 @@ class ModelUpdater(object):
       if self._UpdateTags(responder, model_info['tags']):
         logging.info(' tag changed')
         was_modified = True
+
+    if was_added or was_modified:
+      self.UpdateSearchTokens(responder)
+      self._Rescore(responder)
+
+    # A partial update (with no content_hash) which changes the responder
+    # clears the hash, so the next full load checks every field. So does a
+    # load where a lookup failed, so it's retried once the data exists.
+    if not complete:
+      content_hash = None
+    if ((content_hash is not None or was_modified or not complete) and
+        responder.content_hash != content_hash):
+      responder.content_hash = content_hash
+      self._work.Put(responder)
     return was_added, was_modified
@@ -19,6 +19,7 @@
 from google.appengine.ext import webapp
 
 import common
+import compression
 
 
 class AboutPageHandler(common.BasePageHandler):
@@ -46,7 +47,7 @@ class PacketExtractorHandler(common.BasePageHandler):
     TEMPLATE = 'templates/packet-extractor.tmpl'
 
 
-app = webapp.WSGIApplication(
+app = compression.GzipMiddleware(webapp.WSGIApplication(
     [
         ('/about', AboutPageHandler),
         ('/contact', AboutPageHandler),
@@ -56,4 +57,4 @@ app = webapp.WSGIApplication(
         ('/tools/packet-builder', PacketBuilderHandler),
         ('/tools/packet-extractor', PacketExtractorHandler)
     ],
-    debug=True)
+    debug=True))
@@ -0,0 +1,146 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# pid_cache.py
+# Copyright (C) 2026 Simon Newton
+# An in-memory cache of PID information.
+
+import collections
+import common
+import logging
+import manufacturer_directory
+import memcache_keys
+import pid_search
+import timestamp_keys
+import versioned_cache
+from model import Pid
+
+ESTA_ID = 0
+
+# What we hold in memory for each PID
+PidSummary = collections.namedtuple(
+    'PidSummary', ['name', 'draft', 'has_get', 'has_set'])
+
+
+class PidNameResolver(object):
+  """Maps (manufacturer_id, pid_id) to PID names.
+
+  The map is held in memory, and rebuilt (from memcache if possible) whenever
+  the PIDS timestamp changes. The name search index is built from the same
+  map, the first time it's needed.
+  """
+  def __init__(self):
+    self._loaded = False
+    self._update_time = None
+    self._pids = {}
+    self._names = {}
+    self._index = None
+
+  def _LoadPids(self):
+    pids = {}
+    for pid in Pid.all():
+      manufacturer = manufacturer_directory.GetEntityManufacturer(pid)
+      pids[(manufacturer.esta_id, pid.pid_id)] = PidSummary(
+          pid.name,
+          pid.draft,
+          Pid.get_command.get_value_for_datastore(pid) is not None,
+          Pid.set_command.get_value_for_datastore(pid) is not None)
+    return pids
+
+  def _MaybeRefresh(self):
+    update_time = common.GetLastUpdateTime(timestamp_keys.PIDS)
+    if self._loaded and update_time == self._update_time:
+      return
+
+    cached = versioned_cache.Get(memcache_keys.PID_SUMMARIES)
+    if cached is not None and cached[0] == update_time:
+      pids = cached[1]
+    else:
+      pids = self._LoadPids()
+      if not versioned_cache.Set(memcache_keys.PID_SUMMARIES,
+                                 (update_time, pids)):
+        logging.error('PID summaries memcache set failed.')
+    self._pids = pids
+    self._names = dict((key, pid.name) for key, pid in pids.iteritems())
+    self._index = None
+    self._update_time = update_time
+    self._loaded = True
+
+  def GetName(self, manufacturer_id, pid_id):
+    """Return the name of a PID, or None if it isn't known."""
+    self._MaybeRefresh()
+    return self._names.get((manufacturer_id, pid_id))
+
+  def ResolveParameters(self, manufacturer_id, params):
+    """Resolve a list of supported parameters.
+
+    Args:
+      manufacturer_id: the ESTA id of the responder's manufacturer, this is
+        used for PIDs in the manufacturer range (0x8000 and above).
+      params: a list of PID values.
+
+    Returns:
+      A list of dicts in the form
+        {'id': <pid_id>, 'manufacturer_id': <id>, 'name': <name>}
+      'name' is omitted if the PID isn't known.
+    """
+    self._MaybeRefresh()
+    output = []
+    for param in params:
+      if param >= 0x8000:
+        pid_manufacturer_id = manufacturer_id
+      else:
+        pid_manufacturer_id = ESTA_ID
+      param_dict = {
+        'id': param,
+        'manufacturer_id': pid_manufacturer_id,
+      }
+      name = self._names.get((pid_manufacturer_id, param))
+      if name is not None:
+        param_dict['name'] = name
+      output.append(param_dict)
+    return output
+
+  def Search(self, query, limit=None):
+    """Search the names of the non-draft PIDs.
+
+    Returns:
+      A list of ((manufacturer_id, pid_id), PidSummary) tuples, best matches
+      first. See pid_search.PidNameIndex.Search.
+    """
+    self._MaybeRefresh()
+    if self._index is None:
+      self._index = pid_search.PidNameIndex(
+          dict((key, pid.name) for key, pid in self._pids.iteritems()
+               if not pid.draft))
+    return [(key, self._pids[key])
+            for key in self._index.Search(query, limit)]
+
+
+_resolver = PidNameResolver()
+
+
+def GetPidName(manufacturer_id, pid_id):
+  """Return the name of a PID, or None if it isn't known."""
+  return _resolver.GetName(manufacturer_id, pid_id)
+
+
+def ResolveParameters(manufacturer_id, params):
+  """See PidNameResolver.ResolveParameters."""
+  return _resolver.ResolveParameters(manufacturer_id, params)
+
+
+def SearchByName(query, limit=None):
+  """See PidNameResolver.Search."""
+  return _resolver.Search(query, limit)
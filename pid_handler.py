@@ -16,12 +16,19 @@
 # Copyright (C) 2011 Simon Newton
 # PID search / display handlers.
 
+import command_messages
 import json
+import manufacturer_directory
 import memcache_keys
 import common
-from model import Manufacturer, Pid, Responder, SUBDEVICE_RANGE_DICT
+import compression
+import counters
+import pid_cache
+import pid_support
+import responder_summaries
+import versioned_cache
+from model import Pid, PidKeyName, SUBDEVICE_RANGE_DICT
 from utils import StringToInt
-from google.appengine.api import memcache
 from google.appengine.ext import webapp
 
 
@@ -48,20 +55,19 @@ class SearchByManufacturer(BaseSearchHandler):
     self._manufacturer_id = StringToInt(self.request.get('manufacturer'))
 
   def GetSearchData(self):
-    manufacturer_list = memcache.get(memcache_keys.MANUFACTURER_PID_COUNTS)
+    manufacturer_list = versioned_cache.Get(memcache_keys.MANUFACTURER_PID_COUNTS)
     if not manufacturer_list:
       manufacturer_list = []
-      query = Manufacturer.all()
-      query.order('name')
-      for manufacturer in query:
-        pids = manufacturer.pid_set.count()
+      counts = counters.GetGroupCounts(counters.PIDS_BY_MANUFACTURER)
+      for manufacturer in manufacturer_directory.AllManufacturers():
+        pids = counts.get(manufacturer.esta_id)
         if pids:
           manufacturer_list.append({
               'id': manufacturer.esta_id,
               'name': manufacturer.name,
               'pid_count': pids,
           })
-      memcache.set(memcache_keys.MANUFACTURER_PID_COUNTS, manufacturer_list)
+      versioned_cache.Set(memcache_keys.MANUFACTURER_PID_COUNTS, manufacturer_list)
 
     return {
         'manufacturers': manufacturer_list,
@@ -70,10 +76,8 @@ class SearchByManufacturer(BaseSearchHandler):
 
   def GetResults(self):
     if self._manufacturer_id is not None:
-      query = Manufacturer.all()
-      query.filter('esta_id = ', self._manufacturer_id)
-
-      for manufacturer in query.fetch(1):
+      manufacturer = common.GetManufacturer(self._manufacturer_id)
+      if manufacturer is not None:
         query = manufacturer.pid_set
         query.filter('draft = ', False)
         query.order('pid_id')
@@ -85,17 +89,28 @@ class SearchByName(BaseSearchHandler):
   """Search by PID name."""
   TEMPLATE = 'templates/name_pid_search.tmpl'
 
+  MAX_RESULTS = 100
+
   def GetResults(self):
     name = self.request.get('name')
-    if name is not None:
-      name = name.strip().replace(' ', '_').upper()
-      # do full string matching for now
-      results = Pid.all()
-      results.filter('draft = ', False)
-      results.filter('name =', name)
-
-      return results
-    return []
+    if not name:
+      return []
+
+    results = []
+    for (manufacturer_id, pid_id), pid in pid_cache.SearchByName(
+        name, self.MAX_RESULTS):
+      manufacturer = manufacturer_directory.GetManufacturer(manufacturer_id)
+      results.append({
+        'manufacturer': {
+          'esta_id': manufacturer_id,
+          'name': manufacturer.name if manufacturer else '',
+        },
+        'pid_id': pid_id,
+        'name': pid.name,
+        'get_command': pid.has_get,
+        'set_command': pid.has_set,
+      })
+    return results
 
 
 class SearchById(BaseSearchHandler):
@@ -124,19 +139,11 @@ class DisplayPid(common.BasePageHandler):
     except ValueError:
       return None
 
-    manufacturer = common.GetManufacturer(self.request.get('manufacturer'))
-    if manufacturer is None or pid_id is None:
+    manufacturer_id = StringToInt(self.request.get('manufacturer'))
+    if manufacturer_id is None or pid_id is None:
       return None
 
-    models = Pid.all()
-    models.filter('pid_id = ', pid_id)
-    models.filter('manufacturer = ', manufacturer.key())
-
-    pid_data = models.fetch(1)
-    if pid_data:
-      return pid_data[0]
-    else:
-      return None
+    return Pid.get_by_key_name(PidKeyName(manufacturer_id, pid_id))
 
   def CopyToDict(self, input_d, output_d, keys):
     for key in keys:
@@ -178,8 +185,7 @@ class DisplayPid(common.BasePageHandler):
       item_output['ranges'] = ranges
     return item_output
 
-  def PopulateMessage(self, message_output, message_str):
-    message_data = eval(message_str)
+  def PopulateMessage(self, message_output, message_data):
     items = []
     for item in message_data['items']:
       item_output = self.PopulateItem(item)
@@ -189,9 +195,9 @@ class DisplayPid(common.BasePageHandler):
 
   def BuildCommand(self, command):
     request = {}
-    self.PopulateMessage(request, command.request)
+    self.PopulateMessage(request, command_messages.Request(command))
     response = {}
-    self.PopulateMessage(response, command.response)
+    self.PopulateMessage(response, command_messages.Response(command))
     command = {
         'request_json': json.dumps(request),
         'response_json': json.dumps(response),
@@ -200,31 +206,50 @@ class DisplayPid(common.BasePageHandler):
     }
     return command
 
+  def GetSupportedBy(self, pid, cursor):
+    """Get a page of the responders which support a PID.
+
+    The page is cached until the PID index or the models change.
+
+    Returns:
+      A tuple of (list of responder dicts, next cursor).
+    """
+    cache_key = memcache_keys.PidSupportedByKey(pid.key().name(), cursor)
+    page = versioned_cache.Get(cache_key)
+    if page is None:
+      responder_ids, next_cursor = pid_support.GetPage(pid.key(), cursor)
+      supported_by = []
+      for summary in responder_summaries.GetSummaries(responder_ids):
+        supported_by.append({
+          'name': summary.name,
+          'manufacturer': summary.manufacturer_id,
+          'model': summary.model_id,
+        })
+      page = (supported_by, next_cursor)
+      versioned_cache.Set(cache_key, page)
+    return page
+
   def GetTemplateData(self):
     pid = self.LookupPIDFromRequest()
     if not pid:
       self.error(404)
       return
 
-    supported_by = []
-    for responder_key in pid.responders:
-      responder = Responder.get(responder_key)
-      if responder:
-        supported_by.append({
-          'name': responder.model_description,
-          'manufacturer': responder.manufacturer.esta_id,
-          'model': responder.device_model_id,
-        })
-    supported_by.sort(key=lambda x: x['name'])
+    cursor = self.request.get('supported_by') or None
+    supported_by, next_cursor = self.GetSupportedBy(pid, cursor)
 
+    manufacturer = manufacturer_directory.GetEntityManufacturer(pid)
     output = {
       'link': pid.link,
-      'manufacturer_name': pid.manufacturer.name,
-      'manufacturer_id': pid.manufacturer.esta_id,
+      'manufacturer_name': manufacturer.name,
+      'manufacturer_id': manufacturer.esta_id,
       'notes': pid.notes,
       'pid_id': pid.pid_id,
       'pid_name': pid.name,
       'supported_by': supported_by,
+      'supported_by_count': pid.responder_count,
+      'supported_by_first': cursor is not None,
+      'supported_by_next': next_cursor,
     }
 
     if pid.get_command:
@@ -241,11 +266,11 @@ class DisplayPid(common.BasePageHandler):
     return output
 
 
-pid_application = webapp.WSGIApplication(
+pid_application = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/pid/manufacturer', SearchByManufacturer),
     ('/pid/name', SearchByName),
     ('/pid/id', SearchById),
     ('/pid/display', DisplayPid),
   ],
-  debug=True)
+  debug=True))
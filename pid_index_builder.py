@@ -16,76 +16,224 @@
 # pid_index_builder.py
 # Copyright (C) 2012 Simon Newton
 # Build the index of PIDs to responders.
+#
+# The index is stored in PidSupport entities, see pid_support.py. The
+# ModelUpdater records a delta whenever the supported parameters of a
+# responder change, and ScheduleDeltas() queues a task which applies them to
+# the affected PIDs. PidIndexBuilder.BuildIndex() rebuilds the whole
+# index, it's run periodically from cron.yaml to correct any drift.
 
-import logging
 import common
-from model import Pid, Responder
+import json
+import logging
+import manufacturer_directory
+import pid_support
+import timestamp_keys
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from model import Pid, PidKeyName, PidSupport, Responder, ResponderKeyName
+from unit_of_work import UnitOfWork
+from update_times import UpdateModificationTime
+
+ESTA_ID = 0
+# PIDs below this are defined by ESTA
+MANUFACTURER_PID_MIN = 0x8000
+
+# The queue, defined in queue.yaml
+QUEUE_NAME = 'pid-index'
+APPLY_DELTAS_URL = '/tasks/apply_pid_deltas'
+# The number of responder deltas in each task
+MAX_DELTAS_PER_TASK = 100
+
+
+def IndexKey(manufacturer_id, pid_id):
+  """Return the (manufacturer_id, pid_id) of the PID a responder supports."""
+  if pid_id < MANUFACTURER_PID_MIN:
+    manufacturer_id = ESTA_ID
+  return (manufacturer_id, pid_id)
+
+
+def SupportedParametersDelta(old_parameters, new_parameters):
+  """Compare two lists of supported parameters.
+
+  Returns:
+    A tuple of (added, removed) sorted lists.
+  """
+  old_parameters = set(old_parameters)
+  new_parameters = set(new_parameters)
+  return (sorted(new_parameters - old_parameters),
+          sorted(old_parameters - new_parameters))
+
+
+def _PidKey(manufacturer_id, pid_id):
+  return db.Key.from_path(Pid.kind(),
+                          PidKeyName(*IndexKey(manufacturer_id, pid_id)))
+
+
+def ScheduleDeltas(deltas):
+  """Queue tasks to apply changes in the responders' supported parameters.
+
+  Args:
+    deltas: a list of (manufacturer_id, model_id, added, removed) tuples.
+  """
+  for i in xrange(0, len(deltas), MAX_DELTAS_PER_TASK):
+    task = taskqueue.Task(
+        url=APPLY_DELTAS_URL,
+        payload=json.dumps(deltas[i:i + MAX_DELTAS_PER_TASK]))
+    task.add(QUEUE_NAME)
+
+
+def ApplyDeltas(deltas):
+  """Apply the deltas passed to ScheduleDeltas().
+
+  The tasks may run out of order, so a PID is only added if the responder
+  still supports it, and only removed if it still doesn't.
+
+  Returns:
+    The number of Pid entities updated.
+  """
+  responder_keys = [
+      db.Key.from_path(Responder.kind(),
+                       ResponderKeyName(manufacturer_id, model_id))
+      for manufacturer_id, model_id, _, _ in deltas]
+  responders = db.get(responder_keys)
+
+  # Pid key -> (set of responder ids to add, set to remove)
+  changes = {}
+  for (manufacturer_id, model_id, added, removed), responder in zip(
+      deltas, responders):
+    responder_id = pid_support.ResponderId(manufacturer_id, model_id)
+    supported = set()
+    if responder is not None:
+      supported = set(common.GetLatestSupportedParameters(responder))
+
+    for param in added:
+      if param in supported:
+        changes.setdefault(_PidKey(manufacturer_id, param),
+                           (set(), set()))[0].add(responder_id)
+    for param in removed:
+      if param not in supported:
+        changes.setdefault(_PidKey(manufacturer_id, param),
+                           (set(), set()))[1].add(responder_id)
+
+  updated = 0
+  for pid_key, (added, removed) in changes.iteritems():
+    if db.run_in_transaction(pid_support.ApplyChanges, pid_key, added,
+                             removed):
+      updated += 1
+  if updated:
+    UpdateModificationTime(timestamp_keys.PID_INDEX)
+  logging.info('Applied %d responder deltas, updated %d PIDs' %
+               (len(deltas), updated))
+  return updated
 
 
 class PidIndexBuilder():
   """We need to be smart about this, my first attempt blew through my write
      budget when I built the index.
+
+  The responder sets are held as bitmaps, with a bit for each responder, so
+  comparing the current and new index is cheap. Only the PIDs whose set
+  changed are written.
   """
   def __init__(self):
+    # (manufacturer_id, pid_id) -> Pid
     self._pid_cache = {}
-    self._esta = common.GetManufacturer(0)
+    # Pid key -> list of PidSupport entities
+    self._shards = {}
+    # responder id -> bit number, and the reverse
+    self._responder_bits = {}
+    self._responder_ids = []
+
+  def _Bit(self, responder_id):
+    bit = self._responder_bits.get(responder_id)
+    if bit is None:
+      bit = len(self._responder_ids)
+      self._responder_bits[responder_id] = bit
+      self._responder_ids.append(responder_id)
+    return 1 << bit
+
+  def _ResponderIds(self, bitmap):
+    """Return the responder ids for the bits set in a bitmap."""
+    responder_ids = set()
+    while bitmap:
+      lowest = bitmap & -bitmap
+      responder_ids.add(self._responder_ids[lowest.bit_length() - 1])
+      bitmap ^= lowest
+    return responder_ids
 
   def LoadCurrentIndex(self):
     """Load the current PID to responder map. Also populates the pid_cache.
 
     Returns:
       A dict in the form {
-        (manufacturer_id, pid_id) : set(responder_keys),
+        (manufacturer_id, pid_id) : responder bitmap,
       }
     """
+    bitmaps = {}
+    for shard in PidSupport.all():
+      pid_key = shard.parent_key()
+      self._shards.setdefault(pid_key, []).append(shard)
+      bitmap = bitmaps.get(pid_key, 0)
+      for responder_id in pid_support.Decode(shard.responders):
+        bitmap |= self._Bit(responder_id)
+      bitmaps[pid_key] = bitmap
+
     index = {}
     for pid in Pid.all():
-      key = (pid.manufacturer.esta_id, pid.pid_id)
-      responders = set()
-      for responder in pid.responders:
-        responders.add(responder)
-      index[key] = responders
+      manufacturer = manufacturer_directory.GetEntityManufacturer(pid)
+      key = (manufacturer.esta_id, pid.pid_id)
+      index[key] = bitmaps.get(pid.key(), 0)
       self._pid_cache[key] = pid
     return index
 
-  def KeyFromPID(self, manufacturer, pid_id):
-    """Determine the key from a manufacturer and pid_id."""
-    if pid_id < 0x8000:
-      manufacturer = self._esta
-    return (manufacturer.esta_id, pid_id)
-
   def BuildIndex(self):
+    """Rebuild the index from the responders, and fix any PIDs that differ.
+
+    Returns:
+      The number of PIDs updated.
+    """
     current_index = self.LoadCurrentIndex()
     new_index = {}
 
     for responder in Responder.all():
-      version = common.GetLatestSoftware(responder)
-      if not version:
-        continue
-      for param in version.supported_parameters:
-        key = self.KeyFromPID(responder.manufacturer, param)
-        pid = self._pid_cache.get(key, None)
-        if not pid:
-          continue
-
-        new_index.setdefault(key, set()).add(responder.key())
-
-    # now diff the old and new
-    for key, responders in new_index.iteritems():
-      if key in current_index:
-        if current_index[key] != responders:
-          logging.info('Responder set changed for %s' % str(key))
-          pid = self._pid_cache[key]
-          pid.responders = list(responders)
-          pid.put()
-        del current_index[key]
-      else:
-        # this should never happen
-        logging.warn('Missing key for %s' % str(key))
-
-    for key, responders in current_index.iteritems():
-      if responders:
-        logging.info('Removed %s' % responders)
-        pid = self._pid_cache[key]
+      manufacturer = manufacturer_directory.GetEntityManufacturer(responder)
+      bit = self._Bit(pid_support.ResponderId(manufacturer.esta_id,
+                                              responder.device_model_id))
+      for param in common.GetLatestSupportedParameters(responder):
+        key = IndexKey(manufacturer.esta_id, param)
+        if key in self._pid_cache:
+          new_index[key] = new_index.get(key, 0) | bit
+
+    work = UnitOfWork()
+    updated = 0
+    for key, current in current_index.iteritems():
+      pid = self._pid_cache[key]
+      new = new_index.get(key, 0)
+      responder_ids = self._ResponderIds(new)
+      if pid.responders:
+        # from before the index was stored in PidSupport
         pid.responders = []
-        pid.put()
+        work.Put(pid)
+      if pid.responder_count != len(responder_ids):
+        pid.responder_count = len(responder_ids)
+        work.Put(pid)
+      if new == current:
+        continue
+
+      added = new & ~current
+      removed = current & ~new
+      logging.info('Responder set changed for %s: +%d -%d' %
+                   (str(key), bin(added).count('1'), bin(removed).count('1')))
+      puts, deletes = pid_support.UpdateShards(
+          pid.key(), self._shards.get(pid.key(), []), responder_ids)
+      for shard in puts:
+        work.Put(shard)
+      for shard in deletes:
+        work.Delete(shard)
+      updated += 1
+    work.Flush()
+    if updated:
+      UpdateModificationTime(timestamp_keys.PID_INDEX)
+    logging.info('PID index check updated %d PIDs' % updated)
+    return updated
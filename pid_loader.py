@@ -17,9 +17,11 @@
 # Copyright (C) 2011 Simon Newton
 # Load PID data.
 
+import command_messages
 import common
+import counters
 import logging
-from model import Command, Pid
+from model import Command, Pid, PidKeyName
 
 
 class UnknownManufacturerException(Exception):
@@ -28,6 +30,7 @@ class UnknownManufacturerException(Exception):
 
 class PidLoader():
   """Load pids."""
+  ESTA_ID = 0
 
   def LookupPid(self, pid_id, manufacturer_id):
     """
@@ -40,15 +43,8 @@ class PidLoader():
     if manufacturer is None:
       raise UnknownManufacturerException(manufacturer_id)
 
-    pid_query = Pid.all()
-    pid_query.filter('pid_id = ', pid_id)
-    pid_query.filter('manufacturer = ', manufacturer.key())
-
-    result_set = pid_query.fetch(1)
-    if result_set:
-      return manufacturer, result_set[0]
-    else:
-      return manufacturer, None
+    pid = Pid.get_by_key_name(PidKeyName(manufacturer.esta_id, pid_id))
+    return manufacturer, pid
 
   def UpdateCommand(self, pid, new_pid_data, command_type):
     """Update a command if required.
@@ -75,14 +71,9 @@ class PidLoader():
         existing_command.sub_device_range = new_pid_data[sub_device_attr]
         save = True
 
-      request = new_pid_data.get(request_attr)
-      if eval(existing_command.request) != request:
-        existing_command.request = str(request)
-        save = True
-
-      response = new_pid_data.get(response_attr)
-      if eval(existing_command.response) != response:
-        existing_command.response = str(response)
+      if command_messages.SetMessages(existing_command,
+                                      new_pid_data.get(request_attr),
+                                      new_pid_data.get(response_attr)):
         save = True
 
       if save:
@@ -100,9 +91,10 @@ class PidLoader():
       return True
 
     elif has_command:
-      command = Command(sub_device_range=new_pid_data[sub_device_attr],
-                        request=str(new_pid_data.get(request_attr)),
-                        response=str(new_pid_data.get(response_attr)))
+      command = Command(sub_device_range=new_pid_data[sub_device_attr])
+      command_messages.SetMessages(command,
+                                   new_pid_data.get(request_attr),
+                                   new_pid_data.get(response_attr))
       command.put()
       setattr(pid, command_attr, command)
       logging.info('Set %s:%s' %
@@ -124,9 +116,15 @@ class PidLoader():
     """
     manufacturer, pid = self.LookupPid(new_pid_data['value'], manufacturer_id)
     save = False
+    deltas = []
 
     if not pid:
-      pid = Pid(manufacturer=manufacturer,
+      deltas.append((counters.ManufacturerPids(manufacturer.esta_id), 1))
+      if manufacturer.esta_id != self.ESTA_ID:
+        deltas.append((counters.MANUFACTURER_PIDS, 1))
+      pid = Pid(key_name=PidKeyName(manufacturer.esta_id,
+                                    new_pid_data['value']),
+                manufacturer=manufacturer,
                 pid_id=new_pid_data['value'],
                 name=new_pid_data['name'])
 
@@ -148,5 +146,5 @@ class PidLoader():
 
     if save:
       logging.info('Updated %s' % new_pid_data['name'])
-      pid.put()
+      counters.RunInTransaction(pid.put, deltas)
     return save
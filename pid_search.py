@@ -0,0 +1,175 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# pid_search.py
+# Copyright (C) 2026 Simon Newton
+# An in-memory index for searching PID names.
+
+import bisect
+import re
+
+ESTA_ID = 0
+
+# How a name matched a query, best first
+EXACT, WORD_PREFIX, PREFIX, TOKEN, TOKEN_PREFIX, SUBSTRING = range(6)
+
+# Substring matches use an index of the n-grams in each name
+NGRAM_SIZE = 3
+
+_SEPARATORS = re.compile(r'[\s_\-]+')
+
+
+def Normalize(name):
+  """Convert a name or query to the form used in the index.
+
+  PID names are upper case with words separated by underscores, e.g.
+  DMX_START_ADDRESS.
+  """
+  return '_'.join(token for token in _SEPARATORS.split(name.upper()) if token)
+
+
+def _Tokens(name):
+  return [token for token in name.split('_') if token]
+
+
+def _NGrams(name):
+  return set(name[i:i + NGRAM_SIZE]
+             for i in xrange(len(name) - NGRAM_SIZE + 1))
+
+
+def _PrefixRange(sorted_items, prefix):
+  """Return the slice of a sorted list of (string, ...) which start with prefix.
+  """
+  start = bisect.bisect_left(sorted_items, (prefix,))
+  # \uffff sorts after every character used in a PID name
+  end = bisect.bisect_left(sorted_items, (prefix + u'\uffff',), start)
+  return sorted_items[start:end]
+
+
+class PidNameIndex(object):
+  """Searches PID names by prefix, token and substring.
+
+  Args:
+    names: a dict of (manufacturer_id, pid_id) : name.
+  """
+  def __init__(self, names):
+    self._names = {}
+    # sorted (name, key) tuples, for prefix matches
+    self._sorted_names = []
+    # token -> set of keys
+    self._tokens = {}
+    # ngram -> set of keys
+    self._ngrams = {}
+
+    for key, name in names.iteritems():
+      if not name:
+        continue
+      name = Normalize(name)
+      self._names[key] = name
+      self._sorted_names.append((name, key))
+      for token in _Tokens(name):
+        self._tokens.setdefault(token, set()).add(key)
+      for ngram in _NGrams(name):
+        self._ngrams.setdefault(ngram, set()).add(key)
+    self._sorted_names.sort()
+    self._sorted_tokens = sorted((token,) for token in self._tokens)
+
+  def __len__(self):
+    return len(self._names)
+
+  def _PrefixMatches(self, query):
+    return set(key for name, key in _PrefixRange(self._sorted_names, query))
+
+  def _TokenPrefixMatches(self, query_tokens):
+    """Keys where every query token is the prefix of one of the name tokens."""
+    matches = None
+    for query_token in query_tokens:
+      keys = set()
+      for (token,) in _PrefixRange(self._sorted_tokens, query_token):
+        keys.update(self._tokens[token])
+      if matches is None:
+        matches = keys
+      else:
+        matches &= keys
+      if not matches:
+        break
+    return matches or set()
+
+  def _SubstringMatches(self, query):
+    if len(query) < NGRAM_SIZE:
+      return set(key for key, name in self._names.iteritems() if query in name)
+
+    candidates = None
+    for ngram in sorted(_NGrams(query),
+                        key=lambda n: len(self._ngrams.get(n, ()))):
+      keys = self._ngrams.get(ngram)
+      if not keys:
+        return set()
+      if candidates is None:
+        candidates = set(keys)
+      else:
+        candidates &= keys
+    return set(key for key in candidates if query in self._names[key])
+
+  def _MatchType(self, name, query, query_tokens):
+    if name == query:
+      return EXACT
+    if name.startswith(query + '_'):
+      return WORD_PREFIX
+    if name.startswith(query):
+      return PREFIX
+    name_tokens = _Tokens(name)
+    if all(query_token in name_tokens for query_token in query_tokens):
+      return TOKEN
+    if all(any(token.startswith(query_token) for token in name_tokens)
+           for query_token in query_tokens):
+      return TOKEN_PREFIX
+    return SUBSTRING
+
+  def Search(self, query, limit=None):
+    """Find the PIDs whose names match a query.
+
+    Args:
+      query: the text to search for, case and separators are ignored.
+      limit: the maximum number of results to return, or None for all of them.
+
+    Returns:
+      A list of (manufacturer_id, pid_id) keys, best matches first. The
+      matches are ordered: exact, prefixes which end on a word boundary,
+      other prefixes, names containing every query word, names with a word
+      starting with each query word, and finally substrings. Within each
+      group ESTA PIDs are listed before manufacturer ones, and shorter names
+      before longer ones.
+    """
+    query = Normalize(query)
+    if not query:
+      return []
+    query_tokens = _Tokens(query)
+
+    matches = self._PrefixMatches(query)
+    matches.update(self._TokenPrefixMatches(query_tokens))
+    matches.update(self._SubstringMatches(query))
+
+    def SortKey(key):
+      name = self._names[key]
+      return (self._MatchType(name, query, query_tokens),
+              key[0] != ESTA_ID,
+              len(name),
+              name,
+              key)
+
+    results = sorted(matches, key=SortKey)
+    if limit is not None:
+      results = results[:limit]
+    return results
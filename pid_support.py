@@ -0,0 +1,176 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# pid_support.py
+# Copyright (C) 2026 Simon Newton
+# The responders which support each PID.
+#
+# The responders are stored in PidSupport entities, which are children of the
+# Pid. Each one holds a bucket of responders, as a sorted string of packed
+# responder ids. A responder id is the manufacturer's esta_id in the top 16
+# bits and the device model id in the lower 16 bits, and the bucket is chosen
+# by manufacturer, so the responders are ordered by manufacturer & model
+# across the buckets.
+
+import struct
+from google.appengine.ext import db
+from model import PidSupport, PidSupportKeyName
+
+# Each bucket holds 2 ** (BUCKET_SHIFT - 16) manufacturers
+BUCKET_SHIFT = 26
+ID_SIZE = 4
+PAGE_SIZE = 50
+
+
+def ResponderId(manufacturer_id, model_id):
+  """Return the responder id for a (manufacturer_id, model_id)."""
+  return (manufacturer_id << 16) | model_id
+
+
+def SplitResponderId(responder_id):
+  """Return the (manufacturer_id, model_id) of a responder id."""
+  return responder_id >> 16, responder_id & 0xffff
+
+
+def Bucket(responder_id):
+  return responder_id >> BUCKET_SHIFT
+
+
+def Encode(responder_ids):
+  """Pack a sorted list of responder ids."""
+  return struct.pack('>%dI' % len(responder_ids), *responder_ids)
+
+
+def Decode(data):
+  """Unpack the responder ids of a PidSupport."""
+  if not data:
+    return []
+  return list(struct.unpack('>%dI' % (len(data) // ID_SIZE), data))
+
+
+def ShardKey(pid_key, bucket):
+  return db.Key.from_path(PidSupport.kind(), PidSupportKeyName(bucket),
+                          parent=pid_key)
+
+
+def UpdateShards(pid_key, shards, responder_ids):
+  """Work out the writes needed to store a set of responders.
+
+  Args:
+    pid_key: the key of the Pid.
+    shards: the existing PidSupport entities for the buckets which
+      responder_ids covers.
+    responder_ids: the set of responder ids.
+
+  Returns:
+    A tuple of (PidSupport entities to put, PidSupport entities to delete).
+  """
+  buckets = {}
+  for responder_id in responder_ids:
+    buckets.setdefault(Bucket(responder_id), []).append(responder_id)
+
+  existing = dict((shard.bucket, shard) for shard in shards)
+  puts = []
+  for bucket, bucket_ids in buckets.iteritems():
+    data = Encode(sorted(bucket_ids))
+    shard = existing.pop(bucket, None)
+    if shard is None:
+      shard = PidSupport(parent=pid_key, key_name=PidSupportKeyName(bucket),
+                         bucket=bucket)
+    elif shard.responders == data:
+      continue
+    shard.responders = data
+    shard.count = len(bucket_ids)
+    puts.append(shard)
+  return puts, existing.values()
+
+
+def ApplyChanges(pid_key, added, removed):
+  """Add and remove responders from a PID.
+
+  This should be run in a transaction.
+
+  Args:
+    pid_key: the key of the Pid.
+    added: a set of responder ids to add.
+    removed: a set of responder ids to remove.
+
+  Returns:
+    True if the PID was updated, False otherwise.
+  """
+  buckets = sorted(set(Bucket(responder_id)
+                       for responder_id in added | removed))
+  entities = db.get([pid_key] + [ShardKey(pid_key, b) for b in buckets])
+  pid = entities[0]
+  if pid is None:
+    # we only index PIDs we know about
+    return False
+  shards = [shard for shard in entities[1:] if shard is not None]
+
+  current = set()
+  for shard in shards:
+    current.update(Decode(shard.responders))
+  new = (current | added) - removed
+  if new == current:
+    return False
+
+  puts, deletes = UpdateShards(pid_key, shards, new)
+  pid.responder_count = (pid.responder_count or 0) + len(new) - len(current)
+  db.put(puts + [pid])
+  if deletes:
+    db.delete(deletes)
+  return True
+
+
+def _ParseCursor(cursor):
+  try:
+    bucket, offset = cursor.split(':')
+    return max(int(bucket), 0), max(int(offset), 0)
+  except (AttributeError, ValueError):
+    return 0, 0
+
+
+def GetPage(pid_key, cursor=None, page_size=PAGE_SIZE):
+  """Get a page of the responders which support a PID.
+
+  Only the buckets the page covers are read.
+
+  Args:
+    pid_key: the key of the Pid.
+    cursor: the cursor returned by the previous page, or None for the first
+      page.
+    page_size: the number of responders in a page.
+
+  Returns:
+    A tuple of (list of responder ids, next cursor). The next cursor is None
+    if this is the last page.
+  """
+  bucket, offset = _ParseCursor(cursor)
+  query = PidSupport.all().ancestor(pid_key)
+  query.filter('__key__ >=', ShardKey(pid_key, bucket))
+  query.order('__key__')
+
+  responder_ids = []
+  for shard in query.run(batch_size=4):
+    if len(responder_ids) == page_size:
+      # there's at least one more bucket
+      return responder_ids, '%d:0' % shard.bucket
+    if shard.bucket != bucket:
+      offset = 0
+    end = offset + page_size - len(responder_ids)
+    shard_ids = Decode(shard.responders)
+    responder_ids.extend(shard_ids[offset:end])
+    if end < len(shard_ids):
+      return responder_ids, '%d:%d' % (shard.bucket, end)
+  return responder_ids, None
@@ -17,10 +17,16 @@
 # Product search / display handlers
 
 import common
+import compression
+import counters
 import logging
+import manufacturer_directory
+import timestamp_keys
 from model import Controller, Node, ProductTag, Software, Splitter
+from model import ProductTagKeyName
 from utils import StringToInt
 from google.appengine.api import images
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 
 
@@ -28,51 +34,58 @@ class BrowseProducts(common.BasePageHandler):
   """Show products & pictures.
 
   The sub class products a ProductType() method which tells us what model class
-  to use.
+  to use, and a TimestampKey() method which returns the timestamp_keys section
+  for the products.
   """
   TEMPLATE = 'templates/browse_products.tmpl'
   ROWS = 4
   COLUMNS = 4
   RESULTS_PER_PAGE = ROWS * COLUMNS
 
+  def _FetchPage(self, query, listing, page):
+    product_type = self.ProductType().class_name().lower()
+    return common.FetchPage(query, '%s:%s' % (product_type, listing),
+                            [self.TimestampKey()], page,
+                            self.RESULTS_PER_PAGE, self.request.get('cursor'))
+
   def GetAll(self, page):
     """
     Returns:
-      count, products
+      count, products, previous_cursor, next_cursor
     """
     query = self.ProductType().all()
     query.order('-image_url')
-    total = query.count()
-    products = query.fetch(limit=self.RESULTS_PER_PAGE,
-                           offset=page * self.RESULTS_PER_PAGE)
-    return total, products
+    total = counters.GetCount(counters.ProductTypeCount(self.ProductType()))
+    products, previous_cursor, next_cursor = self._FetchPage(query, 'all', page)
+    return total, products, previous_cursor, next_cursor
 
   def FilterByTag(self, page, tag):
-    query = ProductTag.all()
-    query.filter('label = ', tag)
-    query.filter('product_type = ', self.ProductType().class_name())
-    tags = query.fetch(1)
-
-    if not tags:
-      return 0, []
+    tag_key = db.Key.from_path(
+        ProductTag.kind(),
+        ProductTagKeyName(self.ProductType().class_name(), tag))
+    query = self.ProductType().all()
+    query.filter('tags = ', tag)
+    query.order('-image_url')
+    products, previous_cursor, next_cursor = self._FetchPage(
+        query, 'tag:%s' % tag, page)
 
-    query = tags[0].product_set
-    total = query.count()
-    tag_relationships = query.fetch(limit=self.RESULTS_PER_PAGE,
-                                    offset=(page * self.RESULTS_PER_PAGE))
-    return total, [r.product for r in tag_relationships]
+    # the counter is only used for the total, since it's zero until the
+    # counters have been recounted, and can drift
+    total = max(counters.GetCount(counters.TagProducts(tag_key)),
+                page * self.RESULTS_PER_PAGE + len(products))
+    return total, products, previous_cursor, next_cursor
 
   def FilterByManufacturer(self, page, manufacturer):
     manufacturer_id = StringToInt(manufacturer)
     manufacturer = common.GetManufacturer(manufacturer_id)
     if manufacturer is None:
-      return 0, []
+      return 0, [], None, None
 
     query = self.ProductType().all()
     query.filter('manufacturer = ', manufacturer.key())
     query.order('name')
-    total = query.count()
-    return total, query.fetch(None)
+    products = query.fetch(None)
+    return len(products), products, None, None
 
   def GetTemplateData(self):
     page = StringToInt(self.request.get('page'), False)
@@ -86,18 +99,18 @@ class BrowseProducts(common.BasePageHandler):
       'product_type': self.ProductType().class_name().lower(),
     }
 
-    total = 0
-    products = []
     tag = self.request.get('tag')
     manufacturer = self.request.get('manufacturer')
     if tag:
       data['tag'] = tag
-      total, products = self.FilterByTag(page, tag)
+      total, products, previous_cursor, next_cursor = self.FilterByTag(
+          page, tag)
     elif manufacturer:
       data['manufacturer'] = manufacturer
-      total, products = self.FilterByManufacturer(page, manufacturer)
+      total, products, previous_cursor, next_cursor = (
+          self.FilterByManufacturer(page, manufacturer))
     else:
-      total, products = self.GetAll(page)
+      total, products, previous_cursor, next_cursor = self.GetAll(page)
 
     data['total'] = total
     rows = []
@@ -126,8 +139,10 @@ class BrowseProducts(common.BasePageHandler):
 
     if page:
       data['previous'] = page
+      data['previous_cursor'] = previous_cursor
     if start + len(products) < total:
       data['next'] = page + 2
+      data['next_cursor'] = next_cursor
     return data
 
 
@@ -161,19 +176,18 @@ class DisplayProduct(common.BasePageHandler):
 
     self.response.headers['Content-Type'] = 'text/plain'
 
+    manufacturer = manufacturer_directory.GetEntityManufacturer(product)
     output = {
       'name': product.name,
-      'manufacturer': product.manufacturer.name,
-      'manufacturer_id': product.manufacturer.esta_id,
+      'manufacturer': manufacturer.name,
+      'manufacturer_id': manufacturer.esta_id,
     }
     # link is optional
     if product.link:
       output['link'] = product.link
 
-    # tags
-    for tag in product.tag_set:
-      tags = output.setdefault('tags', [])
-      tags.append(tag.tag.label)
+    if product.tags:
+      output['tags'] = product.tags
 
     if product.image_data:
       serving_url = product.image_serving_url
@@ -192,6 +206,9 @@ class BrowseController(BrowseProducts):
   def ProductType(self):
     return Controller
 
+  def TimestampKey(self):
+    return timestamp_keys.CONTROLLERS
+
 
 class DisplayController(DisplayProduct):
   def ProductType(self):
@@ -203,6 +220,9 @@ class BrowseNodes(BrowseProducts):
   def ProductType(self):
     return Node
 
+  def TimestampKey(self):
+    return timestamp_keys.NODES
+
 
 class DisplayNode(DisplayProduct):
   def ProductType(self):
@@ -214,6 +234,9 @@ class BrowseSoftware(BrowseProducts):
   def ProductType(self):
     return Software
 
+  def TimestampKey(self):
+    return timestamp_keys.SOFTWARE
+
 
 class DisplaySoftware(DisplayProduct):
   def ProductType(self):
@@ -225,13 +248,16 @@ class BrowseSplitters(BrowseProducts):
   def ProductType(self):
     return Splitter
 
+  def TimestampKey(self):
+    return timestamp_keys.SPLITTERS
+
 
 class DisplaySplitters(DisplayProduct):
   def ProductType(self):
     return Splitter
 
 
-app = webapp.WSGIApplication(
+app = compression.GzipMiddleware(webapp.WSGIApplication(
   [
     ('/controller/browse', BrowseController),
     ('/controller/display', DisplayController),
@@ -242,4 +268,4 @@ app = webapp.WSGIApplication(
     ('/splitter/browse', BrowseSplitters),
     ('/splitter/display', DisplaySplitters),
   ],
-  debug=True)
+  debug=True))
@@ -17,15 +17,23 @@
 # Loads product data
 
 import common
+import counters
+import image_fetcher
 import logging
-from model import ProductTag, ProductTagRelationship
+from model import ProductTag, ProductTagRelationship, ProductKeyName, ProductTagKeyName
+from unit_of_work import UnitOfWork
 
 
 class ProductLoader(object):
-  """Load Product definition into the datastore."""
+  """Load Product definition into the datastore.
+
+  The changes for each manufacturer are collected in a UnitOfWork and written
+  together.
+  """
   def __init__(self, data, product_type):
     self._product_data = data
     self._product_type = product_type
+    self._work = UnitOfWork()
     # manufacturer_id to Manufacturer object
     self._manufacturers = {}
     # string to ProductTag objects
@@ -49,18 +57,16 @@ class ProductLoader(object):
       The entity object, or None if not found.
     """
     if tag_label not in self._tags:
-      query = ProductTag.all()
-      query.filter('label = ', tag_label)
-      query.filter('product_type = ', self._product_type.class_name())
-      tags = query.fetch(1)
-      if tags:
-        self._tags[tag_label] = tags[0]
-      else:
-        tag_entity = ProductTag(label=tag_label,
-                                product_type=self._product_type.class_name())
-        tag_entity.put()
-        self._tags[tag_label] = tag_entity
+      product_type = self._product_type.class_name()
+      key_name = ProductTagKeyName(product_type, tag_label)
+      tag_entity = ProductTag.get_by_key_name(key_name)
+      if tag_entity is None:
+        tag_entity = ProductTag(key_name=key_name,
+                                label=tag_label,
+                                product_type=product_type)
+        self._work.Put(tag_entity)
         logging.info('added %s -> %s' % (tag_label, tag_entity))
+      self._tags[tag_label] = tag_entity
 
     return self._tags[tag_label]
 
@@ -98,10 +104,11 @@ class ProductLoader(object):
     if image_url is not None and image_url != product.image_url:
       product.image_url = image_url
       product.image_data = None
+      image_fetcher.ResetFetchState(product)
       modified = True
 
     if modified:
-      product.put()
+      self._work.Put(product)
     return modified
 
   def _AddProduct(self, manufacturer, product_info):
@@ -114,7 +121,12 @@ class ProductLoader(object):
     Returns:
       The new Product entity.
     """
+    # the key name lets the tag relationships refer to the product before it's
+    # written.
     product = self._product_type(
+        key_name=ProductKeyName(self._product_type.class_name(),
+                                manufacturer.esta_id,
+                                product_info['name']),
         manufacturer=manufacturer,
         name=product_info['name'])
 
@@ -126,7 +138,10 @@ class ProductLoader(object):
     if image_url:
       product.image_url = image_url
 
-    product.put()
+    self._work.Put(product)
+    self._work.AddCounterDeltas(
+        [(counters.PRODUCTS, 1),
+         (counters.ProductTypeCount(self._product_type), 1)])
     return product
 
   def _UpdateTags(self, product, new_tags):
@@ -139,6 +154,7 @@ class ProductLoader(object):
     Returns:
       True if the product was modified, false otherwise.
     """
+    labels = sorted(set(new_tags))
     new_tags = set(new_tags)
     modified = False
 
@@ -148,7 +164,9 @@ class ProductLoader(object):
         new_tags.remove(label)
       else:
         logging.info('Deleting %s from %s' % (label, product.name))
-        relationship.delete()
+        self._work.Delete(relationship)
+        self._work.AddCounterDeltas(
+            [(counters.TagProducts(relationship.tag.key()), -1)])
         modified = True
 
     for tag_label in new_tags:
@@ -156,9 +174,17 @@ class ProductLoader(object):
       relationship = ProductTagRelationship(
           tag=tag_entity,
           product=product)
-      relationship.put()
+      self._work.Put(relationship)
+      self._work.AddCounterDeltas(
+          [(counters.TagProducts(tag_entity.key()), 1)])
       modified = True
 
+    # this also fills in the labels for products tagged before the tags
+    # property existed.
+    if product.tags != labels:
+      product.tags = labels
+      self._work.Put(product)
+      modified = True
     return modified
 
   def Update(self):
@@ -204,5 +230,6 @@ class ProductLoader(object):
           added.append(name)
         elif was_modified:
           updated.append(name)
+      self._work.Flush()
 
     return added, updated
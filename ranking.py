@@ -0,0 +1,89 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# ranking.py
+# Copyright (C) 2026 Simon Newton
+# Rank the devices according to a simple scoring algorithm.
+#
+# The score only depends on fields of the Responder, so it's updated inline
+# whenever one of them changes. RankAll() rescores every responder, it's a
+# safety net for responders which were changed some other way.
+
+import logging
+from model import Responder
+from unit_of_work import UnitOfWork
+
+# Points for having an image
+IMAGE_POINTS = 10
+# Points for having a link
+LINK_POINTS = 1
+# Points for having version information
+SOFTWARE_POINTS = 10
+# The test rating is 0 - 100, this gives up to 20 points
+RATING_DIVISOR = 5
+
+
+def _HasSoftware(responder):
+  if responder.software_version_count is not None:
+    return responder.software_version_count > 0
+  # not denormalized yet
+  return responder.software_version_set.count(1) > 0
+
+
+def Score(responder):
+  """Compute the score of a responder."""
+  score = 0
+  if Responder.image_data.get_value_for_datastore(responder) is not None:
+    score += IMAGE_POINTS
+  if responder.link is not None:
+    score += LINK_POINTS
+  if _HasSoftware(responder):
+    score += SOFTWARE_POINTS
+
+  if responder.score_penalty:
+    score -= responder.score_penalty
+
+  if responder.rdm_responder_rating is not None:
+    score += int(responder.rdm_responder_rating / RATING_DIVISOR)
+  return score
+
+
+def Rescore(responder):
+  """Update the score of a responder, this doesn't save it.
+
+  Returns:
+    True if the score changed, False otherwise.
+  """
+  score = Score(responder)
+  if score == responder.score:
+    return False
+  responder.score = score
+  return True
+
+
+def RankAll():
+  """Rescore every responder, and write the ones whose score changed.
+
+  Returns:
+    The number of responders updated.
+  """
+  work = UnitOfWork()
+  updated = 0
+  for responder in Responder.all().run(batch_size=500):
+    if Rescore(responder):
+      work.Put(responder)
+      updated += 1
+  work.Flush()
+  logging.info('Ranked devices, %d scores changed' % updated)
+  return updated
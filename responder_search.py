@@ -0,0 +1,168 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# responder_search.py
+# Copyright (C) 2026 Simon Newton
+# Text search over the responders.
+#
+# Each Responder has a search_tokens list, which holds the normalized tokens
+# from the model description, manufacturer name, product category & tags,
+# along with the prefixes of each token. This is the inverted index: the
+# datastore finds the responders which have every query token, and we rank
+# the candidates in memory.
+
+import common
+import re
+import unicodedata
+from google.appengine.ext import db
+from model import Responder
+
+# Prefixes shorter than this aren't indexed
+MIN_PREFIX_LENGTH = 2
+# Longer tokens are truncated
+MAX_TOKEN_LENGTH = 20
+# Each query token is a datastore filter, so limit the number we use
+MAX_QUERY_TOKENS = 5
+# The number of candidates to rank. For a single token query these are the
+# matches with the highest score.
+MAX_CANDIDATES = 200
+
+# How much a match in each field is worth
+DESCRIPTION_WEIGHT = 4
+MANUFACTURER_WEIGHT = 2
+CATEGORY_WEIGHT = 1
+TAG_WEIGHT = 1
+# A whole token match is worth this much more than a prefix match
+EXACT_MATCH_MULTIPLIER = 2
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def Tokenize(text):
+  """Split text into normalized tokens.
+
+  Text is lower cased and accents are removed, anything other than letters and
+  numbers separates tokens.
+  """
+  if not text:
+    return []
+  if not isinstance(text, unicode):
+    text = text.decode('utf-8', 'replace')
+  text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore')
+  return [token[:MAX_TOKEN_LENGTH] for token in _TOKEN_RE.findall(text.lower())]
+
+
+def IndexTokens(description, manufacturer_name, category_name, tag_labels):
+  """Build the search_tokens for a responder.
+
+  Returns:
+    A sorted list of the tokens, and the prefixes of each token.
+  """
+  tokens = set()
+  for text in [description, manufacturer_name, category_name] + tag_labels:
+    for token in Tokenize(text):
+      for length in xrange(MIN_PREFIX_LENGTH, len(token)):
+        tokens.add(token[:length])
+      tokens.add(token)
+  return sorted(tokens)
+
+
+def _MatchScore(query_token, field_tokens, weight):
+  score = 0
+  for token in field_tokens:
+    if token == query_token:
+      return weight * EXACT_MATCH_MULTIPLIER
+    if token.startswith(query_token):
+      score = weight
+  return score
+
+
+def Score(query_tokens, responder, category_name):
+  """Score how well a candidate responder matches a query.
+
+  Each query token scores for the best field it matches. The candidates all
+  matched the index, so a token which doesn't match the description,
+  manufacturer or category must have matched one of the tags.
+  """
+  manufacturer = responder.manufacturer
+  fields = [
+      (Tokenize(responder.model_description), DESCRIPTION_WEIGHT),
+      (Tokenize(getattr(manufacturer, 'name', None)), MANUFACTURER_WEIGHT),
+      (Tokenize(category_name), CATEGORY_WEIGHT),
+  ]
+  score = 0
+  for query_token in query_tokens:
+    score += max([_MatchScore(query_token, field_tokens, weight)
+                  for field_tokens, weight in fields] + [TAG_WEIGHT])
+  return score
+
+
+def Search(query, limit=None):
+  """Search the responders.
+
+  Args:
+    query: the text to search for.
+    limit: the maximum number of results, or None for all of them.
+
+  The ranking needs the responders themselves, so only a bounded number of
+  candidates are ranked. For a single token these are the MAX_CANDIDATES
+  matches with the highest ranking score, which needs the
+  (search_tokens, -score) composite index. Queries with more tokens use a
+  merge join, which can't be sorted without an index per number of tokens,
+  so they rank the first MAX_CANDIDATES matches in key order and may miss
+  matches past that, though requiring every token makes them far less
+  common.
+
+  Returns:
+    A list of Responder entities, the best matches first. Responders with the
+    same score are ordered by their ranking score.
+  """
+  query_tokens = []
+  for token in Tokenize(query):
+    if len(token) >= MIN_PREFIX_LENGTH and token not in query_tokens:
+      query_tokens.append(token)
+  query_tokens = query_tokens[:MAX_QUERY_TOKENS]
+  if not query_tokens:
+    return []
+
+  if len(query_tokens) == 1:
+    datastore_query = Responder.all()
+    datastore_query.filter('search_tokens = ', query_tokens[0])
+    datastore_query.order('-score')
+    candidates = datastore_query.fetch(MAX_CANDIDATES)
+  else:
+    datastore_query = Responder.all(keys_only=True)
+    for token in query_tokens:
+      datastore_query.filter('search_tokens = ', token)
+    keys = datastore_query.fetch(MAX_CANDIDATES)
+    candidates = []
+    for i in xrange(0, len(keys), common.MAX_BATCH_GET):
+      candidates.extend(responder for responder in
+                        db.get(keys[i:i + common.MAX_BATCH_GET])
+                        if responder is not None)
+  candidates = common.PrefetchReferences(candidates,
+                                         Responder.manufacturer,
+                                         Responder.product_category)
+
+  scored = []
+  for responder in candidates:
+    category = responder.product_category
+    score = Score(query_tokens, responder, category and category.name)
+    scored.append(((-score, -(responder.score or 0),
+                    responder.model_description), responder))
+  scored.sort(key=lambda item: item[0])
+  results = [responder for _, responder in scored]
+  if limit is not None:
+    results = results[:limit]
+  return results
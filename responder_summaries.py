@@ -0,0 +1,63 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# responder_summaries.py
+# Copyright (C) 2026 Simon Newton
+# A memcache backed cache of the fields needed to list a responder.
+
+import collections
+import memcache_keys
+import pid_support
+import versioned_cache
+from google.appengine.ext import db
+from model import Responder, ResponderKeyName
+
+ResponderSummary = collections.namedtuple(
+    'ResponderSummary', ['name', 'manufacturer_id', 'model_id'])
+
+
+def GetSummaries(responder_ids):
+  """Get the summaries of a list of responders.
+
+  The summaries come from memcache, the responders which aren't cached are
+  fetched with a single batch get.
+
+  Args:
+    responder_ids: a list of pid_support responder ids.
+
+  Returns:
+    A list of ResponderSummary, in the same order as responder_ids. Responders
+    which don't exist are skipped.
+  """
+  cache_keys = [memcache_keys.ResponderSummaryKey(responder_id)
+                for responder_id in responder_ids]
+  summaries = versioned_cache.GetMulti(cache_keys)
+
+  missing = [i for i, summary in enumerate(summaries) if summary is None]
+  if missing:
+    keys = [db.Key.from_path(Responder.kind(), ResponderKeyName(
+                *pid_support.SplitResponderId(responder_ids[i])))
+            for i in missing]
+    new_items = []
+    for i, responder in zip(missing, db.get(keys)):
+      if responder is None:
+        continue
+      manufacturer_id, model_id = pid_support.SplitResponderId(
+          responder_ids[i])
+      summaries[i] = ResponderSummary(
+          responder.model_description, manufacturer_id, model_id)
+      new_items.append((cache_keys[i], summaries[i]))
+    if new_items:
+      versioned_cache.SetMulti(new_items)
+  return [summary for summary in summaries if summary is not None]
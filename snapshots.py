@@ -0,0 +1,248 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# snapshots.py
+# Copyright (C) 2026 Simon Newton
+# Pre-rendered copies of the exports, stored gzipped in the blobstore.
+#
+# The gzipped content is also kept in memcache, so most requests for an export
+# are served without touching the datastore or the blobstore.
+
+from __future__ import with_statement
+import common
+import datetime
+import gzip
+import hashlib
+import logging
+import memcache_keys
+import timestamp_keys
+import versioned_cache
+import zlib
+from StringIO import StringIO
+from google.appengine.api import files
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from model import ExportSnapshot
+
+EXPORT_MODELS = 'export_models'
+EXPORT_CONTROLLERS = 'export_controllers'
+MODEL_INFO = 'model_info'
+PIDS = 'pids'
+PIDS_ESTA = 'pids_esta'
+PIDS_ESTA_DRAFT = 'pids_esta_draft'
+PIDS_MANUFACTURERS = 'pids_manufacturers'
+MANUFACTURER_NAMES = 'manufacturer_names'
+
+# The pids= selection of /download -> snapshot name
+PID_SELECTIONS = {
+  '': PIDS,
+  'esta': PIDS_ESTA,
+  'esta-draft': PIDS_ESTA_DRAFT,
+  'manufacturers': PIDS_MANUFACTURERS,
+  'manufacturer-names': MANUFACTURER_NAMES,
+}
+
+# Snapshot name -> the timestamp_keys sections it's built from
+SNAPSHOTS = {
+  EXPORT_MODELS: [timestamp_keys.DEVICES, timestamp_keys.MANUFACTURERS],
+  EXPORT_CONTROLLERS: [timestamp_keys.CONTROLLERS,
+                       timestamp_keys.MANUFACTURERS],
+  MODEL_INFO: [timestamp_keys.DEVICES, timestamp_keys.MANUFACTURERS],
+  PIDS: [timestamp_keys.PIDS, timestamp_keys.MANUFACTURERS],
+  PIDS_ESTA: [timestamp_keys.PIDS, timestamp_keys.MANUFACTURERS],
+  PIDS_ESTA_DRAFT: [timestamp_keys.PIDS, timestamp_keys.MANUFACTURERS],
+  PIDS_MANUFACTURERS: [timestamp_keys.PIDS, timestamp_keys.MANUFACTURERS],
+  MANUFACTURER_NAMES: [timestamp_keys.MANUFACTURERS],
+}
+
+# The files API limits the size of a single write
+MAX_WRITE_SIZE = 512 * 1024
+
+
+def _SourceTime(name):
+  """The most recent update time of the data a snapshot is built from."""
+  update_times = [common.GetLastUpdateTime(timestamp_name)
+                  for timestamp_name in SNAPSHOTS[name]]
+  update_times = [t for t in update_times if t is not None]
+  if update_times:
+    return max(update_times)
+  return None
+
+
+def _IsCurrent(built_source_time, source_time):
+  return source_time is None or (built_source_time is not None and
+                                 built_source_time >= source_time)
+
+
+def _CacheKey(name):
+  return memcache_keys.SnapshotKey(name, *SNAPSHOTS[name])
+
+
+def _Cache(name, source_time, data):
+  versioned_cache.SetChunked(_CacheKey(name), (source_time, data))
+
+
+def ScheduleBuild(name):
+  """Add a task to build a snapshot.
+
+  The task is named after the snapshot and the update time of its data, so
+  this can be called as often as we like.
+  """
+  version = '0'
+  source_time = _SourceTime(name)
+  if source_time is not None:
+    version = source_time.strftime('%Y%m%d%H%M%S%f')
+  task = taskqueue.Task(method='GET',
+                        name='snapshot-%s-%s' % (name, version),
+                        url='/tasks/build_snapshot?name=%s' % name)
+  try:
+    task.add()
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def ScheduleBuilds(timestamp_name):
+  """Schedule a rebuild of every snapshot that depends on a timestamp."""
+  for name, timestamp_names in SNAPSHOTS.iteritems():
+    if timestamp_name in timestamp_names:
+      ScheduleBuild(name)
+
+
+def _Compress(content):
+  output = StringIO()
+  # set mtime so the same content always compresses to the same bytes
+  with gzip.GzipFile(fileobj=output, mode='wb', mtime=0) as f:
+    f.write(content)
+  return output.getvalue()
+
+
+def Decompress(data):
+  """Decompress the data returned by ReadSnapshot."""
+  return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def _WriteBlob(data):
+  file_name = files.blobstore.create(mime_type='application/x-gzip')
+  with files.open(file_name, 'a') as f:
+    for i in xrange(0, len(data), MAX_WRITE_SIZE):
+      f.write(data[i:i + MAX_WRITE_SIZE])
+  files.finalize(file_name)
+  return files.blobstore.get_blob_key(file_name)
+
+
+def Render(name, render):
+  """Render an export into a single buffer, and cache it.
+
+  This is used when there isn't a current snapshot. The snapshot itself is
+  left to the task which ScheduleBuild() adds.
+
+  Returns:
+    The gzipped content.
+  """
+  source_time = _SourceTime(name)
+  out = StringIO()
+  render(out)
+  content = out.getvalue()
+  if isinstance(content, unicode):
+    content = content.encode('utf-8')
+  data = _Compress(content)
+  _Cache(name, source_time, data)
+  return data
+
+
+def Build(name, render):
+  """Build a snapshot.
+
+  Args:
+    name: the name of the snapshot.
+    render: a function which takes a file-like object, and writes the export
+      to it.
+
+  Returns:
+    True if the content changed, False otherwise.
+  """
+  # read this first, so if the data changes while we're rendering the snapshot
+  # is considered stale.
+  source_time = _SourceTime(name)
+  out = StringIO()
+  render(out)
+  content = out.getvalue()
+  if isinstance(content, unicode):
+    content = content.encode('utf-8')
+  content_hash = hashlib.sha1(content).hexdigest()
+
+  snapshot = ExportSnapshot.get_by_key_name(name)
+  if snapshot is None:
+    snapshot = ExportSnapshot(key_name=name)
+  old_blob_key = ExportSnapshot.blob.get_value_for_datastore(snapshot)
+
+  changed = snapshot.content_hash != content_hash or old_blob_key is None
+  data = _Compress(content)
+  if changed:
+    snapshot.blob = _WriteBlob(data)
+    snapshot.content_hash = content_hash
+  snapshot.source_time = source_time
+  snapshot.build_time = datetime.datetime.now()
+  snapshot.put()
+
+  if changed and old_blob_key is not None:
+    blobstore.delete(old_blob_key)
+  _Cache(name, source_time, data)
+  logging.info('Built snapshot %s, %d bytes, changed: %s' %
+               (name, len(content), changed))
+  return changed
+
+
+def GetCurrentSnapshot(name):
+  """Get the snapshot for an export, if it's up to date.
+
+  Returns:
+    The ExportSnapshot entity, or None if there isn't a snapshot or the data
+    has changed since it was built.
+  """
+  snapshot = ExportSnapshot.get_by_key_name(name)
+  if (snapshot is None or
+      ExportSnapshot.blob.get_value_for_datastore(snapshot) is None):
+    return None
+
+  if not _IsCurrent(snapshot.source_time, _SourceTime(name)):
+    return None
+  return snapshot
+
+
+def ReadSnapshot(snapshot):
+  """Return the gzipped content of a snapshot."""
+  blob_key = ExportSnapshot.blob.get_value_for_datastore(snapshot)
+  return blobstore.BlobReader(blob_key).read()
+
+
+def GetCurrentData(name):
+  """Get the gzipped content of an export, if there's an up to date copy.
+
+  memcache is checked first, then the snapshot in the blobstore.
+
+  Returns:
+    The gzipped content, or None if the export needs to be rendered.
+  """
+  source_time = _SourceTime(name)
+  cached = versioned_cache.GetChunked(_CacheKey(name))
+  if cached is not None and _IsCurrent(cached[0], source_time):
+    return cached[1]
+
+  snapshot = GetCurrentSnapshot(name)
+  if snapshot is None:
+    return None
+  data = ReadSnapshot(snapshot)
+  _Cache(name, snapshot.source_time, data)
+  return data
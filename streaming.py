@@ -0,0 +1,61 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# streaming.py
+# Copyright (C) 2026 Simon Newton
+# Writers that stream an export to a file-like object.
+
+import csv
+import json
+
+
+class JsonListWriter(object):
+  """Writes a JSON object with a single list, one item at a time.
+
+  The output is the same as json.dumps({name: items}), without having to hold
+  all the items in memory.
+  """
+  def __init__(self, out, name):
+    self._out = out
+    self._first = True
+    self._out.write('{%s: [' % json.dumps(name))
+
+  def Write(self, item):
+    """Write one item of the list."""
+    if not self._first:
+      self._out.write(', ')
+    self._out.write(json.dumps(item))
+    self._first = False
+
+  def Close(self):
+    """Finish the output, this must be called once all items are written."""
+    self._out.write(']}')
+
+
+class CsvWriter(object):
+  """Writes CSV rows, one at a time.
+
+  The csv module doesn't handle unicode, so fields are encoded as UTF-8.
+  """
+  def __init__(self, out):
+    self._writer = csv.writer(out, lineterminator='\n')
+
+  def Write(self, fields):
+    """Write a row, fields is a list of strings."""
+    self._writer.writerow([self._Encode(field) for field in fields])
+
+  def _Encode(self, field):
+    if isinstance(field, unicode):
+      return field.encode('utf-8')
+    return field
@@ -16,93 +16,199 @@
 # Copyright (C) 2011 Simon Newton
 # Defines the task queue handlers.
 
-from google.appengine.api import images
+import command_messages
+import compression
+import export
+import image_fetcher
+import json
+import logging
+import model_load_job
+import snapshots
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
 from google.appengine.ext import webapp
-from image_fetcher import ImageFetcher
-from model import Product, Responder
-from pid_index_builder import PidIndexBuilder
-
-
-class FetchResponderImage(webapp.RequestHandler):
-  """Fetch the image for a responder entity."""
-  def get(self):
-    key = self.request.get('key')
-    responder = Responder.get(key)
-    if not responder:
-      return
+from key_migrator import KeyMigrator, STAGES
+from model import Command, Manufacturer, Responder
+from model_loader import ModelUpdater
+import manufacturer_directory
+import pid_index_builder
+import ranking
+from utils import StringToInt
+
+
+class FetchImages(webapp.RequestHandler):
+  """Fetch the images for a batch of responders & products, see
+     image_fetcher.py.
+  """
+  def post(self):
+    image_fetcher.FetchImages(json.loads(self.request.body))
 
-    if responder.image_url and not responder.image_data:
-      fetcher = ImageFetcher()
-      blob_key = fetcher.FetchAndSaveImage(responder.image_url)
 
-      if blob_key:
-        responder.image_data = blob_key
-        responder.image_serving_url = images.get_serving_url(blob_key)
-        responder.put()
-    return
+class FetchImage(webapp.RequestHandler):
+  """Fetch the image for a single responder or product.
 
-
-class FetchProductImage(webapp.RequestHandler):
-  """Fetch the image for a product entity."""
+  This handles the tasks that were queued before FetchImages.
+  """
   def get(self):
-    key = self.request.get('key')
-    product = Product.get(key)
-    if not product:
-      return
-
-    if product.image_url and not product.image_data:
-      fetcher = ImageFetcher()
-      blob_key = fetcher.FetchAndSaveImage(product.image_url)
-
-      if blob_key:
-        product.image_data = blob_key
-        product.image_serving_url = images.get_serving_url(blob_key)
-        product.put()
-    return
+    image_fetcher.FetchImages([self.request.get('key')])
 
 
 class RankDevices(webapp.RequestHandler):
-  """Rank the devices according to a simple scoring algorithm."""
+  """Rescore all the devices, see ranking.py."""
   def get(self):
-    for device in Responder.all():
-      score = 0
-      if device.image_data is not None:
-        # 10 point boost for having an image
-        score += 10
-      if device.link is not None:
-        # 1 point boost for having a link
-        score += 1
-      if device.software_version_set.count():
-        # 10 point boost for having version information
-        score += 10
-
-      if device.score_penalty:
-        score -= device.score_penalty
-
-      # up to +20 pts for having test results
-      if device.rdm_responder_rating is not None:
-        score += int(device.rdm_responder_rating / 5)
-
-      device.score = score
-      device.put()
+    ranking.RankAll()
     return
 
 
 class BuildPidResponderIndex(webapp.RequestHandler):
   """Build the mappings between PIDs and the responders which support the
      PID.
+
+  This is a consistency check, the index is normally kept up to date by
+  ApplyPidDeltas.
   """
   def get(self):
-    builder = PidIndexBuilder()
+    builder = pid_index_builder.PidIndexBuilder()
     builder.BuildIndex()
     return
 
 
-tasks_application = webapp.WSGIApplication(
+class ApplyPidDeltas(webapp.RequestHandler):
+  """Apply the supported parameter changes queued by the ModelUpdater."""
+  def post(self):
+    pid_index_builder.ApplyDeltas(json.loads(self.request.body))
+
+
+class MigrateKeys(webapp.RequestHandler):
+  """Move entities onto their deterministic key names.
+
+  Each task handles a single batch and then queues the next one, so this can
+  be restarted from the beginning at any time.
+  """
+  URL = '/tasks/migrate_keys'
+
+  def get(self):
+    stage = StringToInt(self.request.get('stage'), False) or 0
+    if stage >= len(STAGES):
+      logging.info('Key migration complete')
+      return
+
+    migrator = KeyMigrator()
+    if not migrator.MigrateBatch(stage):
+      logging.info('Completed key migration for %s' %
+                   STAGES[stage].kind.kind())
+      if STAGES[stage].kind == Manufacturer:
+        manufacturer_directory.InvalidateManufacturers()
+      stage += 1
+
+    task = taskqueue.Task(method='GET',
+                          url='%s?stage=%d' % (self.URL, stage))
+    task.add()
+
+
+class DenormalizeResponders(webapp.RequestHandler):
+  """Populate the denormalized fields for existing responders.
+
+  This updates the latest software fields, the tag labels and the search
+  tokens. It processes a batch of responders and then queues the next batch.
+  """
+  URL = '/tasks/denormalize_responders'
+  BATCH_SIZE = 50
+
+  def get(self):
+    query = Responder.all()
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+
+    updater = ModelUpdater()
+    responders = query.fetch(self.BATCH_SIZE)
+    updated = 0
+    for responder in responders:
+      modified = updater.UpdateLatestSoftware(responder)
+      modified = updater.UpdateTagLabels(responder) or modified
+      modified = updater.UpdateSearchTokens(responder) or modified
+      if modified:
+        updated += 1
+    updater.Flush()
+    logging.info('Updated %d of %d responders' % (updated, len(responders)))
+
+    if len(responders) == self.BATCH_SIZE:
+      task = taskqueue.Task(method='GET',
+                            url='%s?cursor=%s' % (self.URL, query.cursor()))
+      task.add()
+
+
+class MigrateCommands(webapp.RequestHandler):
+  """Convert the Command messages to canonical JSON.
+
+  This processes a batch of commands and then queues the next batch.
+  """
+  URL = '/tasks/migrate_commands'
+  BATCH_SIZE = 100
+
+  def get(self):
+    query = Command.all()
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+
+    commands = query.fetch(self.BATCH_SIZE)
+    updated = [command for command in commands
+               if command_messages.SetMessages(
+                   command,
+                   command_messages.Request(command),
+                   command_messages.Response(command))]
+    db.put(updated)
+    logging.info('Migrated %d of %d commands' % (len(updated), len(commands)))
+
+    if len(commands) == self.BATCH_SIZE:
+      task = taskqueue.Task(method='GET',
+                            url='%s?cursor=%s' % (self.URL, query.cursor()))
+      task.add()
+
+
+class BuildSnapshot(webapp.RequestHandler):
+  """Render one of the exports and store it as a snapshot."""
+  def get(self):
+    name = self.request.get('name')
+    if name not in export.SNAPSHOT_RENDERERS:
+      logging.error('Unknown snapshot %s' % name)
+      return
+    snapshots.Build(name, export.SNAPSHOT_RENDERERS[name])
+
+
+class LoadModels(webapp.RequestHandler):
+  """Load one chunk of the model data, see model_load_job.py."""
+  def get(self):
+    manufacturer_id = StringToInt(self.request.get('manufacturer'))
+    start = StringToInt(self.request.get('start'))
+    if manufacturer_id is None or start is None:
+      logging.error('Invalid chunk %s' % self.request.query_string)
+      return
+    model_load_job.LoadChunk(self.request.get('job'), manufacturer_id, start)
+
+
+class FinishModelLoad(webapp.RequestHandler):
+  """Complete a model load once all the chunks are done."""
+  def get(self):
+    attempt = StringToInt(self.request.get('attempt')) or 0
+    model_load_job.Finish(self.request.get('job'), attempt)
+
+
+tasks_application = compression.GzipMiddleware(webapp.WSGIApplication(
   [
-    ('/tasks/fetch_image', FetchResponderImage),
-    ('/tasks/fetch_product_image', FetchProductImage),
+    ('/tasks/fetch_image', FetchImage),
+    ('/tasks/fetch_images', FetchImages),
+    ('/tasks/fetch_product_image', FetchImage),
     ('/tasks/rank_devices', RankDevices),
+    ('/tasks/apply_pid_deltas', ApplyPidDeltas),
     ('/tasks/build_pid_responder_index', BuildPidResponderIndex),
+    ('/tasks/build_snapshot', BuildSnapshot),
+    ('/tasks/denormalize_responders', DenormalizeResponders),
+    ('/tasks/migrate_commands', MigrateCommands),
+    ('/tasks/migrate_keys', MigrateKeys),
+    ('/tasks/load_models', LoadModels),
+    ('/tasks/finish_model_load', FinishModelLoad),
   ],
-  debug=True)
+  debug=True))
@@ -21,5 +21,11 @@ DEVICES = 'devices'
 MANUFACTURERS = 'manufacturers'
 NODES = 'nodes'
 PIDS = 'pids'
+# The PID to responder index, see pid_index_builder.py
+PID_INDEX = 'pid_index'
 SOFTWARE = 'software'
 SPLITTERS = 'splitters'
+
+# All the sections of the index
+ALL = [CONTROLLERS, DEVICES, MANUFACTURERS, NODES, PIDS, PID_INDEX, SOFTWARE,
+       SPLITTERS]
@@ -0,0 +1,93 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# unit_of_work.py
+# Copyright (C) 2026 Simon Newton
+# Collects the datastore writes for an update and batches them.
+
+import counters
+import logging
+from google.appengine.ext import db
+
+# The maximum number of entities in a single put or delete
+MAX_BATCH_SIZE = 500
+
+
+def _Identity(entity):
+  """Entities with a complete key are tracked by key, the rest by object."""
+  if entity.has_key():
+    return entity.key()
+  return id(entity)
+
+
+class UnitOfWork(object):
+  """Records the new, modified and deleted entities during an update.
+
+  Nothing is written until Flush() is called, and an entity that's changed
+  several times is only written once. Entities which are referenced by other
+  entities in the same unit of work need a key name, since a reference can't
+  be made to an entity that doesn't have a complete key.
+  """
+  def __init__(self, batch_size=MAX_BATCH_SIZE):
+    self._batch_size = batch_size
+    self._puts = {}
+    self._deletes = {}
+    self._deltas = []
+
+  def Put(self, entity):
+    """Mark an entity as new or modified."""
+    self._puts[_Identity(entity)] = entity
+
+  def Delete(self, entity):
+    """Mark an entity for deletion."""
+    identity = _Identity(entity)
+    self._puts.pop(identity, None)
+    if entity.has_key():
+      self._deletes[identity] = entity.key()
+
+  def AddCounterDeltas(self, deltas):
+    """Record the counter changes for the entities in this unit of work.
+
+    Args:
+      deltas: a list of (counters.Counter, delta) tuples.
+    """
+    self._deltas.extend(deltas)
+
+  def IsEmpty(self):
+    return not (self._puts or self._deletes or self._deltas)
+
+  def _InBatches(self, function, items):
+    for i in xrange(0, len(items), self._batch_size):
+      function(items[i:i + self._batch_size])
+
+  def Flush(self):
+    """Write everything that has been recorded.
+
+    The counters are updated after the entities are written, so they can
+    drift if a flush fails half way. /admin?action=recount fixes them.
+    """
+    if self.IsEmpty():
+      return
+
+    puts = self._puts.values()
+    deletes = self._deletes.values()
+    deltas = self._deltas
+    self._puts = {}
+    self._deletes = {}
+    self._deltas = []
+
+    self._InBatches(db.put, puts)
+    self._InBatches(db.delete, deletes)
+    counters.IncrementAll(deltas)
+    logging.info('Flushed %d puts, %d deletes' % (len(puts), len(deletes)))
@@ -0,0 +1,39 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# update_times.py
+# Copyright (C) 2026 Simon Newton
+# Record changes to a section of the index.
+
+import datetime
+import memcache_keys
+import snapshots
+import versioned_cache
+from model import LastUpdateTime, LastUpdateTimeKeyName
+
+
+def UpdateModificationTime(timestamp_name):
+  """Update a particular timestamp."""
+  key_name = LastUpdateTimeKeyName(timestamp_name)
+  result = LastUpdateTime.get_by_key_name(key_name)
+  if result is None:
+    result = LastUpdateTime(key_name=key_name, name=timestamp_name)
+  result.update_time = datetime.datetime.now()
+  result.put()
+
+  # drop everything cached for this section, including the index info
+  versioned_cache.Invalidate(timestamp_name)
+  versioned_cache.Set(memcache_keys.LastUpdateTimeKey(timestamp_name),
+                      result.update_time)
+  snapshots.ScheduleBuilds(timestamp_name)
@@ -0,0 +1,170 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# versioned_cache.py
+# Copyright (C) 2026 Simon Newton
+# Memcache access, versioned by a generation counter per data domain.
+
+import cPickle as pickle
+import hashlib
+import logging
+import time
+from google.appengine.api import memcache
+
+GENERATION_KEY = 'generation:%s'
+# Values larger than this are split by SetChunked. memcache's limit is 1MB per
+# item, this leaves room for the key & overhead.
+MAX_CHUNK_SIZE = 1000 * 1000
+
+
+def _NewGeneration():
+  # Start from the current time, rather than 0, so that we don't re-use a
+  # generation number if the counter is evicted.
+  return int(time.time() * 1000)
+
+
+def GetGenerations(domains):
+  """Get the current generation numbers for a list of domains.
+
+  Returns:
+    A list of generation numbers, in the same order as domains. An entry is
+    None if memcache is unavailable.
+  """
+  keys = [GENERATION_KEY % domain for domain in domains]
+  generations = memcache.get_multi(keys)
+  missing = [key for key in keys if key not in generations]
+  if missing:
+    initial = _NewGeneration()
+    memcache.add_multi(dict((key, initial) for key in missing))
+    generations.update(memcache.get_multi(missing))
+  return [generations.get(key) for key in keys]
+
+
+def GetGeneration(domain):
+  """Get the current generation number for a domain."""
+  return GetGenerations([domain])[0]
+
+
+def _VersionedKeys(cache_keys):
+  domains = sorted(set(domain for cache_key in cache_keys
+                       for domain in cache_key.domains))
+  generations = dict(zip(domains, GetGenerations(domains)))
+  return ['%s@%s' % (
+              cache_key.name,
+              ','.join('%s.%s' % (domain, generations[domain])
+                       for domain in cache_key.domains))
+          for cache_key in cache_keys]
+
+
+def _VersionedKey(cache_key):
+  return _VersionedKeys([cache_key])[0]
+
+
+def Get(cache_key):
+  """Get a value from memcache.
+
+  Args:
+    cache_key: a memcache_keys.CacheKey.
+  """
+  return memcache.get(_VersionedKey(cache_key))
+
+
+def Set(cache_key, value, time=0):
+  """Set a value in memcache."""
+  return memcache.set(_VersionedKey(cache_key), value, time=time)
+
+
+def Add(cache_key, value, time=0):
+  """Add a value to memcache, if it isn't already present."""
+  return memcache.add(_VersionedKey(cache_key), value, time=time)
+
+
+def GetMulti(cache_keys):
+  """Get several values from memcache.
+
+  The generation numbers are fetched once for all the keys.
+
+  Returns:
+    A list of values, in the same order as cache_keys. An entry is None if
+    the value isn't present.
+  """
+  keys = _VersionedKeys(cache_keys)
+  values = memcache.get_multi(keys)
+  return [values.get(key) for key in keys]
+
+
+def SetMulti(items, time=0):
+  """Set several values in memcache.
+
+  Args:
+    items: a list of (memcache_keys.CacheKey, value) tuples.
+  """
+  keys = _VersionedKeys([cache_key for cache_key, _ in items])
+  return not memcache.set_multi(
+      dict((key, value) for key, (_, value) in zip(keys, items)), time=time)
+
+
+def SetChunked(cache_key, value, time=0):
+  """Set a value which may be larger than memcache's item limit.
+
+  The value is pickled and stored in chunks, along with a manifest which
+  lists the number of chunks and the hash of the data.
+
+  Returns:
+    True if all the chunks were stored.
+  """
+  key = _VersionedKey(cache_key)
+  data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+  items = {}
+  chunk_count = 0
+  for i in xrange(0, len(data), MAX_CHUNK_SIZE):
+    items['%s:%d' % (key, chunk_count)] = data[i:i + MAX_CHUNK_SIZE]
+    chunk_count += 1
+  items[key] = (chunk_count, hashlib.sha1(data).hexdigest())
+  return not memcache.set_multi(items, time=time)
+
+
+def GetChunked(cache_key):
+  """Get a value stored with SetChunked.
+
+  Returns:
+    The value, or None if it's not present or any of the chunks are missing.
+  """
+  key = _VersionedKey(cache_key)
+  manifest = memcache.get(key)
+  if manifest is None:
+    return None
+
+  chunk_count, digest = manifest
+  chunk_keys = ['%s:%d' % (key, i) for i in xrange(chunk_count)]
+  chunks = memcache.get_multi(chunk_keys)
+  if len(chunks) != chunk_count:
+    return None
+  data = ''.join(chunks[chunk_key] for chunk_key in chunk_keys)
+  # the chunks may be from different calls to SetChunked
+  if hashlib.sha1(data).hexdigest() != digest:
+    return None
+  return pickle.loads(data)
+
+
+def Invalidate(*domains):
+  """Bump the generation of each domain.
+
+  This invalidates every key derived from the domain, the old entries are left
+  for memcache to evict.
+  """
+  for domain in domains:
+    if memcache.incr(GENERATION_KEY % domain,
+                     initial_value=_NewGeneration()) is None:
+      logging.error('Generation memcache incr failed for %s' % domain)